@@ -0,0 +1,140 @@
+"""Peak memory of downloading one large attachment.
+
+Compares the old path (FETCH RFC822, email.message_from_bytes and
+get_payload(decode=True)) with the streaming path of imap_fetch, which
+decodes partial BODY.PEEK fetches chunk by chunk straight into the file.
+Every mode runs in a fresh process against a fake IMAP server running in
+another process, so the numbers are the peak RSS of the client only.
+
+Usage: python benchmarks/bench_attachment_memory.py --size-mb 40
+"""
+import argparse
+import email
+import imaplib
+import json
+import multiprocessing
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from email.message import EmailMessage
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "email_downloader"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+
+# Function to get the peak resident memory of this process in MB
+def peak_rss_mb():
+    # VmHWM is reset by exec, ru_maxrss can still hold the peak of the parent that forked us
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Function to build a message with one large PDF attachment
+def build_message(size_mb):
+    msg = EmailMessage()
+    msg["Subject"] = "Sammelrechnung"
+    msg["From"] = "Lieferant <rechnung@lieferant.de>"
+    msg["To"] = "re@example.com"
+    msg["Date"] = email.utils.formatdate()
+    msg["Message-ID"] = email.utils.make_msgid()
+    msg.set_content("Anbei die Rechnungen.")
+    msg.add_attachment(b"%PDF-1.4\n" + os.urandom(size_mb * 1024 * 1024), maintype="application",
+                       subtype="pdf", filename="sammelrechnung.pdf")
+    return msg.as_bytes()
+
+
+# Function to download the attachment the way check_inbox did with RFC822
+def download_legacy(mail, target_dir):
+    status, data = mail.uid("fetch", "1", "(RFC822)")
+    for response_part in data:
+        if isinstance(response_part, tuple):
+            msg = email.message_from_bytes(response_part[1])
+            for part in msg.walk():
+                filename = part.get_filename()
+                if filename:
+                    with open(target_dir / filename, "wb") as f:
+                        f.write(part.get_payload(decode=True))
+
+
+# Function to download the attachment with BODYSTRUCTURE and streamed partial fetches
+def download_streaming(mail, target_dir):
+    from imap_fetch import fetch_message_structures, download_attachments
+    messages = fetch_message_structures(mail, [1])
+    for message in messages:
+        for part in message["parts"]:
+            part["path"] = target_dir / part["filename"]
+    download_attachments(mail, messages)
+
+
+# Function to run one mode and print its measurements as JSON
+def run_mode(mode, port, target_dir):
+    mail = imaplib.IMAP4("127.0.0.1", port)
+    mail.login("bench", "bench")
+    mail.select("inbox")
+
+    baseline = peak_rss_mb()
+    start = time.perf_counter()
+    if mode == "legacy":
+        download_legacy(mail, target_dir)
+    else:
+        download_streaming(mail, target_dir)
+    seconds = time.perf_counter() - start
+    mail.logout()
+
+    print(json.dumps({"mode": mode, "seconds": seconds, "baseline_mb": baseline, "peak_mb": peak_rss_mb()}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size-mb", type=int, default=40)
+    parser.add_argument("--mode", choices=["legacy", "streaming"])
+    parser.add_argument("--port", type=int)
+    parser.add_argument("--target")
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.port, Path(args.target))
+        return
+
+    from fake_imap_server import serve_folder
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        (tmp / "mail").mkdir()
+        (tmp / "mail" / "large.eml").write_bytes(build_message(args.size_mb))
+
+        port_queue = multiprocessing.Queue()
+        server = multiprocessing.Process(target=serve_folder, args=(tmp / "mail", port_queue), daemon=True)
+        server.start()
+        port = port_queue.get()
+
+        print(f"Attachment size: {args.size_mb} MB")
+        print(f"{'Mode':<12} {'Seconds':>8} {'Peak RSS (MB)':>14} {'Growth (MB)':>12}")
+        try:
+            for mode in ("legacy", "streaming"):
+                target = tmp / mode
+                target.mkdir()
+                output = subprocess.run([sys.executable, __file__, "--mode", mode, "--port", str(port),
+                                         "--target", str(target)], capture_output=True, text=True, check=True)
+                result = json.loads(output.stdout.strip().splitlines()[-1])
+                growth = result["peak_mb"] - result["baseline_mb"]
+                print(f"{mode:<12} {result['seconds']:>8.2f} {result['peak_mb']:>14.1f} {growth:>12.1f}")
+        finally:
+            server.terminate()
+
+        same = (tmp / "legacy" / "sammelrechnung.pdf").read_bytes() == (tmp / "streaming" / "sammelrechnung.pdf").read_bytes()
+        print(f"Identical output files: {'yes' if same else 'NO'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Cost of keeping email_info.xlsx up to date: per-row rewrite vs batched export.
+
+"per-row" is the old save_email_info_to_excel (pd.read_excel, mask, concat,
+to_excel for every email), measured on a workbook that already holds
+--rows rows. "batched" adds all --rows rows to the SQLite index through the
+current save_email_info_to_excel and exports the workbook once with
+flush_excel_exports (openpyxl write-only mode).
+
+Usage: python benchmarks/bench_excel_export.py --rows 10000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "email_downloader"))
+
+COLUMNS = ["Date", "Email", "Subject", "Attachments", "Invoice_number"]
+
+
+# Function to build a synthetic email record
+def make_record(i):
+    return {
+        "Date": f"Mon, {1 + i % 28:02d} Jan 2024 {i % 24:02d}:{i % 60:02d}:00 +0100",
+        "Email": f"rechnung{i % 500}@lieferant{i % 37}.de",
+        "Subject": f"Ihre Rechnung {100000 + i}",
+        "Message_ID": f"<{i}@bench>",
+        "Attachments": [f"rechnung_{100000 + i}.pdf"],
+        "Invoice_number": str(100000 + i)
+    }
+
+
+# Function with the pandas read-modify-write logic save_email_info_to_excel used before
+def legacy_save_email_info_to_excel(email_data, excel_file):
+    import pandas as pd
+    if os.path.exists(excel_file):
+        df = pd.read_excel(excel_file)
+        for col in COLUMNS:
+            if col not in df.columns:
+                df[col] = None
+    else:
+        df = pd.DataFrame(columns=COLUMNS)
+    df['Invoice_number'] = df['Invoice_number'].astype(str)
+
+    existing_entry = df[(df['Date'] == email_data['Date']) & (df['Email'] == email_data['Email'])]
+    if not existing_entry.empty:
+        idx = existing_entry.index[0]
+        df.at[idx, 'Attachments'] = email_data['Attachments']
+        df.at[idx, 'Invoice_number'] = email_data['Invoice_number']
+    else:
+        df = pd.concat([df, pd.DataFrame([{column: email_data[column] for column in COLUMNS}])], ignore_index=True)
+    df[COLUMNS].to_excel(excel_file, index=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--samples", type=int, default=5, help="per-row appends timed on the full workbook")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        # The index database lives in data/ of the working directory
+        os.chdir(tmp)
+        import file_handler
+
+        # Batched: every row goes to the index, one export at the end
+        batched_file = tmp / "batched.xlsx"
+        start = time.perf_counter()
+        for i in range(args.rows):
+            file_handler.save_email_info_to_excel(make_record(i), batched_file)
+        buffered = time.perf_counter() - start
+        start = time.perf_counter()
+        file_handler.flush_excel_exports()
+        flushed = time.perf_counter() - start
+
+        # Per-row: start from the same workbook and time a few appends, each rewrites everything
+        legacy_file = tmp / "legacy.xlsx"
+        file_handler.write_excel_rows(legacy_file, [make_record(i) for i in range(args.rows)])
+        start = time.perf_counter()
+        for i in range(args.rows, args.rows + args.samples):
+            legacy_save_email_info_to_excel(make_record(i), legacy_file)
+        per_row = (time.perf_counter() - start) / args.samples
+
+    print(f"Rows: {args.rows}")
+    print(f"per-row: {per_row * 1000:10.1f} ms per email at {args.rows} rows "
+          f"(~{per_row * args.rows / 2 / 60:.0f} min to build {args.rows} rows one by one, cost grows with the size)")
+    print(f"batched: {buffered / args.rows * 1e6:10.1f} us per email indexed, "
+          f"{flushed:.2f} s for one export of {args.rows} rows")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Time of finding the invoice number in worst-case texts.
+
+"legacy" is the old extract_invoice_number: six regexes run one after the
+other over the full text with re.DOTALL. "engine" is invoice_patterns,
+which only runs the rules in short windows around "Rechnung" hits. Every
+text is measured at growing sizes; legacy time grows with the square of
+the size on the bad inputs, the engine stays linear.
+
+Usage: python benchmarks/bench_invoice_patterns.py --sizes 5000 10000 20000 40000
+"""
+import argparse
+import re
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "email_downloader"))
+
+LEGACY_PATTERNS = [
+    r'Rechnungsnr\.?\s*:\s*([\w\d-]+)',
+    r'Rechnung\s+(\d{4}/\d{4})',
+    r'(?:Rechnung\s*Nr\.?|Rechnungs-Nr\.?|Rechnungsnummer)[\s:]*[-\s]*([\w\d-]+)',
+    r'[\D]*(\d{8,})[\D]*Rechnungsnummer',
+    r'(\d{8,})\s*[\s\S]*?Rechnungsnummer\s*[:\s]*',
+    r'(\d{8,})\s*Rechnungsnummer\s*[:\s]*'
+]
+
+# Texts that make the old patterns backtrack, repeated up to the requested size
+WORST_CASES = {
+    # Long numbers (article, IBAN-like) and no "Rechnungsnummer" at all
+    "digits_no_keyword": "Artikel 12345678901 Menge 1 Preis 10,00\n",
+    # Letters only: [\D]* at every position scans to the end of the text
+    "no_digits": "Lieferschein ohne Nummer fuer die Bestellung\n",
+    # The keyword stem everywhere, but never a full rule
+    "keyword_near_miss": "Rechnung folgt 12345678 Rechnungsnumme\n",
+}
+
+
+# Function with the matching logic extract_invoice_number used before the pattern engine
+def legacy_find(text):
+    for pattern in LEGACY_PATTERNS:
+        match = re.search(pattern, text, re.MULTILINE | re.DOTALL)
+        if match:
+            return match.group(1).strip()
+    return None
+
+
+# Function to time one call, repeated until it took long enough to be measured
+def measure(fn, text, max_seconds):
+    runs, start = 0, time.perf_counter()
+    while True:
+        fn(text)
+        runs += 1
+        elapsed = time.perf_counter() - start
+        if elapsed > 0.2 or elapsed > max_seconds:
+            return elapsed / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[5000, 10000, 20000, 40000])
+    parser.add_argument("--legacy-limit", type=float, default=20.0, help="stop timing legacy above this (s)")
+    args = parser.parse_args()
+
+    from invoice_patterns import InvoicePatternEngine
+    engine = InvoicePatternEngine()
+
+    print(f"{'text':<20} {'chars':>8} {'legacy ms':>12} {'engine ms':>12}")
+    for name, unit in WORST_CASES.items():
+        legacy_too_slow = False
+        for size in args.sizes:
+            text = (unit * (size // len(unit) + 1))[:size]
+            if legacy_too_slow:
+                legacy = "skipped"
+            else:
+                seconds = measure(legacy_find, text, args.legacy_limit)
+                legacy_too_slow = seconds > args.legacy_limit / 4
+                legacy = f"{seconds * 1000:12.2f}"
+            engine_ms = measure(engine.find, text, args.legacy_limit) * 1000
+            print(f"{name:<20} {size:>8} {legacy:>12} {engine_ms:12.2f}")
+
+
+if __name__ == "__main__":
+    main()
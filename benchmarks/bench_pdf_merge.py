@@ -0,0 +1,133 @@
+"""Time and peak memory of merging many large PDF attachments.
+
+"legacy" is the old merge_email_attachments (PyPDF2.PdfMerger, one
+merger.write at the end). "current" is pdf_handler.merge_email_attachments.
+Every input is a one page PDF with --size-mb of image data; every mode
+runs in a fresh process on its own copy of the inputs, so the peak RSS is
+the one of the merge only.
+
+Usage: python benchmarks/bench_pdf_merge.py --files 50 --size-mb 10
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "email_downloader"))
+
+
+# Function to get the peak resident memory of this process in MB
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Function to write a one page PDF that shows an uncompressed gray image of about size bytes
+def write_image_pdf(path, size):
+    side = int(size ** 0.5)
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Resources << /XObject << /Im0 5 0 R >> >> "
+        b"/Contents 4 0 R >>",
+    ]
+    content = b"q 595 0 0 842 0 0 cm /Im0 Do Q"
+    with open(path, "wb") as f:
+        offsets = []
+        f.write(b"%PDF-1.4\n")
+        for number, body in enumerate(objects, 1):
+            offsets.append(f.tell())
+            f.write(b"%d 0 obj\n" % number + body + b"\nendobj\n")
+        offsets.append(f.tell())
+        f.write(b"4 0 obj\n<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream\nendobj\n")
+        offsets.append(f.tell())
+        f.write(b"5 0 obj\n<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace /DeviceGray "
+                b"/BitsPerComponent 8 /Length %d >>\nstream\n" % (side, side, side * side))
+        for _ in range(side):
+            f.write(os.urandom(side))
+        f.write(b"\nendstream\nendobj\n")
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1))
+        for offset in offsets:
+            f.write(b"%010d 00000 n \n" % offset)
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(offsets) + 1, xref))
+
+
+# Function with the merge logic merge_email_attachments used before
+def legacy_merge(pdf_files, output_path):
+    import PyPDF2
+    merger = PyPDF2.PdfMerger()
+    try:
+        for pdf_file in pdf_files:
+            merger.append(str(pdf_file))
+        with open(output_path, "wb") as f_out:
+            merger.write(f_out)
+    finally:
+        merger.close()
+        for pdf_file in pdf_files:
+            Path(pdf_file).unlink()
+    return output_path
+
+
+# Function to run one mode in this process and print its result as JSON
+def run_mode(mode, folder):
+    pdf_files = sorted(Path(folder).glob("in_*.pdf"))
+    start = time.perf_counter()
+    if mode == "legacy":
+        output = legacy_merge(pdf_files, Path(folder) / "merged.pdf")
+    else:
+        from pdf_handler import merge_email_attachments
+        output = merge_email_attachments(pdf_files, "merged.pdf")
+    elapsed = time.perf_counter() - start
+    peak_mb = peak_rss_mb()
+    from PyPDF2 import PdfReader
+    with open(output, "rb") as f:
+        pages = len(PdfReader(f).pages)
+    print(json.dumps({"seconds": elapsed, "peak_mb": peak_mb, "pages": pages,
+                      "output_mb": os.path.getsize(output) / 1024 / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=50)
+    parser.add_argument("--size-mb", type=int, default=10)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    parser.add_argument("--folder", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.mode:
+        run_mode(args.mode, args.folder)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        source = Path(tmp) / "source"
+        source.mkdir()
+        for i in range(args.files):
+            write_image_pdf(source / f"in_{i:03d}.pdf", args.size_mb * 1024 * 1024)
+        print(f"Merging {args.files} PDFs of {args.size_mb} MB")
+
+        for mode in ("legacy", "current"):
+            folder = Path(tmp) / mode
+            shutil.copytree(source, folder)
+            result = subprocess.run([sys.executable, __file__, "--mode", mode, "--folder", str(folder)],
+                                    capture_output=True, text=True, check=True)
+            stats = json.loads(result.stdout.strip().splitlines()[-1])
+            print(f"{mode:<8} {stats['seconds']:7.2f} s  peak {stats['peak_mb']:8.1f} MB  "
+                  f"{stats['pages']} pages, {stats['output_mb']:.0f} MB written")
+            shutil.rmtree(folder)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+"""Benchmark suite: end-to-end check_inbox and the hot functions on synthetic data.
+
+Every benchmark runs in a fresh process, so its peak RSS is its own:
+
+  e2e         check_inbox against the fake IMAP server (another process) on a
+              synthetic mailbox: messages/s, MB/s, per-stage latency, peak
+              memory of the client and of the worker processes, and how many
+              invoice numbers were found, missed or wrong per number format
+  extraction  extract_invoice_from_pdf on text invoices of 1 to --max-pages pages
+  patterns    extract_invoice_number on the text of the synthetic invoices
+  merge       merge_email_attachments on the attachments of multi-invoice emails
+  excel       save_email_info_to_excel for --rows emails plus one export
+
+Results are saved to benchmarks/results/<time>.json together with the git
+commit and compared with the previous results file (or --compare FILE).
+
+Usage: python benchmarks/bench_suite.py --messages 300 --only e2e extraction
+"""
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR.parent / "email_downloader"))
+sys.path.insert(0, str(BENCH_DIR))
+
+RESULTS_DIR = BENCH_DIR / "results"
+BENCHMARKS = ["e2e", "extraction", "patterns", "merge", "excel"]
+
+# Figures compared between runs: (benchmark, key, unit, True if higher is better)
+HEADLINE = [
+    ("e2e", "messages_per_second", "msg/s", True),
+    ("e2e", "mb_per_second", "MB/s", True),
+    ("e2e", "peak_mb", "MB", False),
+    ("e2e", "worker_peak_mb", "MB", False),
+    ("e2e", "found_rate", "", True),
+    ("extraction", "ms_per_page", "ms", False),
+    ("extraction", "peak_mb", "MB", False),
+    ("patterns", "us_per_text", "us", False),
+    ("merge", "ms_per_email", "ms", False),
+    ("merge", "peak_mb", "MB", False),
+    ("excel", "us_per_email", "us", False),
+    ("excel", "export_seconds", "s", False),
+]
+
+
+# Function to get the peak resident memory of this process in MB
+def peak_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Function to get the largest peak RSS of the finished child processes (worker pool) in MB
+def children_peak_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+# Function to get the number of the moved message from a file in Re_Erledigt: (invoice number, index)
+def parse_moved_name(name):
+    number, _, original = name.partition("_")
+    index = re.search(r"(?<!\d)(\d{5})(?!\d)", original)
+    return number, int(index.group(1)) if index else None
+
+
+# Function to count found, missed and wrong invoice numbers, in total and per kind and number format
+def score_invoices(expected, moved):
+    score = {"found": 0, "missed": 0, "wrong": 0, "by_kind": {}, "by_format": {}}
+    for entry in expected:
+        if entry["expected"] is None:
+            outcome = "wrong" if entry["index"] in moved else None
+        elif moved.get(entry["index"]) == entry["expected"].replace("/", "-"):
+            outcome = "found"
+        else:
+            outcome = "wrong" if entry["index"] in moved else "missed"
+        if outcome is None:
+            continue
+        score[outcome] += 1
+        for group, key in (("by_kind", entry["kind"]), ("by_format", entry["format"])):
+            if key is not None:
+                counts = score[group].setdefault(key, {"found": 0, "missed": 0, "wrong": 0})
+                counts[outcome] += 1
+    return score
+
+
+# Function to run check_inbox once over a synthetic mailbox
+def bench_e2e(args, workdir):
+    from synthetic import write_mailbox
+    from fake_imap_server import serve_folder
+
+    mail_dir = workdir / "mail"
+    expected = write_mailbox(mail_dir, args.messages, args.seed, args.max_pages)
+    mailbox_mb = sum(path.stat().st_size for path in mail_dir.glob("*.eml")) / 1024 / 1024
+
+    port_queue = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve_folder, args=(mail_dir, port_queue, True, args.latency), daemon=True)
+    server.start()
+    port = port_queue.get()
+    try:
+        # The index, the cache and the state files live in data/ of the working directory
+        os.chdir(workdir)
+        (workdir / "data").mkdir()
+        import imaplib
+        from email_handler import check_inbox
+        from worker_pool import get_worker_pool
+
+        executor = get_worker_pool(args.workers)
+        re_dir = workdir / "re_bench"
+        re_dir.mkdir()
+        mail = imaplib.IMAP4("127.0.0.1", port)
+        mail.login("bench", "bench")
+        mail.select("inbox")
+
+        baseline_mb = peak_rss_mb()
+        start = time.perf_counter()
+        stats = check_inbox(mail, re_dir, workdir / "data" / "email_info.jsonl", account="bench", executor=executor)
+        seconds = time.perf_counter() - start
+        peak_mb = peak_rss_mb()
+        mail.logout()
+        executor.shutdown()
+    finally:
+        server.terminate()
+
+    moved = dict(reversed(parse_moved_name(path.name)) for path in (workdir / "Re_Erledigtbench").glob("*.pdf"))
+    score = score_invoices(expected, moved)
+    with_number = sum(entry["expected"] is not None for entry in expected)
+    return {
+        "messages": args.messages,
+        "mailbox_mb": mailbox_mb,
+        "seconds": seconds,
+        "messages_per_second": args.messages / seconds,
+        "mb_per_second": mailbox_mb / seconds,
+        "stages": {name: dict(stage, ms_per_item=stage["seconds"] * 1000 / stage["items"] if stage["items"] else 0)
+                   for name, stage in (stats or {}).items()},
+        "baseline_mb": baseline_mb,
+        "peak_mb": peak_mb,
+        "worker_peak_mb": children_peak_mb(),
+        "found_rate": score["found"] / with_number if with_number else 0,
+        "score": score,
+    }
+
+
+# Function to time extract_invoice_from_pdf per page count, without the extraction cache
+def bench_extraction(args, workdir):
+    from synthetic import InvoiceFactory, text_pdf
+    from pdf_text import extract_invoice_from_pdf
+    from email_handler import extract_invoice_number
+
+    factory = InvoiceFactory(args.seed)
+    by_pages = {}
+    total_pages = total_seconds = 0
+    for pages in range(1, args.max_pages + 1):
+        paths = []
+        for i in range(args.files):
+            # The number on the last page, so every page is read
+            name, line, number = factory.invoice_number()
+            content = factory.pages(pages)
+            content[-1].append(line)
+            path = workdir / f"invoice_{pages}_{i}.pdf"
+            path.write_bytes(text_pdf(content))
+            paths.append(path)
+        start = time.perf_counter()
+        for path in paths:
+            extract_invoice_from_pdf(str(path), extract_invoice_number, max_pages=pages)
+        seconds = time.perf_counter() - start
+        by_pages[pages] = seconds * 1000 / len(paths)
+        total_pages += pages * len(paths)
+        total_seconds += seconds
+    return {"files": args.files, "ms_per_file_by_pages": by_pages,
+            "ms_per_page": total_seconds * 1000 / total_pages, "peak_mb": peak_rss_mb()}
+
+
+# Function to time extract_invoice_number on invoice texts, per number format
+def bench_patterns(args, workdir):
+    from synthetic import InvoiceFactory
+    from email_handler import extract_invoice_number
+
+    factory = InvoiceFactory(args.seed)
+    texts = []
+    for _ in range(args.files * 10):
+        name, line, number = factory.invoice_number()
+        texts.append((name, "\n".join(sum(factory.pages(factory.page_count(args.max_pages), line), [])), number))
+
+    found = {}
+    start = time.perf_counter()
+    for name, text, number in texts:
+        counts = found.setdefault(name, [0, 0])
+        counts[0] += extract_invoice_number(text) == number
+        counts[1] += 1
+    seconds = time.perf_counter() - start
+    return {"texts": len(texts), "us_per_text": seconds * 1e6 / len(texts),
+            "found_by_format": {name: f"{hits}/{total}" for name, (hits, total) in sorted(found.items())}}
+
+
+# Function to time merge_email_attachments on groups of 2 to 4 invoices
+def bench_merge(args, workdir):
+    from synthetic import InvoiceFactory
+    from pdf_handler import merge_email_attachments
+
+    factory = InvoiceFactory(args.seed)
+    groups = []
+    for i in range(args.files):
+        folder = workdir / f"email_{i}"
+        folder.mkdir()
+        paths = []
+        for part in range(factory.random.randint(2, 4)):
+            data, _, _ = factory.invoice("text", args.max_pages)
+            paths.append(folder / f"beleg_{part}.pdf")
+            paths[-1].write_bytes(data)
+        groups.append(paths)
+
+    start = time.perf_counter()
+    merged = sum(merge_email_attachments(paths, "merged.pdf") is not None for paths in groups)
+    seconds = time.perf_counter() - start
+    return {"emails": len(groups), "merged": merged, "ms_per_email": seconds * 1000 / len(groups),
+            "peak_mb": peak_rss_mb()}
+
+
+# Function to time save_email_info_to_excel and the export of the workbook
+def bench_excel(args, workdir):
+    os.chdir(workdir)
+    import file_handler
+
+    excel_file = workdir / "email_info.xlsx"
+    start = time.perf_counter()
+    for i in range(args.rows):
+        file_handler.save_email_info_to_excel({
+            "Date": f"Mon, {1 + i % 28:02d} Jan 2024 {i % 24:02d}:{i % 60:02d}:00 +0100",
+            "Email": f"rechnung@lieferant{i % 25}.de",
+            "Subject": f"Ihre Rechnung {i:05d}",
+            "Message_ID": f"<{i}@bench.example.com>",
+            "Attachments": [f"beleg_{i:05d}.pdf"],
+            "Invoice_number": f"RE-{i:06d}",
+        }, excel_file)
+    saved = time.perf_counter() - start
+    start = time.perf_counter()
+    file_handler.flush_excel_exports()
+    exported = time.perf_counter() - start
+    return {"rows": args.rows, "us_per_email": saved * 1e6 / args.rows, "export_seconds": exported,
+            "peak_mb": peak_rss_mb()}
+
+
+# Function to run one benchmark in this process and print its result as JSON
+def run_benchmark(name, args):
+    logging.basicConfig(level=logging.WARNING)
+    with tempfile.TemporaryDirectory() as tmp:
+        result = globals()[f"bench_{name}"](args, Path(tmp))
+        # Leave the folder before it is deleted
+        os.chdir(BENCH_DIR)
+    print(json.dumps(result))
+
+
+# Function to get the commit of the working tree, with a mark if it has local changes
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCH_DIR, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=BENCH_DIR,
+                               capture_output=True, text=True).stdout.strip()
+        return commit + ("-dirty" if dirty else "")
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Function to find the newest results file before this run
+def previous_results(exclude=None):
+    files = sorted(path for path in RESULTS_DIR.glob("*.json") if path != exclude)
+    return files[-1] if files else None
+
+
+# Function to print the headline figures, with the change against an earlier run
+def print_summary(results, previous=None):
+    print(f"\n{'benchmark':<12} {'figure':<22} {'value':>12} {'before':>12} {'change':>9}")
+    for name, key, unit, higher_is_better in HEADLINE:
+        value = results["benchmarks"].get(name, {}).get(key)
+        if value is None:
+            continue
+        before = (previous or {}).get("benchmarks", {}).get(name, {}).get(key)
+        change = ""
+        if before:
+            delta = (value - before) / before * 100
+            better = delta > 0 if higher_is_better else delta < 0
+            change = f"{delta:+.1f}%" + (" +" if better and abs(delta) >= 5 else " -" if abs(delta) >= 5 else "")
+        before = f"{before:.2f}" if before is not None else ""
+        print(f"{name:<12} {key:<22} {value:>9.2f} {unit:<2} {before:>12} {change:>9}")
+
+
+# Function to print the per-stage latency and the invoice number score of the e2e run
+def print_e2e(result):
+    print(f"\ncheck_inbox: {result['messages']} messages, {result['mailbox_mb']:.1f} MB in {result['seconds']:.2f} s")
+    for name, stage in result["stages"].items():
+        print(f"  stage {name:<8} {stage['items']:>6} items {stage['seconds']:8.2f} s busy "
+              f"{stage['ms_per_item']:8.2f} ms per item")
+    score = result["score"]
+    print(f"  invoice numbers: {score['found']} found, {score['missed']} missed, {score['wrong']} wrong")
+    for group in ("by_kind", "by_format"):
+        for key, counts in sorted(score[group].items()):
+            print(f"    {key:<16} {counts['found']:>5} found {counts['missed']:>5} missed {counts['wrong']:>5} wrong")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--only", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--messages", type=int, default=300, help="messages in the e2e mailbox")
+    parser.add_argument("--files", type=int, default=20, help="files per size in the other benchmarks")
+    parser.add_argument("--rows", type=int, default=5000, help="emails saved in the excel benchmark")
+    parser.add_argument("--max-pages", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes of check_inbox")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds the fake server waits per command")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--compare", type=Path, help="results file to compare with (default: the previous run)")
+    parser.add_argument("--no-save", action="store_true", help="do not write a results file")
+    parser.add_argument("--run", choices=BENCHMARKS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        run_benchmark(args.run, args)
+        return
+
+    # The benchmark processes get the options that shape the data
+    options = [f"--messages={args.messages}", f"--files={args.files}", f"--rows={args.rows}",
+               f"--max-pages={args.max_pages}", f"--latency={args.latency}", f"--seed={args.seed}"]
+    if args.workers:
+        options.append(f"--workers={args.workers}")
+
+    results = {
+        "time": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_revision(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "options": {"messages": args.messages, "files": args.files, "rows": args.rows, "max_pages": args.max_pages,
+                    "workers": args.workers, "latency": args.latency, "seed": args.seed},
+        "benchmarks": {},
+    }
+    for name in args.only:
+        print(f"Running {name} ...", flush=True)
+        output = subprocess.run([sys.executable, __file__, "--run", name] + options, capture_output=True, text=True)
+        if output.returncode != 0:
+            print(f"{name} failed:\n{output.stderr[-2000:]}")
+            continue
+        results["benchmarks"][name] = json.loads(output.stdout.strip().splitlines()[-1])
+
+    if "e2e" in results["benchmarks"]:
+        print_e2e(results["benchmarks"]["e2e"])
+
+    previous_file = args.compare or previous_results()
+    previous = json.loads(previous_file.read_text()) if previous_file else None
+    if previous:
+        print(f"\nCompared with {previous_file.name} (commit {previous.get('commit')})")
+        if previous.get("options") != results["options"]:
+            print("  The runs used different options, the figures are not directly comparable.")
+    print_summary(results, previous)
+
+    if not args.no_save:
+        RESULTS_DIR.mkdir(exist_ok=True)
+        results_file = RESULTS_DIR / f"{datetime.now().strftime('%Y%m%d-%H%M%S')}.json"
+        results_file.write_text(json.dumps(results, indent=2))
+        print(f"\nSaved results to {results_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,387 @@
+"""Small in-memory IMAP server used by the benchmarks.
+
+It understands the subset of IMAP4rev1 the downloader uses: LOGIN, CAPABILITY,
+SELECT, NOOP, IDLE, LOGOUT and UID SEARCH / FETCH / STORE, including
+BODYSTRUCTURE, ENVELOPE and partial BODY.PEEK[n]<offset.length> fetches.
+There is no TLS, connect with imaplib.IMAP4 instead of IMAP4_SSL.
+"""
+import argparse
+import datetime
+import email
+import email.utils
+import re
+import socketserver
+import threading
+import time
+import urllib.parse
+from pathlib import Path
+
+
+# Function to quote a value as an IMAP string (literal if it is long or contains special characters)
+def imap_string(value):
+    if value is None:
+        return b"NIL"
+    if isinstance(value, str):
+        value = value.encode("utf-8")
+    if re.search(rb'["\\\r\n]', value) or len(value) > 200:
+        return b"{%d}\r\n" % len(value) + value
+    return b'"' + value + b'"'
+
+
+# Function to normalise line endings to CRLF like a real server stores them
+def to_crlf(data):
+    return data.replace(b"\r\n", b"\n").replace(b"\n", b"\r\n")
+
+
+# Function to encode one body parameter, RFC 2231 values keep their extended form
+def body_param(key, value):
+    if isinstance(value, tuple):
+        charset, language, text = value
+        encoded = f"{charset or ''}'{language or ''}'" + urllib.parse.quote(text, encoding="latin-1")
+        return [imap_string(key + "*"), imap_string(encoded)]
+    return [imap_string(key), imap_string(value)]
+
+
+# Function to build a body parameter list for a header (Content-Type or Content-Disposition)
+def body_params(part, header):
+    params = part.get_params(header=header) or []
+    items = []
+    for key, value in params[1:]:
+        items += body_param(key, value)
+    return b"(" + b" ".join(items) + b")" if items else b"NIL"
+
+
+# Function to build the disposition field of a BODYSTRUCTURE
+def body_disposition(part):
+    disposition = part.get("Content-Disposition")
+    if not disposition:
+        return b"NIL"
+    kind = disposition.split(";")[0].strip()
+    return b"(" + imap_string(kind) + b" " + body_params(part, "content-disposition") + b")"
+
+
+# Function to get the encoded body of a leaf part as it is stored on the server
+def leaf_body(part):
+    payload = part.get_payload()
+    if isinstance(payload, str):
+        payload = payload.encode("utf-8", "surrogateescape")
+    return to_crlf(payload)
+
+
+# Function to build the BODYSTRUCTURE of a message or part
+def bodystructure(part):
+    if part.is_multipart():
+        sub_parts = b"".join(bodystructure(sub_part) for sub_part in part.get_payload())
+        return (b"(" + sub_parts + b" " + imap_string(part.get_content_subtype()) + b" "
+                + body_params(part, "content-type") + b" NIL NIL NIL)")
+
+    body = leaf_body(part)
+    maintype = part.get_content_maintype()
+    encoding = part.get("Content-Transfer-Encoding", "7bit").strip()
+    fields = [imap_string(maintype), imap_string(part.get_content_subtype()), body_params(part, "content-type"),
+              imap_string(part.get("Content-ID")), b"NIL", imap_string(encoding), str(len(body)).encode()]
+    if maintype == "text":
+        fields.append(str(body.count(b"\r\n")).encode())
+    fields += [b"NIL", body_disposition(part), b"NIL", b"NIL"]
+    return b"(" + b" ".join(fields) + b")"
+
+
+# Function to build an address list of an ENVELOPE
+def envelope_addresses(value):
+    if not value:
+        return b"NIL"
+    items = []
+    for name, address in email.utils.getaddresses([value]):
+        mailbox, _, host = address.partition("@")
+        items.append(b"(" + imap_string(name or None) + b" NIL " + imap_string(mailbox) + b" " + imap_string(host) + b")")
+    return b"(" + b"".join(items) + b")"
+
+
+# Function to build the ENVELOPE of a message
+def envelope(msg):
+    fields = [
+        imap_string(msg.get("Date")), imap_string(msg.get("Subject")),
+        envelope_addresses(msg.get("From")), envelope_addresses(msg.get("Sender") or msg.get("From")),
+        envelope_addresses(msg.get("Reply-To") or msg.get("From")), envelope_addresses(msg.get("To")),
+        envelope_addresses(msg.get("Cc")), envelope_addresses(msg.get("Bcc")),
+        imap_string(msg.get("In-Reply-To")), imap_string(msg.get("Message-ID"))
+    ]
+    return b"(" + b" ".join(fields) + b")"
+
+
+# Stored message with its UID and flags
+class FakeMessage:
+    def __init__(self, uid, raw, flags=()):
+        self.uid = uid
+        self.raw = to_crlf(raw)
+        self.flags = set(flags)
+        self.msg = email.message_from_bytes(self.raw)
+        self._sections = {}
+
+    # Function to get the content of a body section ("", "HEADER", "2", "1.2", ...)
+    def section(self, spec):
+        if spec not in self._sections:
+            self._sections[spec] = self._build_section(spec)
+        return self._sections[spec]
+
+    def _build_section(self, spec):
+        if spec == "":
+            return self.raw
+        if spec == "HEADER":
+            return self.raw.split(b"\r\n\r\n", 1)[0] + b"\r\n\r\n"
+        part = self.msg
+        for number in spec.split("."):
+            number = int(number)
+            if part.is_multipart():
+                part = part.get_payload()[number - 1]
+            elif number != 1:
+                return b""
+        return leaf_body(part)
+
+
+# Mailbox shared by all connections, new messages wake up clients waiting in IDLE
+class Mailbox:
+    def __init__(self, uidvalidity=1):
+        self.uidvalidity = uidvalidity
+        self.messages = []
+        self.next_uid = 1
+        self.changed = threading.Condition()
+
+    def add(self, raw, flags=()):
+        with self.changed:
+            message = FakeMessage(self.next_uid, raw, flags)
+            self.next_uid += 1
+            self.messages.append(message)
+            self.changed.notify_all()
+            return message.uid
+
+    def snapshot(self):
+        with self.changed:
+            return list(self.messages)
+
+
+# Function to expand an IMAP sequence set ("1:4,7,9:*") into a set of UIDs
+def parse_sequence_set(spec, max_uid):
+    uids = set()
+    for chunk in spec.split(","):
+        if ":" in chunk:
+            first, last = (max_uid if value == "*" else int(value) for value in chunk.split(":"))
+            uids.update(range(min(first, last), max(first, last) + 1))
+        else:
+            uids.add(max_uid if chunk == "*" else int(chunk))
+    return uids
+
+
+FETCH_ITEM = re.compile(r"BODY(?:\.PEEK)?\[[^\]]*\](?:<\d+\.\d+>)?|RFC822\.SIZE|RFC822|BODYSTRUCTURE|ENVELOPE|UID|FLAGS")
+SECTION_ITEM = re.compile(r"BODY(\.PEEK)?\[([^\]]*)\](?:<(\d+)\.(\d+)>)?")
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    def send(self, data):
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def handle(self):
+        self.server.count("connections")
+        self.send(b"* OK fake IMAP server ready\r\n")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            self.server.count("commands")
+            if self.server.latency:
+                # Round trip time of a real server
+                time.sleep(self.server.latency)
+            tag, _, rest = line.rstrip(b"\r\n").decode().partition(" ")
+            command, _, args = rest.partition(" ")
+            command = command.upper()
+
+            if command == "CAPABILITY":
+                capabilities = "IMAP4rev1 IDLE" if self.server.idle else "IMAP4rev1"
+                self.send(f"* CAPABILITY {capabilities}\r\n{tag} OK CAPABILITY completed\r\n".encode())
+            elif command == "LOGIN":
+                self.send(f"{tag} OK LOGIN completed\r\n".encode())
+            elif command in ("SELECT", "EXAMINE"):
+                self.select(tag)
+            elif command == "NOOP":
+                self.send(f"{tag} OK NOOP completed\r\n".encode())
+            elif command == "IDLE" and self.server.idle:
+                if not self.idle(tag):
+                    return
+            elif command == "LOGOUT":
+                self.send(f"* BYE logging out\r\n{tag} OK LOGOUT completed\r\n".encode())
+                return
+            elif command == "UID":
+                sub_command, _, args = args.partition(" ")
+                handler = getattr(self, "uid_" + sub_command.lower(), None)
+                if handler:
+                    handler(tag, args)
+                else:
+                    self.send(f"{tag} BAD unknown UID command\r\n".encode())
+            else:
+                self.send(f"{tag} BAD unknown command\r\n".encode())
+
+    def select(self, tag):
+        mailbox = self.server.mailbox
+        count = len(mailbox.snapshot())
+        self.send(f"* {count} EXISTS\r\n* 0 RECENT\r\n"
+                  f"* OK [UIDVALIDITY {mailbox.uidvalidity}] UIDs valid\r\n"
+                  f"* OK [UIDNEXT {mailbox.next_uid}] predicted next UID\r\n"
+                  f"{tag} OK [READ-WRITE] SELECT completed\r\n".encode())
+
+    def idle(self, tag):
+        mailbox = self.server.mailbox
+        known = len(mailbox.snapshot())
+        self.send(b"+ idling\r\n")
+        self.request.settimeout(0.05)
+        received = b""
+        try:
+            while b"DONE" not in received:
+                with mailbox.changed:
+                    mailbox.changed.wait(0.05)
+                    if len(mailbox.messages) != known:
+                        known = len(mailbox.messages)
+                        self.send(f"* {known} EXISTS\r\n".encode())
+                try:
+                    chunk = self.request.recv(64)
+                except OSError:
+                    continue
+                if not chunk:
+                    return False
+                received += chunk
+        finally:
+            self.request.settimeout(None)
+        self.send(f"{tag} OK IDLE terminated\r\n".encode())
+        return True
+
+    def uid_search(self, tag, args):
+        messages = self.server.mailbox.snapshot()
+        max_uid = messages[-1].uid if messages else 0
+        tokens = args.upper().replace("(", " ").replace(")", " ").split()
+        if tokens[:1] == ["CHARSET"]:
+            tokens = tokens[2:]
+
+        result = []
+        for message in messages:
+            matches = True
+            i = 0
+            while i < len(tokens):
+                token = tokens[i]
+                if token == "UNSEEN":
+                    matches &= "\\Seen" not in message.flags
+                elif token == "UID":
+                    i += 1
+                    matches &= message.uid in parse_sequence_set(tokens[i], max_uid)
+                elif token in ("SINCE", "BEFORE"):
+                    i += 1
+                    day = datetime.datetime.strptime(tokens[i].title(), "%d-%b-%Y").date()
+                    sent = email.utils.parsedate_to_datetime(message.msg.get("Date")).date()
+                    matches &= sent >= day if token == "SINCE" else sent < day
+                i += 1
+            if matches:
+                result.append(str(message.uid))
+        self.send(f"* SEARCH {' '.join(result)}".rstrip().encode() + f"\r\n{tag} OK SEARCH completed\r\n".encode())
+
+    def uid_store(self, tag, args):
+        messages = self.server.mailbox.snapshot()
+        spec, operation, flags = args.split(" ", 2)
+        uids = parse_sequence_set(spec, messages[-1].uid if messages else 0)
+        for message in messages:
+            if message.uid in uids:
+                for flag in flags.strip("()").split():
+                    if operation.startswith("+"):
+                        message.flags.add(flag)
+                    else:
+                        message.flags.discard(flag)
+        self.send(f"{tag} OK STORE completed\r\n".encode())
+
+    def uid_fetch(self, tag, args):
+        messages = self.server.mailbox.snapshot()
+        spec, _, items = args.partition(" ")
+        uids = parse_sequence_set(spec, messages[-1].uid if messages else 0)
+        names = FETCH_ITEM.findall(items.upper())
+
+        for number, message in enumerate(messages, 1):
+            if message.uid not in uids:
+                continue
+            out = [b"UID %d" % message.uid]
+            for name in names:
+                if name == "UID":
+                    continue
+                elif name == "FLAGS":
+                    out.append(b"FLAGS (" + " ".join(sorted(message.flags)).encode() + b")")
+                elif name == "RFC822.SIZE":
+                    out.append(b"RFC822.SIZE %d" % len(message.raw))
+                elif name == "RFC822":
+                    message.flags.add("\\Seen")
+                    self.server.count("bytes", len(message.raw))
+                    out.append(b"RFC822 {%d}\r\n" % len(message.raw) + message.raw)
+                elif name == "BODYSTRUCTURE":
+                    out.append(b"BODYSTRUCTURE " + bodystructure(message.msg))
+                elif name == "ENVELOPE":
+                    out.append(b"ENVELOPE " + envelope(message.msg))
+                else:
+                    match = SECTION_ITEM.match(name)
+                    data = message.section(match.group(2))
+                    label = b"BODY[" + match.group(2).encode() + b"]"
+                    if match.group(3):
+                        offset, length = int(match.group(3)), int(match.group(4))
+                        data = data[offset:offset + length]
+                        label += b"<%d>" % offset
+                    if not match.group(1):
+                        message.flags.add("\\Seen")
+                    self.server.count("bytes", len(data))
+                    out.append(label + b" {%d}\r\n" % len(data) + data)
+            self.send(b"* %d FETCH (" % number + b" ".join(out) + b")\r\n")
+        self.send(f"{tag} OK FETCH completed\r\n".encode())
+
+
+class FakeImapServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mailbox=None, idle=True, port=0, latency=0.0):
+        super().__init__(("127.0.0.1", port), FakeImapHandler)
+        self.mailbox = mailbox or Mailbox()
+        self.idle = idle
+        self.latency = latency
+        self.stats = {"connections": 0, "commands": 0, "bytes": 0}
+        self._stats_lock = threading.Lock()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def count(self, name, amount=1):
+        with self._stats_lock:
+            self.stats[name] += amount
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+# Function to run a server in its own process, serving the .eml files of a folder
+def serve_folder(folder, port_queue, idle=True, latency=0.0):
+    mailbox = Mailbox()
+    for path in sorted(Path(folder).glob("*.eml")):
+        mailbox.add(path.read_bytes())
+    server = FakeImapServer(mailbox, idle=idle, latency=latency)
+    port_queue.put(server.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the .eml files of a folder over IMAP.")
+    parser.add_argument("folder")
+    parser.add_argument("--port", type=int, default=1143)
+    parser.add_argument("--no-idle", action="store_true")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds to wait before answering a command")
+    args = parser.parse_args()
+
+    mailbox = Mailbox()
+    for path in sorted(Path(args.folder).glob("*.eml")):
+        mailbox.add(path.read_bytes())
+    server = FakeImapServer(mailbox, idle=not args.no_idle, port=args.port, latency=args.latency)
+    print(f"Serving {len(mailbox.messages)} messages on 127.0.0.1:{server.port}")
+    server.serve_forever()
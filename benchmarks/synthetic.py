@@ -0,0 +1,232 @@
+"""Synthetic invoices and mailboxes for the benchmarks.
+
+Text invoices are written as plain PDFs with a text layer, scanned invoices
+as PDFs that only hold a rendered page image (Pillow), so they have no text
+layer and need OCR. Every invoice uses one of the German invoice number
+formats the pattern engine knows and remembers the number it should give.
+
+Usage: python benchmarks/synthetic.py OUTPUT_FOLDER --messages 200
+"""
+import argparse
+import email.utils
+import io
+import random
+from datetime import datetime, timedelta, timezone
+from email.message import EmailMessage
+from pathlib import Path
+
+# Invoice number lines: (format name, line template, number template)
+INVOICE_FORMATS = [
+    ("rechnungsnr", "Rechnungsnr.: {number}", "RE-{n:06d}"),
+    ("rechnung_jahr", "Rechnung {number}", "{year}/{n4:04d}"),
+    ("rechnungsnummer", "Rechnungsnummer: {number}", "{n:08d}"),
+    ("rechnung_nr", "Rechnung Nr. {number}", "R{n:07d}"),
+    ("rechnungs_nr", "Rechnungs-Nr. {number}", "{year}-{n:05d}"),
+    ("nummer_davor", "{number} Rechnungsnummer", "{n:010d}"),
+]
+
+# Lines around the invoice number, with the long digit runs (IBAN, article numbers) real invoices have
+FILLER_LINES = [
+    "Lieferant GmbH - Industriestrasse 12 - 70565 Stuttgart",
+    "Kundennummer: {customer}",
+    "Lieferdatum: {date}",
+    "Pos. Artikel {article} Menge {quantity} Einzelpreis {price},00 EUR",
+    "Zwischensumme netto {price},00 EUR, zzgl. 19 % USt.",
+    "Zahlbar innerhalb von 14 Tagen ohne Abzug.",
+    "IBAN DE{iban} BIC GENODEF1S02",
+    "Vielen Dank fuer Ihren Auftrag.",
+]
+
+# Kinds of messages in a mailbox and how often they occur
+MESSAGE_KINDS = {
+    "text": 6,   # one invoice with a text layer
+    "multi": 2,  # several text invoices, merged into one PDF; the number of the first one wins
+    "scan": 1,   # one scanned invoice, found only with OCR
+    "image": 1,  # one scanned invoice sent as a JPEG
+    "none": 1,   # a PDF without an invoice number
+}
+
+
+# Function to escape a line for a PDF string
+def pdf_string(text):
+    return b"(" + text.encode("latin-1", "replace").replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)") + b")"
+
+
+# Function to build a PDF with a text layer, one list of lines per page
+def text_pdf(pages):
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>",
+               3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"}
+    kids = []
+    number = 4
+    for lines in pages:
+        content = b"BT /F1 11 Tf 50 790 Td 14 TL " + b" ".join(pdf_string(line) + b" '" for line in lines) + b" ET"
+        objects[number] = b"<< /Length %d >>\nstream\n" % len(content) + content + b"\nendstream"
+        objects[number + 1] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] /Contents %d 0 R "
+                               b"/Resources << /Font << /F1 3 0 R >> >> >>" % number)
+        kids.append(number + 1)
+        number += 2
+    objects[2] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(b"%d 0 R" % kid for kid in kids), len(kids))
+
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number in sorted(objects):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(offsets) + 1, xref)
+    return bytes(out)
+
+
+# Function to render the pages as grayscale images like a scanner would
+def render_pages(pages, dpi=150):
+    from PIL import Image, ImageDraw, ImageFont
+    try:
+        font = ImageFont.load_default(size=dpi // 6)
+    except TypeError:
+        font = ImageFont.load_default()
+    width, height = int(8.27 * dpi), int(11.69 * dpi)
+    images = []
+    for lines in pages:
+        image = Image.new("L", (width, height), 255)
+        draw = ImageDraw.Draw(image)
+        for row, line in enumerate(lines):
+            draw.text((dpi // 2, dpi // 2 + row * dpi // 4), line, fill=0, font=font)
+        images.append(image)
+    return images
+
+
+# Function to build a scanned PDF: page images only, no text layer
+def scanned_pdf(pages, dpi=150):
+    images = render_pages(pages, dpi)
+    buffer = io.BytesIO()
+    images[0].save(buffer, "PDF", resolution=dpi, save_all=True, append_images=images[1:])
+    return buffer.getvalue()
+
+
+# Function to build a photographed invoice (first page only) as JPEG
+def scanned_jpeg(pages, dpi=150):
+    buffer = io.BytesIO()
+    render_pages(pages[:1], dpi)[0].save(buffer, "JPEG", quality=80)
+    return buffer.getvalue()
+
+
+# Generator of invoices with their expected numbers, the same seed gives the same corpus
+class InvoiceFactory:
+    def __init__(self, seed=1):
+        self.random = random.Random(seed)
+        self.count = 0
+
+    # Function to pick an invoice number, returns (format name, line, expected number)
+    def invoice_number(self):
+        self.count += 1
+        name, line, number = self.random.choice(INVOICE_FORMATS)
+        number = number.format(n=self.random.randint(1, 99999) * 1000 + self.count % 1000,
+                               n4=self.count % 10000, year=self.random.randint(2019, 2025))
+        return name, line.format(number=number), number
+
+    # Function to build the text of an invoice, the number is on the first page
+    def pages(self, page_count, number_line=None):
+        pages = []
+        for page in range(page_count):
+            lines = []
+            for _ in range(self.random.randint(12, 30)):
+                lines.append(self.random.choice(FILLER_LINES).format(
+                    customer=self.random.randint(10000, 99999),
+                    date=f"{self.random.randint(1, 28):02d}.{self.random.randint(1, 12):02d}.2024",
+                    article=self.random.randint(10 ** 10, 10 ** 11),
+                    quantity=self.random.randint(1, 20),
+                    price=self.random.randint(5, 5000),
+                    iban=self.random.randint(10 ** 19, 10 ** 20)))
+            if page == 0 and number_line:
+                lines.insert(self.random.randint(1, 4), number_line)
+            lines.append(f"Seite {page + 1} von {page_count}")
+            pages.append(lines)
+        return pages
+
+    def page_count(self, max_pages):
+        # Most invoices have one or two pages, a few are long
+        return min(max_pages, 1 + int(self.random.expovariate(0.8)))
+
+    # Function to build one invoice, returns (PDF or JPEG bytes, format name, expected number or None)
+    def invoice(self, kind="text", max_pages=8):
+        if kind == "none":
+            return text_pdf(self.pages(self.page_count(max_pages))), None, None
+        name, line, number = self.invoice_number()
+        pages = self.pages(self.page_count(max_pages) if kind != "image" else 1, line)
+        if kind == "scan":
+            return scanned_pdf(pages), name, number
+        if kind == "image":
+            return scanned_jpeg(pages), name, number
+        return text_pdf(pages), name, number
+
+
+# Function to build a message with the given attachments [(filename, data)]
+def build_message(subject, sender, attachments, date):
+    msg = EmailMessage()
+    msg["Subject"] = subject
+    msg["From"] = sender
+    msg["To"] = "rechnungen@example.com"
+    msg["Date"] = email.utils.format_datetime(date)
+    msg["Message-ID"] = email.utils.make_msgid(domain="bench.example.com")
+    msg.set_content("Sehr geehrte Damen und Herren,\n\nanbei erhalten Sie unsere Rechnung.\n")
+    for filename, data in attachments:
+        maintype, subtype = ("image", "jpeg") if filename.endswith(".jpg") else ("application", "pdf")
+        msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename)
+    return msg.as_bytes()
+
+
+# Function to pick the kind of every message, in the proportions of MESSAGE_KINDS
+def message_kinds(count, rng, kinds=MESSAGE_KINDS):
+    names = list(kinds)
+    return rng.choices(names, weights=[kinds[name] for name in names], k=count)
+
+
+# Function to write a mailbox of .eml files for the fake IMAP server
+# Returns one entry per message: {"index", "kind", "format", "expected"}
+def write_mailbox(folder, count, seed=1, max_pages=8, kinds=MESSAGE_KINDS):
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    factory = InvoiceFactory(seed)
+    start = datetime(2024, 1, 1, 8, tzinfo=timezone.utc)
+    expected = []
+    for index, kind in enumerate(message_kinds(count, factory.random, kinds)):
+        # The index in every file name lets the benchmark find the message of a moved file
+        if kind == "multi":
+            attachments, first = [], None
+            for part in range(factory.random.randint(2, 4)):
+                data, name, number = factory.invoice("text", max_pages)
+                attachments.append((f"beleg_{index:05d}_{part}.pdf", data))
+                first = first or (name, number)
+            name, number = first
+        else:
+            data, name, number = factory.invoice(kind, max_pages)
+            suffix = ".jpg" if kind == "image" else ".pdf"
+            attachments = [(f"beleg_{index:05d}{suffix}", data)]
+        sender = f"Buchhaltung <rechnung@lieferant{index % 25}.de>"
+        raw = build_message(f"Ihre Rechnung {index:05d}", sender, attachments, start + timedelta(hours=index))
+        (folder / f"{index:05d}.eml").write_bytes(raw)
+        expected.append({"index": index, "kind": kind, "format": name, "expected": number})
+    return expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("folder")
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--max-pages", type=int, default=8)
+    args = parser.parse_args()
+
+    expected = write_mailbox(args.folder, args.messages, args.seed, args.max_pages)
+    kinds = {}
+    for entry in expected:
+        kinds[entry["kind"]] = kinds.get(entry["kind"], 0) + 1
+    print(f"Wrote {len(expected)} messages to {args.folder}: "
+          + ", ".join(f"{count} {kind}" for kind, count in sorted(kinds.items())))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,291 @@
+import asyncio
+import imaplib
+import re
+import ssl
+import threading
+from config import IMAP_TIMEOUT
+
+# Response lines as imaplib matches them
+UNTAGGED_STATUS = re.compile(rb'^\* (?P<data>\d+) (?P<type>[A-Z-]+)(?: (?P<data2>.*))?$')
+UNTAGGED_RESPONSE = re.compile(rb'^\* (?P<type>[A-Z-]+)(?: (?P<data>.*))?$')
+RESPONSE_CODE = re.compile(rb'\[(?P<type>[A-Z-]+)(?: (?P<data>[^\]]*))?\]')
+LITERAL_AT_END = re.compile(rb'\{(?P<size>\d+)\}$')
+NEW_MAIL_RESPONSE = re.compile(rb'^\* \d+ (EXISTS|RECENT)')
+
+# Untagged response that holds the result of a UID command
+UID_RESULT_RESPONSE = {'FETCH': 'FETCH', 'STORE': 'FETCH', 'SEARCH': 'SEARCH', 'COPY': 'COPY'}
+
+
+# Function to quote a string argument (password, mailbox) like imaplib does
+def quote(value):
+    return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+# IMAP client on asyncio streams, one coroutine per command
+# Responses come back in the format of imaplib, so the parsers of imap_fetch work on both
+# Every read has its own timeout; a command that times out or is cancelled in the middle of a response
+# closes the connection (IMAP4.abort), the rest of the response would be taken for the next one
+class AsyncImapClient:
+    def __init__(self, host, port=993, use_ssl=True, timeout=IMAP_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.loop = None
+        self.untagged_responses = {}
+        self._tag_number = 0
+        self._lock = None
+
+    async def connect(self):
+        self.loop = asyncio.get_running_loop()
+        self._lock = asyncio.Lock()
+        context = ssl.create_default_context() if self.use_ssl else None
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port, ssl=context), self.timeout)
+        greeting = await self._read_line()
+        if not greeting.startswith((b'* OK', b'* PREAUTH')):
+            raise imaplib.IMAP4.error(f"Unexpected greeting: {greeting!r}")
+        return self
+
+    # Function to wait for one read of the stream, a server that stops answering loses the connection
+    async def _read(self, read, timeout=None):
+        if self.reader is None:
+            raise imaplib.IMAP4.abort("connection closed")
+        try:
+            return await asyncio.wait_for(read, timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self._drop()
+            raise imaplib.IMAP4.abort(f"no response from {self.host} within {timeout or self.timeout} s")
+
+    async def _read_line(self):
+        line = await self._read(self.reader.readline())
+        if not line:
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        return line[:-2] if line.endswith(b'\r\n') else line.rstrip(b'\n')
+
+    def _append_untagged(self, typ, data):
+        self.untagged_responses.setdefault(typ, []).append(data)
+
+    # Function to read one untagged response, literals become (header, literal) tuples like in imaplib
+    async def _read_untagged(self, line):
+        match = UNTAGGED_STATUS.match(line)
+        if match:
+            typ, data = match.group('type'), match.group('data')
+            if match.group('data2'):
+                data = data + b' ' + match.group('data2')
+        else:
+            match = UNTAGGED_RESPONSE.match(line)
+            if not match:
+                raise imaplib.IMAP4.abort(f"Unexpected response: {line!r}")
+            typ, data = match.group('type'), match.group('data') or b''
+        typ = typ.decode()
+        if typ == 'BYE':
+            raise imaplib.IMAP4.abort(data.decode('utf-8', 'replace'))
+
+        while True:
+            literal = LITERAL_AT_END.search(data)
+            if not literal:
+                break
+            payload = await self._read(self.reader.readexactly(int(literal.group('size'))))
+            self._append_untagged(typ, (data, payload))
+            data = await self._read_line()
+        self._append_untagged(typ, data)
+
+        if typ in ('OK', 'NO', 'BAD'):
+            code = RESPONSE_CODE.search(data)
+            if code:
+                self._append_untagged(code.group('type').decode(), code.group('data'))
+
+    def _new_tag(self):
+        self._tag_number += 1
+        return f"A{self._tag_number:04d}".encode()
+
+    async def _send(self, data):
+        if self.writer is None:
+            raise imaplib.IMAP4.abort("connection closed")
+        self.writer.write(data)
+        await self._read(self.writer.drain())
+
+    async def _run_command(self, name, args):
+        tag = self._new_tag()
+        line = b' '.join([tag, name.encode()] + [arg if isinstance(arg, bytes) else str(arg).encode()
+                                                   for arg in args if arg is not None])
+        await self._send(line + b'\r\n')
+        while True:
+            line = await self._read_line()
+            if line.startswith(tag + b' '):
+                typ, _, text = line[len(tag) + 1:].partition(b' ')
+                typ = typ.decode()
+                code = RESPONSE_CODE.match(text)
+                if code:
+                    self._append_untagged(code.group('type').decode(), code.group('data'))
+                if typ == 'BAD':
+                    raise imaplib.IMAP4.error(f"{name} command error: {text.decode('utf-8', 'replace')}")
+                return typ, text
+            if line.startswith(b'* '):
+                await self._read_untagged(line)
+
+    # Function to run a command, returns (typ, data) like imaplib: data is the untagged response
+    # named result ([None] if there was none), or the text of the completion when result is None
+    async def command(self, name, *args, result=None):
+        async with self._lock:
+            try:
+                typ, text = await self._run_command(name, args)
+            except (asyncio.CancelledError, imaplib.IMAP4.abort, OSError):
+                self._drop()
+                raise
+        if result is None:
+            return typ, [text]
+        return typ, self.untagged_responses.pop(result, [None])
+
+    async def login(self, user, password):
+        typ, data = await self.command('LOGIN', quote(user), quote(password))
+        if typ != 'OK':
+            raise imaplib.IMAP4.error(data[-1])
+        return typ, data
+
+    # Function to open a mailbox, read-only (EXAMINE) leaves the \\Seen flags alone
+    async def select(self, mailbox='INBOX', readonly=False):
+        self.untagged_responses = {}
+        return await self.command('EXAMINE' if readonly else 'SELECT', mailbox, result='EXISTS')
+
+    async def uid(self, command, *args):
+        return await self.command('UID', command.upper(), *args, result=UID_RESULT_RESPONSE.get(command.upper()))
+
+    async def noop(self):
+        return await self.command('NOOP')
+
+    async def capability(self):
+        return await self.command('CAPABILITY', result='CAPABILITY')
+
+    # Function to wait in IDLE until new mail arrives or the timeout expires
+    async def idle(self, timeout):
+        async with self._lock:
+            try:
+                return await self._idle(timeout)
+            except (asyncio.CancelledError, imaplib.IMAP4.abort, OSError):
+                self._drop()
+                raise
+
+    async def _idle(self, timeout):
+        tag = self._new_tag()
+        await self._send(tag + b' IDLE\r\n')
+        response = await self._read_line()
+        if not response.startswith(b'+'):
+            raise imaplib.IMAP4.error(f"IDLE rejected: {response!r}")
+
+        new_mail = False
+        deadline = self.loop.time() + timeout
+        while True:
+            remaining = deadline - self.loop.time()
+            if remaining <= 0:
+                break
+            try:
+                # Silence is normal here, so not the read timeout of _read_line
+                # A cancelled readline leaves a partial line in the buffer for the next read
+                line = await asyncio.wait_for(self.reader.readline(), remaining)
+            except asyncio.TimeoutError:
+                break
+            if not line:
+                raise imaplib.IMAP4.abort("socket error: EOF")
+            if line.startswith(b'* BYE'):
+                raise imaplib.IMAP4.abort("Connection closed during IDLE")
+            if NEW_MAIL_RESPONSE.match(line):
+                new_mail = True
+                break
+
+        # Leave IDLE and read everything up to the tagged completion
+        await self._send(b'DONE\r\n')
+        while not (await self._read_line()).startswith(tag):
+            pass
+        return new_mail
+
+    async def logout(self):
+        try:
+            async with self._lock:
+                await self._run_command('LOGOUT', ())
+        except (imaplib.IMAP4.abort, OSError):
+            pass
+        finally:
+            await self.close()
+        return 'BYE', [b'']
+
+    async def close(self):
+        if self.writer is None:
+            return
+        writer = self.writer
+        self._drop()
+        try:
+            await writer.wait_closed()
+        except (OSError, ssl.SSLError):
+            pass
+
+    # Function to give up the connection at once, after it got out of step with the server
+    def _drop(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+# Function to get the event loop shared by the sync clients, running in its own thread
+def get_shared_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="imap-loop", daemon=True).start()
+        return _loop
+
+
+# Blocking imaplib-like wrapper around AsyncImapClient, for check_inbox and the other sync code
+# The commands run on the loop of the client, which must not be the calling thread
+class SyncImapClient:
+    def __init__(self, client):
+        self.client = client
+
+    # Function to connect and log in on the shared loop
+    @classmethod
+    def connect(cls, host, port=993, use_ssl=True, timeout=IMAP_TIMEOUT):
+        client = AsyncImapClient(host, port, use_ssl, timeout)
+        asyncio.run_coroutine_threadsafe(client.connect(), get_shared_loop()).result()
+        return cls(client)
+
+    def _run(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.client.loop).result()
+
+    @property
+    def sock(self):
+        return None
+
+    def login(self, user, password):
+        return self._run(self.client.login(user, password))
+
+    def select(self, mailbox='INBOX', readonly=False):
+        return self._run(self.client.select(mailbox, readonly))
+
+    def uid(self, command, *args):
+        return self._run(self.client.uid(command, *args))
+
+    def response(self, name):
+        return name, self.client.untagged_responses.pop(name.upper(), [None])
+
+    def noop(self):
+        return self._run(self.client.noop())
+
+    def capability(self):
+        return self._run(self.client.capability())
+
+    def idle_wait(self, timeout):
+        return self._run(self.client.idle(timeout))
+
+    def logout(self):
+        return self._run(self.client.logout())
+
+    def shutdown(self):
+        self._run(self.client.close())
@@ -0,0 +1,292 @@
+import argparse
+import logging
+import os
+import queue
+import threading
+import time
+from datetime import date
+from pathlib import Path
+from config import BACKFILL_BATCH_SIZE, BACKFILL_CONNECTIONS, BACKFILL_REPORT_INTERVAL
+from email_handler import InboxCycle, get_select_response_value, rename_and_move_files, sanitize_filename
+from file_handler import unique_file_path, flush_excel_exports
+from imap_connection import ImapConnectionPool, CONNECTION_ERRORS
+from imap_fetch import chunked, fetch_message_structures, download_attachments
+from multi_account import load_accounts, JSON_FILE
+from pipeline import STOP, Stage, stage_queue
+from sync_state import load_sync_state, save_sync_state, UidWatermark
+from worker_pool import get_worker_pool
+
+# Checkpoints of the backfills, apart from the watermark of the normal sync
+BACKFILL_STATE_FILE = Path("data") / "backfill_state.json"
+
+# Times a batch is fetched again after its connection was lost
+BATCH_ATTEMPTS = 3
+
+# IMAP dates always use the English month names, whatever the locale
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+
+# Function to format a date for SEARCH SINCE/BEFORE (01-Jan-2024)
+def imap_date(value):
+    return f"{value.day:02d}-{MONTHS[value.month - 1]}-{value.year}"
+
+
+# Function to build the SEARCH criteria of a backfill from a date range and/or a UID range ("1:5000")
+def build_search_criteria(since=None, before=None, uid_range=None):
+    criteria = []
+    if uid_range:
+        criteria.append(f"UID {uid_range}")
+    if since:
+        criteria.append(f"SINCE {imap_date(since)}")
+    if before:
+        criteria.append(f"BEFORE {imap_date(before)}")
+    return ' '.join(criteria) or 'ALL'
+
+
+# Function to select the inbox read-only (EXAMINE), so no flag of an old message can change
+def examine_inbox(mail):
+    mail.select("inbox", readonly=True)
+    return get_select_response_value(mail, "UIDVALIDITY")
+
+
+# Progress of a backfill: messages and bytes done, and the checkpoint of the messages finished in order
+class BackfillProgress:
+    def __init__(self, account, criteria, uidvalidity, uids, state_file):
+        self.key = f"{account} backfill {criteria}"
+        self.uidvalidity = uidvalidity
+        self.state_file = state_file
+        self.total = len(uids)
+        self.messages = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_bytes(self, size):
+        with self._lock:
+            self.bytes += size
+
+    def message_recorded(self):
+        with self._lock:
+            self.messages += 1
+
+    # Function to save the checkpoint, every message up to last_uid is recorded and its files are moved
+    def save(self, last_uid):
+        save_sync_state(self.key, self.uidvalidity, last_uid, self.state_file)
+
+    # Function to log the progress, the throughput and the expected time left
+    def report(self):
+        with self._lock:
+            elapsed = max(time.monotonic() - self.started, 1e-9)
+            rate = self.messages / elapsed
+            left = (self.total - self.messages) / rate if rate else 0
+            logging.info(f"Backfill: {self.messages}/{self.total} messages "
+                         f"({self.messages * 100 / max(self.total, 1):.1f}%), {rate:.1f} messages/s, "
+                         f"{self.bytes / elapsed / 1024 / 1024:.2f} MB/s, {left / 60:.0f} min left")
+
+
+# Function to find the UIDs to import, without the ones a previous run already finished
+def search_backfill_uids(mail, account, criteria, state_file):
+    uidvalidity = examine_inbox(mail)
+    status, data = mail.uid("search", None, criteria)
+    if status != 'OK':
+        raise RuntimeError(f"SEARCH {criteria} failed: {data}")
+    uids = sorted(int(uid) for uid in data[0].split())
+
+    checkpoint = load_sync_state(f"{account} backfill {criteria}", state_file)
+    if checkpoint["uidvalidity"] == uidvalidity and checkpoint["last_uid"]:
+        logging.info(f"Resuming the backfill after UID {checkpoint['last_uid']}.")
+        uids = [uid for uid in uids if uid > checkpoint["last_uid"]]
+    return uidvalidity, uids
+
+
+# Inbox cycle of a backfill, its watermark is the checkpoint of the backfill and not the one of the normal sync
+# Like in check_inbox a message only counts once all of its files went through the move stage
+class BackfillCycle(InboxCycle):
+    def __init__(self, re_dir, json_file, account, executor):
+        super().__init__(re_dir, json_file, account, executor)
+        self.progress = None
+
+    def save_watermark(self):
+        self.progress.save(self.watermark.value)
+
+
+# Backfill of one account: several connections fetch batches with BODY.PEEK, one stage records the
+# messages and the worker pool extracts the invoice numbers, like check_inbox but without touching \Seen
+class Backfill:
+    def __init__(self, account, re_dir, json_file, executor, connections=BACKFILL_CONNECTIONS,
+                 batch_size=BACKFILL_BATCH_SIZE, state_file=BACKFILL_STATE_FILE):
+        self.account = account
+        self.re_dir = Path(re_dir)
+        self.executor = executor
+        self.connections = connections
+        self.batch_size = batch_size
+        self.state_file = state_file
+        self.cycle = BackfillCycle(self.re_dir, json_file, account["email"], executor)
+        self.progress = None
+        self.stopping = False
+        self.taken = set()
+        self._taken_lock = threading.Lock()
+
+    # Function to give every attachment a file name no other connection is writing to
+    def assign_paths(self, messages):
+        with self._taken_lock:
+            for message in messages:
+                for part in message["parts"]:
+                    part["path"] = unique_file_path(self.re_dir, sanitize_filename(part["filename"]), self.taken)
+                    self.taken.add(part["path"])
+
+    def release_paths(self, messages):
+        with self._taken_lock:
+            for message in messages:
+                for part in message["parts"]:
+                    self.taken.discard(part["path"])
+
+    # Function to fetch one batch with the connection of a pool, fetched again on a new connection if it drops
+    def fetch_batch(self, pool, uidvalidity, uids):
+        for attempt in range(1, BATCH_ATTEMPTS + 1):
+            messages = []
+            try:
+                with pool.connection() as mail:
+                    if examine_inbox(mail) != uidvalidity:
+                        raise RuntimeError("UIDVALIDITY changed, the backfill has to start again")
+                    messages = fetch_message_structures(mail, uids)
+                    self.assign_paths(messages)
+                    download_attachments(mail, messages)
+                return messages
+            except CONNECTION_ERRORS as e:
+                # Files of the failed attempt would otherwise show up as new files
+                for message in messages:
+                    for part in message["parts"]:
+                        if "sha256" in part and os.path.exists(part["path"]):
+                            os.remove(part["path"])
+                if attempt == BATCH_ATTEMPTS:
+                    raise
+                logging.warning(f"Fetching UIDs {uids[0]}-{uids[-1]} failed ({e}), trying again.")
+            finally:
+                self.release_paths(messages)
+
+    # Fetch thread: takes batches until there are none left
+    def fetch_worker(self, pool, uidvalidity, batches, messages_queue):
+        while not self.stopping:
+            try:
+                uids = batches.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                messages = self.fetch_batch(pool, uidvalidity, uids)
+            except Exception as e:
+                logging.error(f"Skipping UIDs {uids[0]}-{uids[-1]}: {e}")
+                # The checkpoint stops before this batch, the next run fetches it again
+                continue
+            # Messages deleted since the search are not returned, nothing is left to do for them
+            if messages:
+                for uid in set(uids) - {message["uid"] for message in messages}:
+                    self.cycle.message_done(uid)
+            for message in messages:
+                self.progress.add_bytes(sum(part.get("bytes", 0) for part in message["parts"]))
+                messages_queue.put(message)
+
+    # Record stage: record a message, the checkpoint moves once the move stage is done with it
+    def record(self, message):
+        self.progress.message_recorded()
+        return self.cycle.record_message(message)
+
+    # Function to wait for the fetch threads, logging the progress in between
+    def wait_for_fetchers(self, fetchers):
+        while any(fetcher.is_alive() for fetcher in fetchers):
+            for fetcher in fetchers:
+                fetcher.join(BACKFILL_REPORT_INTERVAL / len(fetchers))
+            self.progress.report()
+
+    def run(self, criteria):
+        account = self.account
+        pool = ImapConnectionPool(account["server"], account["email"], account["password"], self.connections,
+                                  port=account["port"], use_ssl=account["ssl"])
+        try:
+            with pool.connection() as mail:
+                uidvalidity, uids = search_backfill_uids(mail, account["email"], criteria, self.state_file)
+            self.cycle.uidvalidity = uidvalidity
+            batch_list = list(chunked(uids, self.batch_size))
+            self.progress = self.cycle.progress = BackfillProgress(account["email"], criteria, uidvalidity, uids,
+                                                                   self.state_file)
+            # Incomplete or failed messages hold the checkpoint back, the next run fetches them again
+            self.cycle.watermark = UidWatermark(uids, 0)
+            logging.info(f"Backfill of {account['email']} ({criteria}): {len(uids)} messages "
+                         f"in {len(batch_list)} batches, {self.connections} connections.")
+            if not uids:
+                return self.progress
+
+            batches = queue.Queue()
+            for batch in batch_list:
+                batches.put(batch)
+            messages_queue = stage_queue()
+            jobs_queue = stage_queue()
+            stages = [
+                Stage("record", self.record, messages_queue, jobs_queue),
+                Stage("move", self.cycle.move_invoice, jobs_queue)
+            ]
+            for stage in stages:
+                stage.start()
+            fetchers = [threading.Thread(target=self.fetch_worker, args=(pool, uidvalidity, batches, messages_queue),
+                                         name=f"backfill-fetch-{i}", daemon=True)
+                        for i in range(min(self.connections, len(batch_list)))]
+            for fetcher in fetchers:
+                fetcher.start()
+
+            interrupted = False
+            try:
+                self.wait_for_fetchers(fetchers)
+            except KeyboardInterrupt:
+                # Batches being fetched are finished and recorded, so no download is left behind
+                logging.info("Stopping after the batches being fetched, press Ctrl+C again to abort.")
+                self.stopping = True
+                self.wait_for_fetchers(fetchers)
+                interrupted = True
+            messages_queue.put(STOP)
+            for stage in stages:
+                stage.join()
+                stage.log_stats()
+            self.progress.report()
+            if interrupted:
+                raise KeyboardInterrupt
+
+            # Files left by an interrupted run (already recorded, not yet moved) are handled like in check_inbox
+            invoices = self.cycle.sweep_folder()
+            if invoices:
+                rename_and_move_files(invoices, str(self.re_dir))
+        finally:
+            pool.close()
+            flush_excel_exports()
+        return self.progress
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import the invoices of old mail without changing its flags.")
+    parser.add_argument("config_file", nargs="?", default="accounts.json")
+    parser.add_argument("--account", help="email of the account to import (default: all accounts of the file)")
+    parser.add_argument("--since", type=date.fromisoformat, help="first day to import (YYYY-MM-DD)")
+    parser.add_argument("--before", type=date.fromisoformat, help="import mail before this day (YYYY-MM-DD)")
+    parser.add_argument("--uids", help="UID range to import, e.g. 1:5000")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument("--connections", type=int, default=BACKFILL_CONNECTIONS)
+    args = parser.parse_args()
+
+    accounts, workers = load_accounts(args.config_file)
+    accounts = [account for account in accounts if not args.account or account["email"] == args.account]
+    if not accounts:
+        logging.error("No account to import.")
+        return
+
+    criteria = build_search_criteria(args.since, args.before, args.uids)
+    executor = get_worker_pool(workers)
+    for account in accounts:
+        account["folder"].mkdir(parents=True, exist_ok=True)
+        try:
+            Backfill(account, account["folder"], JSON_FILE, executor, args.connections, args.batch_size).run(criteria)
+        except KeyboardInterrupt:
+            print("Stopped, the next run resumes from the last checkpoint.")
+            return
+
+
+if __name__ == "__main__":
+    main()
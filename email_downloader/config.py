@@ -1,8 +1,77 @@
 # config.py
 
+import os
+
 EMAIL_PROVIDERS = {
     "IONOS": "imap.ionos.es",
     "Outlook": "outlook.office365.com",
     "Gmail": "imap.gmail.com",
     "Yahoo": "imap.mail.yahoo.com"
 }
+
+# Seconds between two inbox checks when the server does not support IDLE
+POLL_INTERVAL = 30
+
+# Servers drop IDLE after 29 minutes (RFC 2177), so re-arm it a bit earlier
+IDLE_REARM_INTERVAL = 25 * 60
+
+# IMAP connections: socket timeout, NOOP health check after this many idle seconds,
+# reconnect delays doubling from the first to the maximum
+IMAP_TIMEOUT = 60
+IMAP_HEALTH_CHECK_INTERVAL = 60
+IMAP_RECONNECT_DELAY = 2
+IMAP_RECONNECT_MAX_DELAY = 15 * 60
+
+# Processes in the worker pool shared by all accounts (PDF text extraction)
+WORKER_COUNT = os.cpu_count() or 2
+
+# Limits of the on-disk cache of extracted PDF text, the least recently used entries go first
+EXTRACTION_CACHE_MAX_ENTRIES = 20000
+EXTRACTION_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Invoice numbers are searched on the first pages only, the rest is read only when nothing matched
+INVOICE_SEARCH_PAGES = 2
+# Top part of a page (0-1) that is searched before the whole page, None searches whole pages only
+INVOICE_HEADER_FRACTION = None
+
+# Extra invoice number patterns per supplier, keyed by sender address or domain, tried before the built-in ones
+# Example: {"buchhaltung@lieferant.de": [r'Beleg-Nr\.?\s*(\d+)'], "stadtwerke.de": [r'Kundennr\.\s*(\d+)']}
+SUPPLIER_INVOICE_PATTERNS = {}
+
+# Seconds one PDF may take in a folder scan before its worker process is killed
+EXTRACTION_TIMEOUT = 120
+
+# Items that may wait between two stages of the inbox pipeline before the earlier stage blocks
+PIPELINE_QUEUE_SIZE = 32
+
+# Folder watcher: seconds a new file must keep its size before it is processed,
+# seconds between two scans when inotify is not available, and files handed over at once
+WATCH_DEBOUNCE = 2
+WATCH_POLL_INTERVAL = 10
+WATCH_BATCH_SIZE = 200
+
+# Images are scaled down to this many pixels on the long side (A4 at 300 dpi) and stored as JPEG
+IMAGE_MAX_SIDE = 3508
+IMAGE_JPEG_QUALITY = 80
+# Pages of a multi-page TIFF that are converted, an image with more is kept next to its PDF
+IMAGE_MAX_PAGES = 50
+# Attached images smaller than this (logos, icons of an e-mail signature) are not taken for scans
+IMAGE_MIN_BYTES = 20 * 1024
+
+# OCR of scans without a text layer (needs pytesseract and Tesseract with the language data)
+# Only the first OCR_PAGES pages are rendered at OCR_DPI, in a pool of OCR_MAX_CONCURRENT processes of its own
+OCR_PAGES = 2
+OCR_DPI = 300
+OCR_LANGUAGE = 'deu'
+OCR_MIN_TEXT_CHARS = 20
+OCR_MAX_CONCURRENT = 2
+
+# Backfill of old mail: messages per FETCH batch, parallel IMAP connections, seconds between progress lines
+BACKFILL_BATCH_SIZE = 500
+BACKFILL_CONNECTIONS = 4
+BACKFILL_REPORT_INTERVAL = 10
+
+# Metrics: port of the local Prometheus endpoint (http://127.0.0.1:PORT/metrics, 0 turns it off)
+# and seconds between two summary lines in the log
+METRICS_PORT = 9464
+METRICS_SUMMARY_INTERVAL = 5 * 60
@@ -0,0 +1,98 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from config import WATCH_POLL_INTERVAL, METRICS_PORT
+from folder_watcher import FolderWatcher
+from metrics import start_metrics_server, start_summary_logger
+from multi_account import load_accounts, start_account_threads, watch_accounts_async
+from pdf_processor import process_new_files
+from worker_pool import get_worker_pool
+
+# Config file used when neither --config nor this environment variable is given
+CONFIG_ENV = "EMAIL_DOWNLOADER_CONFIG"
+DEFAULT_CONFIG_FILE = "accounts.json"
+
+
+# Function to watch a folder for PDFs and images dropped in by hand or by a scanner, restarting on errors
+def run_folder_watcher(folder, executor):
+    watcher = FolderWatcher(folder, lambda files: process_new_files(folder, files, executor=executor))
+    while True:
+        try:
+            watcher.run()
+        except Exception as e:
+            logging.error(f"Watching {folder} failed: {e}")
+        time.sleep(WATCH_POLL_INTERVAL)
+
+
+# Function to run the service without a window: the accounts of the config file (passwords from
+# environment variables via password_env) and the folder watchers of its "watch_folders" list
+def main(config_file, use_asyncio=False, check_threads=4, metrics_port=METRICS_PORT):
+    # Supervisors (systemd, Docker) stop the service with SIGTERM, handled like Ctrl+C
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    with open(config_file, "r", encoding="utf-8") as f:
+        watch_folders = json.load(f).get("watch_folders", [])
+    accounts, workers = load_accounts(config_file)
+    if not accounts and not watch_folders:
+        logging.error(f"No accounts and no watch_folders in {config_file}, nothing to do.")
+        return 1
+
+    # One worker pool for the accounts and the folder watchers
+    executor = get_worker_pool(workers)
+
+    # The inbox loop handles the new files of the account folders itself, a watcher there would race with it
+    account_folders = {account["folder"].resolve() for account in accounts}
+    for folder in watch_folders:
+        if Path(folder).resolve() in account_folders:
+            logging.warning(f"{folder} is the folder of an account, it is not watched separately.")
+            continue
+        Path(folder).mkdir(parents=True, exist_ok=True)
+        threading.Thread(target=run_folder_watcher, args=(folder, executor), name=f"watch {folder}", daemon=True).start()
+
+    # Timings and counters for Prometheus, and a short summary in the log
+    if metrics_port:
+        try:
+            start_metrics_server(metrics_port)
+        except OSError as e:
+            logging.error(f"Cannot serve metrics on port {metrics_port}: {e}")
+    start_summary_logger()
+
+    try:
+        if accounts:
+            if use_asyncio:
+                for account in accounts:
+                    account["folder"].mkdir(parents=True, exist_ok=True)
+                asyncio.run(watch_accounts_async(accounts, executor, check_threads))
+            else:
+                start_account_threads(accounts, executor)
+        # The work happens in the other threads, sleep in steps so Ctrl+C also works on Windows
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        logging.info("Stopping.")
+    return 0
+
+
+# Function to parse the command line of the service (also used by main.py --headless)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Download invoice attachments without a window.")
+    parser.add_argument("--config", default=os.environ.get(CONFIG_ENV, DEFAULT_CONFIG_FILE),
+                        help=f"accounts file (default: ${CONFIG_ENV} or {DEFAULT_CONFIG_FILE})")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="watch all accounts from one event loop instead of one thread per account")
+    parser.add_argument("--check-threads", type=int, default=4,
+                        help="inbox checks running at the same time with --asyncio")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help=f"port of the metrics endpoint on 127.0.0.1, 0 turns it off (default: {METRICS_PORT})")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    raise SystemExit(main(args.config, args.asyncio, args.check_threads, args.metrics_port))
@@ -0,0 +1,264 @@
+import logging
+import sqlite3
+import threading
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+from pathlib import Path
+from ledger import record_key
+
+# Default database file, next to email_info.jsonl
+DATABASE_FILE = Path("data") / "email_index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    message_key TEXT NOT NULL UNIQUE,
+    message_id TEXT,
+    sender TEXT,
+    subject TEXT,
+    date TEXT,
+    date_utc TEXT,
+    folder TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_messages_message_id ON messages(message_id);
+CREATE INDEX IF NOT EXISTS idx_messages_sender ON messages(sender);
+CREATE INDEX IF NOT EXISTS idx_messages_date ON messages(date_utc);
+CREATE INDEX IF NOT EXISTS idx_messages_folder ON messages(folder);
+
+CREATE TABLE IF NOT EXISTS attachments (
+    id INTEGER PRIMARY KEY,
+    message_id INTEGER REFERENCES messages(id),
+    filename TEXT NOT NULL,
+    path TEXT,
+    sha256 TEXT,
+    size INTEGER,
+    duplicate_of INTEGER REFERENCES attachments(id),
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (message_id, filename)
+);
+CREATE INDEX IF NOT EXISTS idx_attachments_sha256 ON attachments(sha256);
+
+CREATE TABLE IF NOT EXISTS invoices (
+    id INTEGER PRIMARY KEY,
+    invoice_number TEXT NOT NULL,
+    sender TEXT,
+    message_id INTEGER REFERENCES messages(id),
+    file_path TEXT,
+    created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (message_id, invoice_number)
+);
+CREATE INDEX IF NOT EXISTS idx_invoices_number_sender ON invoices(invoice_number, sender);
+
+CREATE TABLE IF NOT EXISTS file_moves (
+    id INTEGER PRIMARY KEY,
+    filename TEXT NOT NULL,
+    source TEXT,
+    destination TEXT,
+    status TEXT,
+    moved_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_file_moves_filename ON file_moves(filename);
+
+CREATE TABLE IF NOT EXISTS processed_files (
+    path TEXT PRIMARY KEY,
+    directory TEXT NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    sha256 TEXT,
+    processed_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE INDEX IF NOT EXISTS idx_processed_files_directory ON processed_files(directory);
+"""
+
+
+# Function to turn an email Date header into a sortable UTC timestamp
+def to_utc_iso(date_header):
+    try:
+        return parsedate_to_datetime(date_header).astimezone(timezone.utc).isoformat()
+    except (TypeError, ValueError):
+        return None
+
+
+# Embedded SQLite index of messages, attachments, invoice numbers and file moves
+class InvoiceDatabase:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # One connection shared by the account threads, calls are serialised by the lock
+        self.connection = sqlite3.connect(self.path, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        self._lock = threading.RLock()
+        with self._lock:
+            # WAL lets exports and lookups read while the inbox loop writes
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.executescript(SCHEMA)
+
+    # Function to insert or update a message together with its attachments and invoice number
+    def upsert_message(self, email_data, folder=None):
+        key = record_key(email_data)
+        with self._lock, self.connection:
+            self.connection.execute(
+                """INSERT INTO messages (message_key, message_id, sender, subject, date, date_utc, folder)
+                   VALUES (?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(message_key) DO UPDATE SET folder = COALESCE(excluded.folder, messages.folder)""",
+                (key, email_data.get("Message_ID"), email_data.get("Email"), email_data.get("Subject"),
+                 email_data.get("Date"), to_utc_iso(email_data.get("Date")), folder)
+            )
+            message_row = self.connection.execute("SELECT id FROM messages WHERE message_key = ?", (key,)).fetchone()
+            message_id = message_row["id"]
+
+            for filename in email_data.get("Attachments") or []:
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO attachments (message_id, filename) VALUES (?, ?)", (message_id, filename)
+                )
+            if email_data.get("Invoice_number"):
+                self.connection.execute(
+                    "INSERT OR IGNORE INTO invoices (invoice_number, sender, message_id) VALUES (?, ?, ?)",
+                    (email_data["Invoice_number"], email_data.get("Email"), message_id)
+                )
+            return message_id
+
+    # Function to record where the file of an invoice was moved to
+    def record_invoice(self, email_data, invoice_number, file_path=None):
+        with self._lock, self.connection:
+            message_id = self.upsert_message(email_data)
+            self.connection.execute(
+                """INSERT INTO invoices (invoice_number, sender, message_id, file_path) VALUES (?, ?, ?, ?)
+                   ON CONFLICT(message_id, invoice_number) DO UPDATE SET
+                       file_path = COALESCE(excluded.file_path, invoices.file_path)""",
+                (invoice_number, email_data.get("Email"), message_id, file_path)
+            )
+
+    # Function to store the content hash of a downloaded attachment, or mark it as a duplicate
+    def record_attachment(self, email_data, filename, path=None, sha256=None, size=None, duplicate_of=None):
+        with self._lock, self.connection:
+            message_id = self.upsert_message(email_data)
+            self.connection.execute(
+                """INSERT INTO attachments (message_id, filename, path, sha256, size, duplicate_of)
+                   VALUES (?, ?, ?, ?, ?, ?)
+                   ON CONFLICT(message_id, filename) DO UPDATE SET
+                       path = excluded.path, sha256 = excluded.sha256,
+                       size = excluded.size,
+                       duplicate_of = NULLIF(COALESCE(attachments.duplicate_of, excluded.duplicate_of), attachments.id)""",
+                (message_id, filename, path, sha256, size, duplicate_of)
+            )
+
+    # Function to find the original attachment with the same content
+    # Pass email_data to leave out the attachments of that email (a message that is fetched again)
+    def find_attachment_by_hash(self, sha256, email_data=None):
+        query = """SELECT a.* FROM attachments a LEFT JOIN messages m ON m.id = a.message_id
+                   WHERE a.sha256 = ? AND a.duplicate_of IS NULL"""
+        params = [sha256]
+        if email_data is not None:
+            query += " AND m.message_key IS NOT ?"
+            params.append(record_key(email_data))
+        with self._lock:
+            return self.connection.execute(query + " ORDER BY a.id LIMIT 1", params).fetchone()
+
+    # Function to find an attachment with this content that an earlier fetch of the same email saved
+    def find_own_attachment(self, email_data, sha256):
+        with self._lock:
+            return self.connection.execute(
+                """SELECT a.* FROM attachments a JOIN messages m ON m.id = a.message_id
+                   WHERE m.message_key = ? AND a.sha256 = ? AND a.duplicate_of IS NULL
+                   ORDER BY a.id LIMIT 1""", (record_key(email_data), sha256)
+            ).fetchone()
+
+    # Function to get the invoice number found for the email an attachment came with
+    def invoice_of_attachment(self, attachment_id):
+        with self._lock:
+            row = self.connection.execute(
+                """SELECT i.invoice_number FROM invoices i JOIN attachments a ON a.message_id = i.message_id
+                   WHERE a.id = ? ORDER BY i.id DESC LIMIT 1""", (attachment_id,)
+            ).fetchone()
+        return row["invoice_number"] if row else None
+
+    # Function to record a file that was renamed and moved to the Re_Erledigt folder
+    def record_move(self, filename, source, destination, status):
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO file_moves (filename, source, destination, status) VALUES (?, ?, ?, ?)",
+                (filename, source, destination, status)
+            )
+
+    # Function to get the manifest entries of a directory: path -> (size, mtime, sha256)
+    def processed_files_in(self, directory):
+        with self._lock:
+            rows = self.connection.execute(
+                "SELECT path, size, mtime, sha256 FROM processed_files WHERE directory = ?", (directory,)
+            ).fetchall()
+        return {row["path"]: (row["size"], row["mtime"], row["sha256"]) for row in rows}
+
+    # Function to remember that a file was handled, a file is new again once its size or content changes
+    def mark_processed(self, path, directory, size, mtime, sha256):
+        with self._lock, self.connection:
+            self.connection.execute(
+                """INSERT INTO processed_files (path, directory, size, mtime, sha256) VALUES (?, ?, ?, ?, ?)
+                   ON CONFLICT(path) DO UPDATE SET size = excluded.size, mtime = excluded.mtime,
+                       sha256 = excluded.sha256, processed_at = CURRENT_TIMESTAMP""",
+                (path, directory, size, mtime, sha256)
+            )
+
+    def forget_processed(self, paths):
+        with self._lock, self.connection:
+            self.connection.executemany("DELETE FROM processed_files WHERE path = ?", [(path,) for path in paths])
+
+    # Function to look up an invoice number, optionally only from one supplier
+    def find_invoice(self, invoice_number, sender=None):
+        query = "SELECT * FROM invoices WHERE invoice_number = ?"
+        params = [invoice_number]
+        if sender:
+            query += " AND sender = ?"
+            params.append(sender)
+        with self._lock:
+            return self.connection.execute(query + " ORDER BY id", params).fetchall()
+
+    def has_invoice(self, invoice_number, sender=None):
+        return bool(self.find_invoice(invoice_number, sender))
+
+    # Function to get the rows of the email_info.xlsx export of one folder
+    def message_rows(self, folder=None):
+        query = """SELECT m.id, m.date, m.sender, m.subject, m.message_id,
+                          (SELECT group_concat(filename, char(31)) FROM attachments a WHERE a.message_id = m.id) AS files,
+                          (SELECT invoice_number FROM invoices i WHERE i.message_id = m.id ORDER BY i.id DESC LIMIT 1) AS invoice
+                   FROM messages m"""
+        params = []
+        if folder is not None:
+            query += " WHERE m.folder = ?"
+            params.append(folder)
+        with self._lock:
+            rows = self.connection.execute(query + " ORDER BY m.id", params).fetchall()
+
+        return [{
+            "Date": row["date"],
+            "Email": row["sender"],
+            "Subject": row["subject"],
+            "Message_ID": row["message_id"],
+            "Attachments": row["files"].split("\x1f") if row["files"] else [],
+            "Invoice_number": row["invoice"] or ''
+        } for row in rows]
+
+    def message_count(self):
+        with self._lock:
+            return self.connection.execute("SELECT count(*) FROM messages").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+# Function to get the (shared) database of a file, created on first use
+def get_database(db_file=DATABASE_FILE):
+    db_file = Path(db_file)
+    with _databases_lock:
+        database = _databases.get(db_file)
+        if database is None:
+            database = _databases[db_file] = InvoiceDatabase(db_file)
+            logging.info(f"Opened email index {db_file}")
+        return database
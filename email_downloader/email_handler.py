@@ -1,16 +1,29 @@
 import imaplib
-import email
-from email.header import decode_header
-from file_handler import save_email_info, save_email_info_to_excel, sanitize_filename, check_new_files
+from file_handler import (save_email_info, save_email_info_to_excel, flush_excel_exports, sanitize_filename,
+                          unique_file_path, check_new_files, mark_files_processed)
 from pdf_handler import merge_email_attachments
+from image_convert import is_image, convert_image_to_pdf
+from database import get_database
+from extraction_cache import extract_with_cache, file_sha256
+from pdf_text import extract_invoice_from_pdf
+from invoice_patterns import get_default_engine
+from worker_pool import parallel_map, submit_task, task_result
+from pipeline import STOP, Stage, stage_queue
+from config import EXTRACTION_TIMEOUT, IMAP_TIMEOUT
+from imap_connection import CONNECTION_ERRORS
+from sync_state import load_sync_state, save_sync_state, UidWatermark
+from imap_fetch import (FETCH_BATCH_SIZE, chunked, fetch_message_structures, download_attachments, mark_seen,
+                        is_attached_scan)
+from metrics import timed, inc, observe
 import os
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-import pdfplumber
 import re
 from pathlib import Path
-import pandas as pd
 import shutil
 import logging
+import threading
 import json
 
 
@@ -19,9 +32,9 @@ logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(
 
 
 # Function to connect to the IMAP server
-def connect_imap(server, email_user, email_pass):
+def connect_imap(server, email_user, email_pass, timeout=IMAP_TIMEOUT):
     try:
-        mail = imaplib.IMAP4_SSL(server, port=993)
+        mail = imaplib.IMAP4_SSL(server, port=993, timeout=timeout)
         mail.login(email_user, email_pass)
         logging.info("Login successful!")
         return mail
@@ -42,6 +55,7 @@ def sanitize_filename_for_windows(filename):
 
 
 # Function to extract text from a PDF file
+@timed
 def extract_text_from_pdf(pdf_file_path):
     text = ''
     if not pdf_file_path.lower().endswith('.pdf'):
@@ -52,12 +66,14 @@ def extract_text_from_pdf(pdf_file_path):
         logging.error(f"File does not exist: {pdf_file_path}")
         return text
 
+    import pdfplumber
     try:
         with pdfplumber.open(pdf_file_path) as pdf:
             for page in pdf.pages:
                 page_text = page.extract_text()
                 if page_text:
                     text += page_text + "\n"
+            observe("pdf_pages", len(pdf.pages), function="extract_text_from_pdf")
         logging.info(f"Extracted text from PDF: {pdf_file_path}")
     except Exception as e:
         logging.error(f"Error reading {pdf_file_path}: {e}")
@@ -65,26 +81,34 @@ def extract_text_from_pdf(pdf_file_path):
     return text
 
 
-# Function to extract the invoice number from the text
-def extract_invoice_number(text):
-    patterns = [
-        r'Rechnungsnr\.?\s*:\s*([\w\d-]+)',
-        r'Rechnung\s+(\d{4}/\d{4})',
-        r'(?:Rechnung\s*Nr\.?|Rechnungs-Nr\.?|Rechnungsnummer)[\s:]*[-\s]*([\w\d-]+)',
-        r'[\D]*(\d{8,})[\D]*Rechnungsnummer',
-        r'(\d{8,})\s*[\s\S]*?Rechnungsnummer\s*[:\s]*',
-        r'(\d{8,})\s*Rechnungsnummer\s*[:\s]*'
-    ]
-
-    for pattern in patterns:
-        match = re.search(pattern, text, re.MULTILINE | re.DOTALL)
-        if match:
-            logging.info(f"Found invoice number: {match.group(1).strip()}")
-            return match.group(1).strip()
+# Function to extract the invoice number from the text (rules of the sender's supplier first)
+@timed
+def extract_invoice_number(text, sender=None):
+    invoice_number = get_default_engine().find(text, sender)
+    if invoice_number:
+        logging.info(f"Found invoice number: {invoice_number}")
+        return invoice_number
 
     logging.info("No invoice number found.")
     return None
 
+# Function to extract the invoice number of a single PDF file (runs in worker processes)
+@timed
+def extract_invoice_from_file(pdf_file_path, sender=None):
+    if not str(pdf_file_path).lower().endswith('.pdf'):
+        logging.info(f"Skipping non-PDF file: {pdf_file_path}")
+        return None
+
+    # Read the pages until the invoice number is found
+    def extract(path):
+        return extract_invoice_from_pdf(path, lambda text: extract_invoice_number(text, sender))
+
+    # A file content is parsed once, later runs and rescans read the cached result
+    rule_set = get_default_engine().rule_set_for(sender)
+    text, invoice_number = extract_with_cache(str(pdf_file_path), extract, rule_set)
+    inc("invoices_found_total" if invoice_number else "invoices_missed_total")
+    return invoice_number
+
 def get_files_in_folder(re_dir):
     files = []
     for root, dirs, filenames in os.walk(re_dir):
@@ -93,13 +117,13 @@ def get_files_in_folder(re_dir):
                 files.append(os.path.join(root, filename))
     return files
 
-def extract_invoices_from_folder(re_dir):
+def extract_invoices_from_folder(re_dir, workers=None, timeout=EXTRACTION_TIMEOUT):
     invoices = []
     files = get_files_in_folder(re_dir)
 
-    for file in files:
-        text = extract_text_from_pdf(file)
-        invoice_number = extract_invoice_number(text)
+    # Files are parsed in parallel processes, a file that hangs is skipped after the timeout
+    invoice_numbers = parallel_map(extract_invoice_from_file, files, workers, timeout)
+    for file, invoice_number in zip(files, invoice_numbers):
         if invoice_number:
             invoices.append((file, invoice_number))
         else:
@@ -117,6 +141,7 @@ def display_invoices(invoices, filename_width=20):
         print(f"{filename_base:<{filename_width}} {invoice_number:<25}")
 
 # Function to rename and move files
+@timed
 def rename_and_move_files(invoices, re_dir):
     re_erledigt_path = re_dir.replace('re_', 'Re_Erledigt')
     print('re_erledigt_path:' + re_erledigt_path)
@@ -143,106 +168,347 @@ def rename_and_move_files(invoices, re_dir):
                 
                 # Append information about the moved file
                 moved_files_info.append({'filename': new_name, 'location': re_erledigt_path, 'status': 'moved'})
+                get_database().record_move(new_name, str(file_path), destination_path, 'moved')
+                inc("files_moved_total")
             except Exception as e:
                 print(f"Error processing {file_path}: {e}")  # Handle any errors
 
     return moved_files_info
 
-# Function to check the inbox and download attachments
-def check_inbox(mail, re_dir, json_file):
-    try:
-        excel_file = re_dir / "email_info.xlsx"
-        invoices = []  # List to store processed invoices
-        downloaded_files = []  # Store downloaded files
-
-        # Read unread emails
-        mail.select("inbox")
-        status, messages = mail.search(None, '(UNSEEN)')
-        mail_ids = messages[0].split()
-
-        if mail_ids:
-            for mail_id in mail_ids:
-                status, msg_data = mail.fetch(mail_id, "(RFC822)")
-                for response_part in msg_data:
-                    if isinstance(response_part, tuple):
-                        msg = email.message_from_bytes(response_part[1])
-                        subject, encoding = decode_header(msg["Subject"])[0]
-                        if isinstance(subject, bytes):
-                            subject = subject.decode(encoding if encoding else "utf-8")
-
-                        date = msg.get("Date")
-                        sender = extract_email(msg.get("From"))
-
-                        email_data = {
-                            "Date": date,
-                            "Email": sender,
-                            "Subject": subject,
-                            "Attachments": [],
-                            "Invoice_number": ''
-                        }
-                        pdf_attachments = []
-                        if msg.is_multipart():
-                            for part in msg.walk():
-                                filename = part.get_filename()
-                                if filename:
-                                    filename = sanitize_filename(filename)
-                                    filepath = re_dir / filename
-                                    with open(filepath, "wb") as f:
-                                        f.write(part.get_payload(decode=True))
-                                    email_data["Attachments"].append(filename)
-                                    downloaded_files.append(filepath)
-                                    pdf_attachments.append(filepath)
-
-                        # Merge the PDFs if there are more than one
-                        if len(pdf_attachments) > 1:
-                            formatted_date = datetime.now().strftime('%Y-%m-%d')  # Use current date for merged file
-                            output_filename = f"merged_{formatted_date}_{sanitize_filename_for_windows(subject)}.pdf"
-                            merged_file_path = merge_email_attachments(pdf_attachments, output_filename)
-                            if merged_file_path:
-                                downloaded_files.append(merged_file_path)
-                        else:
-                            downloaded_files.extend(pdf_attachments)
-                        save_email_info(email_data, json_file)
-                        save_email_info_to_excel(email_data, excel_file)
-
-        # Now check for new files in the directory after processing emails
-        new_files = check_new_files(re_dir)
-        if new_files:
-            logging.info(f"New files detected: {', '.join(map(str, new_files))}")
-            for file in new_files:
-                sanitized_filename = sanitize_filename(file)
-                pdf_file_path = re_dir / sanitized_filename
-
-                # Extract text from the PDF
-                extracted_text = extract_text_from_pdf(str(pdf_file_path))
-                invoice_number = extract_invoice_number(extracted_text)
-
-                if invoice_number:
-                    logging.info(f"Renaming and moving the file for invoice number: {invoice_number}")
-                    invoices.append((pdf_file_path, invoice_number))
-
-                    email_data["Invoice_number"] = invoice_number
-                    save_email_info(email_data, json_file)
-                    save_email_info_to_excel(email_data, excel_file)
+# Function to read a numeric value (UIDVALIDITY, UIDNEXT) from the SELECT response
+def get_select_response_value(mail, name):
+    typ, data = mail.response(name)
+    if data and data[-1]:
+        return int(data[-1])
+    return None
 
 
+# Function to find the UIDs of the messages that still have to be processed
+def search_new_uids(mail, account, state_file):
+    mail.select("inbox")
+    uidvalidity = get_select_response_value(mail, "UIDVALIDITY")
+    uidnext = get_select_response_value(mail, "UIDNEXT")
+    state = load_sync_state(account, state_file)
+
+    if state["uidvalidity"] is not None and state["uidvalidity"] == uidvalidity:
+        # Incremental sync: only ask for messages above the watermark
+        last_uid = state["last_uid"]
+        status, data = mail.uid("search", None, f"UID {last_uid + 1}:*")
+        # "n:*" always returns the highest UID, even if it is below n
+        uids = [int(uid) for uid in data[0].split() if int(uid) > last_uid]
+        return uidvalidity, uids, last_uid, False
+
+    # Full resync: first run or the server renumbered the mailbox
+    logging.info(f"Full resync of {account} (UIDVALIDITY {state['uidvalidity']} -> {uidvalidity})")
+    status, data = mail.uid("search", None, "(UNSEEN)")
+    uids = [int(uid) for uid in data[0].split()]
+
+    if uidnext:
+        last_uid = uidnext - 1
+    else:
+        status, data = mail.uid("search", None, "ALL")
+        all_uids = data[0].split()
+        last_uid = int(all_uids[-1]) if all_uids else 0
+    return uidvalidity, uids, last_uid, True
+
+# State of one inbox check, shared by the stages of the pipeline
+class InboxCycle:
+    def __init__(self, re_dir, json_file, account, executor):
+        self.re_dir = re_dir
+        self.json_file = json_file
+        self.excel_file = re_dir / "email_info.xlsx"
+        self.state_file = Path(json_file).parent / "sync_state.json"
+        self.account = account
+        self.executor = executor
+        self.database = get_database()
+        self.uidvalidity = None
+        self.resync = False
+        self.handled_files = set()  # Names of the files this cycle produced, skipped by the folder sweep
+        self.stats = {}  # Stage name -> items handled and seconds spent, returned by check_inbox
+        self.watermark = None  # UidWatermark of the check, None when the caller keeps its own checkpoint
+        self.open_files = {}  # UID -> files of the message still waiting for the move stage
+        self._done_lock = threading.Lock()
+
+    # Function to count a message as completely processed and move the saved watermark if it can
+    def message_done(self, uid):
+        if self.watermark is None:
+            return
+        with self._done_lock:
+            if self.watermark.done(uid):
+                self.save_watermark()
+
+    # Function to save the watermark after it moved
+    def save_watermark(self):
+        # Only an incremental sync saves as it goes, a full resync saves once at the end
+        if not self.resync:
+            save_sync_state(self.account, self.uidvalidity, self.watermark.value, self.state_file)
+
+    # Function to count a file of a message as moved or left in the folder, the last one completes the message
+    def file_done(self, uid):
+        with self._done_lock:
+            self.open_files[uid] -= 1
+            finished = not self.open_files[uid]
+            if finished:
+                del self.open_files[uid]
+        if finished:
+            self.message_done(uid)
+
+    # Record stage: deduplicate, merge and save one message, then hand its files to the extraction
+    def record_message(self, message):
+        database = self.database
+        email_data = {
+            "Date": message["date"],
+            "Email": message["sender"],
+            "Subject": message["subject"],
+            "Message_ID": message["message_id"],
+            "Attachments": [],
+            "Invoice_number": ''
+        }
+        inc("messages_total", account=self.account)
+        complete = True
+        pdf_attachments = []
+        for part in message["parts"]:
+            filepath = part["path"]
+            if "sha256" not in part:
+                email_data["Attachments"].append(filepath.name)
+                self.handled_files.add(filepath.name)
+                logging.error(f"Attachment {filepath.name} was not downloaded.")
+                # The message is fetched again by the next check
+                complete = False
+                continue
+            inc("attachments_total", account=self.account)
+            observe("attachment_bytes", part["bytes"])
+
+            # Fetched again after an interrupted check: the file of the first fetch is still waiting here
+            own = database.find_own_attachment(email_data, part["sha256"])
+            if own is not None and own["path"] and Path(own["path"]) != filepath and os.path.exists(own["path"]):
+                logging.info(f"{filepath.name} was downloaded before as {own['filename']}, using that file.")
+                os.remove(filepath)
+                filepath = Path(own["path"])
+            email_data["Attachments"].append(filepath.name)
+            self.handled_files.add(filepath.name)
+
+            # The same payload was downloaded before (reminder, CC), skip extraction and matching
+            original = database.find_attachment_by_hash(part["sha256"], email_data)
+            if original is not None:
+                logging.info(f"{filepath.name} is a duplicate of {original['filename']}, skipping it.")
+                os.remove(filepath)
+                email_data["Invoice_number"] = database.invoice_of_attachment(original["id"]) or ''
+                database.record_attachment(email_data, filepath.name, None, part["sha256"], part["bytes"],
+                                           duplicate_of=original["id"])
+                continue
+            database.record_attachment(email_data, filepath.name, str(filepath), part["sha256"], part["bytes"])
+            if is_image(filepath) and not is_attached_scan(part):
+                # A logo or icon, it is neither converted nor merged into the invoice
+                logging.info(f"{filepath.name} is a picture of the email, not a scan, leaving it as it is.")
+                mark_files_processed(self.re_dir, [filepath.name])
+                continue
+            pdf_attachments.append(filepath)
+
+        # Images (photos, TIFF scans) become PDFs in the worker pool, all of them at once
+        conversions = [submit_task(self.executor, convert_image_to_pdf, filepath) if is_image(filepath) else None
+                       for filepath in pdf_attachments]
+        if any(conversions):
+            converted = []
+            for filepath, conversion in zip(pdf_attachments, conversions):
+                if conversion is None:
+                    converted.append(filepath)
+                    continue
+                # A conversion that failed in the pool leaves the message above the watermark
+                pdf_path = task_result(self.executor, conversion, convert_image_to_pdf, filepath)
+                if pdf_path:
+                    converted.append(Path(pdf_path))
+                    self.handled_files.add(Path(pdf_path).name)
+                    if filepath.exists():
+                        # Kept because it has more pages than were converted
+                        mark_files_processed(self.re_dir, [filepath.name])
+            pdf_attachments = converted
+
+        # Merge the PDFs if there are more than one
+        files = pdf_attachments
+        if len(pdf_attachments) > 1:
+            formatted_date = datetime.now().strftime('%Y-%m-%d')  # Use current date for merged file
+            output_filename = f"merged_{formatted_date}_{sanitize_filename_for_windows(message['subject'])}.pdf"
+            merged_file_path = merge_email_attachments(pdf_attachments, output_filename)
+            if merged_file_path:
+                files = [Path(merged_file_path)]
+                self.handled_files.add(files[0].name)
+        save_email_info(email_data, self.json_file)
+        save_email_info_to_excel(email_data, self.excel_file)
+
+        # The message is done once the move stage handled all of its files, the watermark waits for that
+        if not complete:
+            return
+        if not files:
+            self.message_done(message["uid"])
+            return
+        with self._done_lock:
+            self.open_files[message["uid"]] = len(files)
+
+        # submit() blocks while the worker pool is busy, which holds back this stage and the fetch
+        for filepath in files:
+            future = submit_task(self.executor, extract_invoice_from_file, filepath, message["sender"])
+            yield future, filepath, email_data, message["uid"]
+
+    # Move stage: rename and move a file once its invoice number is known, and save the number
+    def move_invoice(self, job):
+        future, filepath, email_data, uid = job
+        # A hung or crashed extraction raises, the file stays and its message is fetched again by the next check
+        invoice_number = task_result(self.executor, future, extract_invoice_from_file, filepath, email_data["Email"])
+        if not invoice_number:
+            # Stays in the folder, later cycles skip it until it changes
+            mark_files_processed(self.re_dir, [Path(filepath).name])
+            self.file_done(uid)
+            return
+        logging.info(f"Renaming and moving the file for invoice number: {invoice_number}")
+        moved_files_info = rename_and_move_files([(filepath, invoice_number)], str(self.re_dir))
+        if moved_files_info:
+            logging.info("Files moved successfully.")
+        # Each file carries the record of its own email
+        email_data["Invoice_number"] = invoice_number
+        save_email_info(email_data, self.json_file)
+        save_email_info_to_excel(email_data, self.excel_file)
+        for info in moved_files_info:
+            self.database.record_invoice(email_data, invoice_number, os.path.join(info['location'], info['filename']))
+        self.file_done(uid)
+
+    # Function to extract and move the new or changed files that did not come with this cycle's emails
+    def sweep_folder(self):
+        new_files = [file for file in check_new_files(self.re_dir) if file not in self.handled_files]
+        if not new_files:
+            return []
+        logging.info(f"New files detected: {', '.join(map(str, new_files))}")
+
+        # A download of an interrupted run that was fetched again under another name would be moved twice
+        duplicates = []
+        for file in new_files:
+            path = self.re_dir / file
+            try:
+                original = self.database.find_attachment_by_hash(file_sha256(path))
+            except OSError:
+                continue
+            if original is not None and original["path"] and Path(original["path"]) != path:
+                logging.info(f"{file} has the content of {original['filename']}, leaving it in place.")
+                duplicates.append(file)
+        if duplicates:
+            mark_files_processed(self.re_dir, duplicates)
+            new_files = [file for file in new_files if file not in duplicates]
+
+        pdf_file_paths = [self.re_dir / sanitize_filename(file) for file in new_files]
+        futures = [submit_task(self.executor, extract_invoice_from_file, path) for path in pdf_file_paths]
+        invoice_numbers = []
+        failed = set()
+        for file, future, path in zip(new_files, futures, pdf_file_paths):
+            try:
+                invoice_numbers.append(task_result(self.executor, future, extract_invoice_from_file, path))
+            except Exception as e:
+                # Not marked as processed, the next cycle tries it again
+                logging.error(f"Error processing {path}: {e}")
+                invoice_numbers.append(None)
+                failed.add(file)
+
+        invoices = []
+        for pdf_file_path, invoice_number in zip(pdf_file_paths, invoice_numbers):
+            if invoice_number:
+                logging.info(f"Renaming and moving the file for invoice number: {invoice_number}")
+                invoices.append((pdf_file_path, invoice_number))
+        # Files without an invoice number are not looked at again until they change
+        moved = {Path(pdf_file_path).name for pdf_file_path, _ in invoices}
+        mark_files_processed(self.re_dir, [file for file in new_files if file not in moved and file not in failed])
+        return invoices
+
+
+# Function to check the inbox and download attachments
+# Fetching (this thread), recording, extraction (worker pool) and moving run as a pipeline of
+# stages joined by bounded queues, so network waits and PDF parsing overlap
+@timed
+def check_inbox(mail, re_dir, json_file, account="default", executor=None):
+    local_pool = None
+    if executor is None:
+        # Without the shared process pool the extraction still gets its own stage
+        local_pool = executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="extract")
+    cycle = InboxCycle(re_dir, json_file, account, executor)
+
+    messages_queue = stage_queue()
+    jobs_queue = stage_queue()
+    stages = [
+        Stage("record", cycle.record_message, messages_queue, jobs_queue),
+        Stage("move", cycle.move_invoice, jobs_queue)
+    ]
+    try:
+        for stage in stages:
+            stage.start()
+        try:
+            # Only ask the server for messages above the last processed UID
+            cycle.uidvalidity, uids, last_uid, cycle.resync = search_new_uids(mail, account, cycle.state_file)
+            cycle.watermark = UidWatermark(uids, last_uid)
+
+            # Fetch the structure of a whole batch first, then only the attachment parts
+            fetch_start = time.perf_counter()
+            for batch in chunked(uids, FETCH_BATCH_SIZE):
+                messages = fetch_message_structures(mail, batch)
+                # Messages deleted since the search are not returned, nothing is left to do for them
+                # (an empty answer can also be an error, then the watermark waits for the next check)
+                if messages:
+                    for uid in set(batch) - {message["uid"] for message in messages}:
+                        cycle.message_done(uid)
+                # A new attachment never overwrites a file with the same name
+                taken = set()
+                for message in messages:
+                    for part in message["parts"]:
+                        part["path"] = unique_file_path(re_dir, sanitize_filename(part["filename"]), taken)
+                        taken.add(part["path"])
+                # Attachments are decoded straight to disk, large ones in bounded chunks
+                download_attachments(mail, messages)
+
+                for message in messages:
+                    # Blocks while the record stage is behind
+                    messages_queue.put(message)
+
+                # BODY.PEEK does not set \Seen, flag the batch like the RFC822 fetch used to
+                mark_seen(mail, batch)
+            cycle.stats["fetch"] = {"items": len(uids), "seconds": time.perf_counter() - fetch_start}
+            if uids:
+                logging.info(f"Stage fetch: {len(uids)} items, {cycle.stats['fetch']['seconds']:.2f} s")
+        finally:
+            # Let the later stages finish everything that was fetched
+            messages_queue.put(STOP)
+            for stage in stages:
+                stage.join()
+                stage.log_stats()
+                cycle.stats[stage.stage_name] = {"items": stage.count, "seconds": stage.busy}
+
+        if cycle.resync:
+            # Stops before the first message that failed, the next check fetches it again
+            save_sync_state(account, cycle.uidvalidity, cycle.watermark.value, cycle.state_file)
+
+        # Files put into the folder by hand are handled after the emails
+        invoices = cycle.sweep_folder()
         if invoices:
             moved_files_info = rename_and_move_files(invoices, str(re_dir))
             if moved_files_info:
                 logging.info("Files moved successfully.")
             else:
                 logging.info("No files were moved.")
-        else:
-            logging.info("No invoices to move.")
 
+    except CONNECTION_ERRORS:
+        # The caller reconnects, the watermark makes the next check resume where this one stopped
+        raise
     except Exception as e:
         logging.error(f"Error checking inbox: {e}")
 
+    finally:
+        if local_pool:
+            local_pool.shutdown()
+        # The workbook is rewritten once per cycle instead of twice per email
+        flush_excel_exports()
+    return cycle.stats
+
 def main(server, email_user, email_pass, re_dir, json_file):
     mail = connect_imap(server, email_user, email_pass)
 
     if mail:
-        check_inbox(mail, re_dir, json_file)
+        check_inbox(mail, re_dir, json_file, account=email_user)
         invoices = extract_invoices_from_folder(re_dir)
         display_invoices(invoices)
     else:
@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from config import EXTRACTION_CACHE_MAX_ENTRIES, EXTRACTION_CACHE_MAX_BYTES
+
+# Default cache file, next to the email index
+CACHE_FILE = Path("data") / "extraction_cache.sqlite"
+
+# Bump when the text extraction or the invoice patterns change, old entries are then ignored
+EXTRACTOR_VERSION = 4
+
+# Bytes read at once while hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS extractions (
+    sha256 TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    rule_set TEXT NOT NULL DEFAULT '',
+    text TEXT,
+    invoice_number TEXT,
+    size INTEGER NOT NULL,
+    last_used REAL NOT NULL,
+    PRIMARY KEY (sha256, version, rule_set)
+);
+CREATE INDEX IF NOT EXISTS idx_extractions_last_used ON extractions(last_used);
+"""
+
+
+# Function to compute the SHA-256 of a file without loading it into memory
+def file_sha256(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# On-disk cache of extracted PDF text and invoice numbers, keyed by content hash
+class ExtractionCache:
+    def __init__(self, path, max_entries=EXTRACTION_CACHE_MAX_ENTRIES, max_bytes=EXTRACTION_CACHE_MAX_BYTES):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # Worker processes open their own connection, the timeout covers their concurrent writes
+        self.connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(extractions)")]
+            if columns and "rule_set" not in columns:
+                # Cache from before supplier rules, it is only a cache so it is rebuilt
+                self.connection.execute("DROP TABLE extractions")
+            self.connection.executescript(SCHEMA)
+            # Running estimate of the cache size, only counted again once it goes over a limit
+            self._count, self._total = self._totals()
+
+    # Function to get (text, invoice_number) of a file content, or None when it was never extracted
+    # rule_set names the supplier rules the result was found with ('' for the built-in rules only)
+    def get(self, sha256, rule_set='', version=EXTRACTOR_VERSION):
+        key = (sha256, version, rule_set)
+        with self._lock, self.connection:
+            row = self.connection.execute(
+                "SELECT text, invoice_number FROM extractions WHERE sha256 = ? AND version = ? AND rule_set = ?", key
+            ).fetchone()
+            if row is None:
+                return None
+            self.connection.execute(
+                "UPDATE extractions SET last_used = ? WHERE sha256 = ? AND version = ? AND rule_set = ?",
+                (time.time(),) + key
+            )
+        return row[0], row[1]
+
+    def put(self, sha256, text, invoice_number, rule_set='', version=EXTRACTOR_VERSION):
+        size = len(text.encode("utf-8"))
+        with self._lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO extractions (sha256, version, rule_set, text, invoice_number, size, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (sha256, version, rule_set, text, invoice_number, size, time.time())
+            )
+            # A replaced entry is counted twice, that only leads to an exact count earlier
+            self._count += 1
+            self._total += size
+            if self._count > self.max_entries or self._total > self.max_bytes:
+                self._evict()
+
+    def _totals(self):
+        return self.connection.execute("SELECT count(*), coalesce(sum(size), 0) FROM extractions").fetchone()
+
+    # Function to drop the least recently used entries until the cache is within its limits
+    def _evict(self):
+        # Other processes write to the same file, so the estimate is replaced by the real numbers
+        count, total = self._count, self._total = self._totals()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        evicted = []
+        for sha256, version, rule_set, size in self.connection.execute(
+                "SELECT sha256, version, rule_set, size FROM extractions ORDER BY last_used"):
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            evicted.append((sha256, version, rule_set))
+            count -= 1
+            total -= size
+        self.connection.executemany(
+            "DELETE FROM extractions WHERE sha256 = ? AND version = ? AND rule_set = ?", evicted
+        )
+        self._count, self._total = count, total
+        logging.info(f"Evicted {len(evicted)} entries from the extraction cache.")
+
+    def close(self):
+        with self._lock:
+            self.connection.close()
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+# Function to get the cache of a file, one connection per process (the worker pool forks)
+def get_extraction_cache(cache_file=CACHE_FILE):
+    key = (os.getpid(), Path(cache_file))
+    with _caches_lock:
+        cache = _caches.get(key)
+        if cache is None:
+            cache = _caches[key] = ExtractionCache(cache_file)
+        return cache
+
+
+# Function to run extract(path) -> (text, invoice_number) once per file content across runs
+def extract_with_cache(pdf_file_path, extract, rule_set='', cache_file=CACHE_FILE):
+    try:
+        sha256 = file_sha256(pdf_file_path)
+    except OSError as e:
+        logging.error(f"Error reading {pdf_file_path}: {e}")
+        return '', None
+
+    try:
+        cache = get_extraction_cache(cache_file)
+        cached = cache.get(sha256, rule_set)
+    except sqlite3.Error as e:
+        # A worker killed while it wrote can leave the cache locked for a moment, the file is read instead
+        logging.warning(f"Extraction cache not usable ({e}), reading {pdf_file_path}")
+        cache = cached = None
+    if cached is not None:
+        logging.info(f"Using cached extraction of {pdf_file_path}")
+        return cached
+
+    text, invoice_number = extract(pdf_file_path)
+    # Nothing readable (a scan while OCR is not installed) is tried again next time
+    if cache is not None and (text.strip() or invoice_number):
+        try:
+            cache.put(sha256, text, invoice_number, rule_set)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not cache the extraction of {pdf_file_path}: {e}")
+    return text, invoice_number
@@ -1,8 +1,16 @@
+import ast
 import os
 import re
-import json
-import pandas as pd
+import threading
+import time
 from pathlib import Path
+from ledger import get_ledger
+from database import get_database
+from extraction_cache import file_sha256
+from metrics import timed
+
+# Lock so several account threads never export the same Excel file at once
+_save_lock = threading.Lock()
 
 # Function to clean filenames by removing unsafe characters
 def sanitize_filename(filename):
@@ -17,85 +25,186 @@ def sanitize_filename(filename):
 
     return sanitized
 
-# Function to save email information to Excel without duplicating columns
+# Function to get a path in the directory that no file (or earlier part of the batch) uses yet
+def unique_file_path(directory, filename, taken=()):
+    path = Path(directory) / filename
+    counter = 1
+    while path.exists() or path in taken:
+        path = Path(directory) / f"{Path(filename).stem}_{counter}{Path(filename).suffix}"
+        counter += 1
+    return path
+
+# Fixed columns of the email_info.xlsx workbook
+EXCEL_COLUMNS = ["Date", "Email", "Subject", "Attachments", "Invoice_number"]
+
+# Workbooks whose rows are in the database, and workbooks to rewrite on the next flush
+_indexed_excel_files = set()
+_indexed_ledgers = set()
+_dirty_excel_files = set()
+
+# Function to read the rows of a workbook written before the database existed
+def _load_excel_rows(excel_file):
+    from openpyxl import load_workbook
+    rows = []
+    workbook = load_workbook(excel_file, read_only=True)
+    try:
+        header = None
+        for values in workbook.active.iter_rows(values_only=True):
+            if header is None:
+                header = [str(value) if value is not None else '' for value in values]
+                continue
+            row = {column: value for column, value in zip(header, values) if column in EXCEL_COLUMNS}
+            # Attachments were written as the text of a Python list
+            attachments = row.get("Attachments")
+            if isinstance(attachments, str) and attachments.startswith('['):
+                try:
+                    attachments = ast.literal_eval(attachments)
+                except (ValueError, SyntaxError):
+                    attachments = [attachments]
+            row["Attachments"] = attachments if isinstance(attachments, list) else []
+            if row.get("Invoice_number") in (None, 'nan'):
+                row["Invoice_number"] = ''
+            rows.append(row)
+    finally:
+        workbook.close()
+    return rows
+
+# Function to save email information to Excel without duplicating columns (written on the next flush)
+@timed
 def save_email_info_to_excel(email_data, excel_file):
-    # Define the fixed columns
-    columns = ["Date", "Email", "Subject", "Attachments", "Invoice_number"]
-
-    # Check if the Excel file already exists
-    if os.path.exists(excel_file):
-        # Load the existing data
-        df = pd.read_excel(excel_file)
-
-        # Check if all required columns are present, if not, add missing columns
-        for col in columns:
-            if col not in df.columns:
-                df[col] = None  # Add missing column with None values
-    else:
-        # Create a new DataFrame with the predefined columns
-        df = pd.DataFrame(columns=columns)
-
-    # Ensure the 'Invoice_number' column is of string type
-    if 'Invoice_number' in df.columns:
-        df['Invoice_number'] = df['Invoice_number'].astype(str)  # Convert to string for consistency
-    
-    # Update or add new entry
-    existing_entry = df[(df['Date'] == email_data['Date']) & (df['Email'] == email_data['Email'])]
-    if not existing_entry.empty:
-        # If the entry exists, update it
-        idx = existing_entry.index[0]
-        df.at[idx, 'Attachments'] = email_data['Attachments']  # Update attachments
-        df.at[idx, 'Invoice_number'] = email_data['Invoice_number']
-    else:
-        # Convert the new email_data into a DataFrame
-        new_data = pd.DataFrame([email_data])
-        # Concatenate the old and new data
-        df = pd.concat([df, new_data], ignore_index=True)
-
-    # Ensure only the fixed columns are saved
-    df = df[columns]
-
-    # Save the updated DataFrame back to Excel
-    df.to_excel(excel_file, index=False)
-
-# Function to save email information to JSON
+    excel_file = str(excel_file)
+    folder = str(Path(excel_file).parent)
+    database = get_database()
+    with _save_lock:
+        if excel_file not in _indexed_excel_files:
+            # Rows of a workbook from before the database are imported once
+            if os.path.exists(excel_file) and not database.message_rows(folder):
+                for row in _load_excel_rows(excel_file):
+                    database.upsert_message(row, folder=folder)
+            _indexed_excel_files.add(excel_file)
+
+        database.upsert_message(email_data, folder=folder)
+        _dirty_excel_files.add(excel_file)
+
+# Function to write rows to a workbook in openpyxl write-only (streaming) mode
+@timed
+def write_excel_rows(excel_file, rows):
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Sheet1")
+    sheet.append(EXCEL_COLUMNS)
+    for row in rows:
+        # Lists (attachments) are written as text, like pandas did before
+        sheet.append([str(row.get(column)) if isinstance(row.get(column), list) else row.get(column)
+                      for column in EXCEL_COLUMNS])
+
+    # Write next to the target first, Excel never sees a half written workbook
+    tmp_file = f"{excel_file}.tmp"
+    workbook.save(tmp_file)
+    os.replace(tmp_file, excel_file)
+
+# Function to write every workbook that changed since the last flush (once per inbox cycle)
+def flush_excel_exports():
+    with _save_lock:
+        for excel_file in sorted(_dirty_excel_files):
+            try:
+                # The workbook is an export of the database rows of its folder
+                rows = get_database().message_rows(str(Path(excel_file).parent))
+                write_excel_rows(excel_file, rows)
+            except Exception as e:
+                print(f"Error writing {excel_file}: {e}")
+                continue
+            _dirty_excel_files.discard(excel_file)
+
+# Function to flush the workbooks on a timer, for callers that do not run in inbox cycles
+def start_excel_export_timer(interval=60):
+    def run():
+        while True:
+            time.sleep(interval)
+            flush_excel_exports()
+
+    thread = threading.Thread(target=run, name="excel-export", daemon=True)
+    thread.start()
+    return thread
+
+# Function to save email information to the append-only ledger that replaces the JSON file
+@timed
 def save_email_info(email_data, json_file):
     try:
-        if os.path.exists(json_file):
-            with open(json_file, "r") as f:
-                try:
-                    data = json.load(f)
-                except json.JSONDecodeError:
-                    print("Error decoding JSON, starting fresh.")
-                    data = []
-        else:
-            data = []
-
-        # Update or add new entry
-        for index, entry in enumerate(data):
-            if entry['Date'] == email_data['Date'] and entry['Email'] == email_data['Email']:
-                data[index]['Attachments'] = email_data['Attachments']  # Update attachments
-                data[index]['Invoice_number'] = email_data['Invoice_number']
-                break
-        else:
-            # If no existing entry found, append the new data
-            data.append(email_data)
-
-        # Save to the JSON file
-        with open(json_file, "w") as f:
-            json.dump(data, f, indent=4)
+        # Only the changed record is appended, email_info.json becomes email_info.jsonl
+        ledger = get_ledger(json_file)
+        record = ledger.upsert(email_data)
+
+        database = get_database()
+        if ledger.path not in _indexed_ledgers:
+            # Fill a new database with the records saved before it existed
+            if database.message_count() == 0:
+                for existing in ledger.records():
+                    database.upsert_message(existing)
+            _indexed_ledgers.add(ledger.path)
+        database.upsert_message(record)
     except Exception as e:
         print(f"Error saving email info: {e}")
 
-# Function to check for new PDF files in the selected directory
+# Function to write all saved email information as a JSON array (the old email_info.json format)
+def export_email_info(json_file, export_file=None):
+    get_ledger(json_file).export_json(export_file or json_file)
+
+# Files that are still being written, they are picked up once they got their final name
+TEMP_SUFFIXES = ('.part', '.tmp')
+
+# Files this program writes itself (the Excel export is rewritten every cycle, the ledger and its
+# JSON export may be kept in the folder too) and the lock file Excel creates next to an open workbook
+EXPORT_FILES = {'email_info.xlsx', 'email_info.json', 'email_info.jsonl'}
+EXCEL_LOCK_PREFIX = '~$'
+
+# Function to check for new or changed files in the selected directory (against the processed-file manifest)
 def check_new_files(directory):
     try:
-        existing_files = set(os.listdir(directory))
-        return existing_files
+        directory = str(Path(directory).resolve())
+        database = get_database()
+        known = database.processed_files_in(directory)
+        new_files = set()
+        present = set()
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if (not entry.is_file() or entry.name.endswith(TEMP_SUFFIXES) or entry.name in EXPORT_FILES
+                        or entry.name.startswith(EXCEL_LOCK_PREFIX)):
+                    continue
+                present.add(entry.path)
+                stat = entry.stat()
+                record = known.get(entry.path)
+                if record and record[0] == stat.st_size:
+                    if record[1] == stat.st_mtime:
+                        continue
+                    # Only touched (copied back, synced), the content is the same
+                    if record[2] == file_sha256(entry.path):
+                        database.mark_processed(entry.path, directory, stat.st_size, stat.st_mtime, record[2])
+                        continue
+                new_files.add(entry.name)
+
+        # Files that were moved away or deleted leave the manifest
+        vanished = set(known) - present
+        if vanished:
+            database.forget_processed(vanished)
+        return new_files
     except Exception as e:
         print(f"Error checking files: {e}")
         return set()
 
+# Function to record files as processed so check_new_files skips them until they change
+def mark_files_processed(directory, filenames):
+    directory = str(Path(directory).resolve())
+    database = get_database()
+    for filename in filenames:
+        path = os.path.join(directory, filename)
+        try:
+            stat = os.stat(path)
+            database.mark_processed(path, directory, stat.st_size, stat.st_mtime, file_sha256(path))
+        except FileNotFoundError:
+            # Renamed and moved to Re_Erledigt in the meantime
+            continue
+
 # Create data directory if it doesn't exist
 data_dir = Path("data")
 data_dir.mkdir(exist_ok=True)
@@ -0,0 +1,151 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import time
+from config import WATCH_DEBOUNCE, WATCH_POLL_INTERVAL, WATCH_BATCH_SIZE
+from file_handler import check_new_files, TEMP_SUFFIXES
+from image_convert import IMAGE_EXTENSIONS
+
+# inotify event masks (linux/inotify.h)
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the name: wd, mask, cookie, len
+EVENT_HEADER = struct.Struct("iIII")
+
+
+# Thin ctypes wrapper around the inotify API of the Linux kernel
+class Inotify:
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+    def add_watch(self, path, mask):
+        wd = self._add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f"inotify_add_watch failed for {path}")
+        return wd
+
+    # Function to read the pending events as (mask, name) pairs, waiting at most timeout seconds
+    def read_events(self, timeout):
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0")
+            offset += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+# Function to check if a file name is a finished PDF or image
+def is_pdf(filename):
+    return filename.lower().endswith(('.pdf',) + IMAGE_EXTENSIONS) and not filename.endswith(TEMP_SUFFIXES)
+
+
+# Watcher that hands new PDFs and images of a folder to a callback once they are completely written
+# Uses inotify on Linux and falls back to polling with check_new_files everywhere else
+class FolderWatcher:
+    def __init__(self, folder, handle_files, debounce=WATCH_DEBOUNCE, poll_interval=WATCH_POLL_INTERVAL,
+                 batch_size=WATCH_BATCH_SIZE):
+        self.folder = str(folder)
+        # handle_files(list of paths) is called with batches of ready files
+        self.handle_files = handle_files
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.pending = {}  # name -> (size, time of the last change)
+
+    # Function to remember a file as changed, it is ready once its size stayed the same for debounce seconds
+    def touch(self, name):
+        try:
+            size = os.path.getsize(os.path.join(self.folder, name))
+        except OSError:
+            self.pending.pop(name, None)
+            return
+        previous = self.pending.get(name)
+        if previous is None or previous[0] != size:
+            self.pending[name] = (size, time.monotonic())
+
+    # Function to hand the files that are ready to the callback, in batches
+    def flush_ready(self):
+        now = time.monotonic()
+        ready = []
+        for name, (size, changed) in list(self.pending.items()):
+            if now - changed < self.debounce:
+                continue
+            # The size must still be the one seen last, otherwise the file is still being written
+            self.touch(name)
+            if name in self.pending and self.pending[name] == (size, changed):
+                ready.append(name)
+                del self.pending[name]
+
+        for i in range(0, len(ready), self.batch_size):
+            batch = [os.path.join(self.folder, name) for name in ready[i:i + self.batch_size]]
+            logging.info(f"Processing {len(batch)} new files from {self.folder}")
+            try:
+                self.handle_files(batch)
+            except Exception as e:
+                logging.error(f"Error processing new files: {e}")
+
+    # Function to queue every new or changed file of the folder (start-up and inotify queue overflow)
+    def scan(self):
+        for name in check_new_files(self.folder):
+            if is_pdf(name):
+                self.touch(name)
+
+    def run(self):
+        # Files dropped while the watcher was not running
+        self.scan()
+        try:
+            inotify = Inotify()
+            inotify.add_watch(self.folder, IN_CLOSE_WRITE | IN_MOVED_TO)
+        except (OSError, AttributeError) as e:
+            logging.info(f"inotify not available ({e}), polling {self.folder} every {self.poll_interval} seconds.")
+            self.run_polling()
+            return
+
+        logging.info(f"Watching {self.folder} with inotify.")
+        try:
+            while True:
+                # Wake up in time to hand over the files whose debounce runs out
+                timeout = self.debounce if self.pending else None
+                for mask, name in inotify.read_events(timeout):
+                    if mask & IN_Q_OVERFLOW:
+                        logging.warning("inotify queue overflowed, scanning the folder once.")
+                        self.scan()
+                    elif mask & IN_IGNORED:
+                        raise OSError(f"{self.folder} is no longer watched")
+                    elif is_pdf(name):
+                        self.touch(name)
+                self.flush_ready()
+        finally:
+            inotify.close()
+
+    def run_polling(self):
+        while True:
+            time.sleep(self.poll_interval)
+            self.scan()
+            self.flush_ready()
@@ -3,9 +3,10 @@ import tkinter as tk
 from tkinter import filedialog, ttk
 from pathlib import Path
 from config import EMAIL_PROVIDERS
-from email_handler import connect_imap, check_inbox
+from email_handler import connect_imap
+from idle_watcher import watch_inbox
+from imap_connection import ImapConnection
 import threading
-import time
 
 # Function to select the folder where PDFs will be saved
 def select_folder():
@@ -31,16 +32,14 @@ def save_user_info(folder_selected, email, provider):
         json.dump(user_info, f, indent=4)
 
 # Function to start checking inbox in a separate thread
-def start_checking_inbox(mail, re_dir, json_file):
+def start_checking_inbox(connection, re_dir, json_file, account):
     try:
-        while True:
-            check_inbox(mail, re_dir, json_file)
-            print("Waiting 30 seconds for the next check...")
-            time.sleep(30)
+        # Uses IDLE when the server supports it, polling otherwise, and reconnects when the server drops it
+        watch_inbox(connection, re_dir, json_file, account)
     except KeyboardInterrupt:
         print("Exiting script.")
     finally:
-        mail.logout()
+        connection.close()
 
 # Function to start the application
 def start_app():
@@ -97,7 +96,9 @@ def start_app():
             provider_label.pack(pady=5)
 
             # Start checking inbox in a new thread
-            threading.Thread(target=start_checking_inbox, args=(mail, re_dir, Path("data/email_info.json")), daemon=True).start()
+            # The logged-in connection is kept, the password only to log in again after a disconnect
+            connection = ImapConnection(server, email_user, email_pass, mail=mail)
+            threading.Thread(target=start_checking_inbox, args=(connection, re_dir, Path("data/email_info.json"), email_user), daemon=True).start()
 
             # Hide the main window
             root.withdraw()
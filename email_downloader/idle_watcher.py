@@ -0,0 +1,128 @@
+import imaplib
+import logging
+import re
+import select
+import ssl
+import time
+from config import POLL_INTERVAL, IDLE_REARM_INTERVAL
+from email_handler import check_inbox
+from imap_connection import CONNECTION_ERRORS
+
+# Untagged responses that mean the mailbox received new messages
+NEW_MAIL_RESPONSE = re.compile(rb'^\* \d+ (EXISTS|RECENT)')
+
+
+# Function to check if the server announces the IDLE extension (RFC 2177)
+def supports_idle(mail):
+    # Ask again after login, some servers only list their extensions once authenticated
+    typ, data = mail.capability()
+    if typ != 'OK' or not data or not data[0]:
+        return False
+    return 'IDLE' in data[0].decode().upper().split()
+
+
+# Function to check if imaplib's buffered reader holds data, e.g. an EXISTS that came in one packet
+# with the IDLE continuation; select() only sees the socket, not that buffer
+def has_buffered_data(mail):
+    reader = getattr(mail, 'file', None)
+    if reader is None or not hasattr(reader, 'peek'):
+        return False
+    sock = mail.sock
+    timeout = sock.gettimeout()
+    # Non-blocking, so peek() returns the buffer or what the socket has right now and never waits
+    sock.settimeout(0)
+    try:
+        return bool(reader.peek(1))
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        sock.settimeout(timeout)
+
+
+# Function to wait until the IMAP connection has data to read
+def wait_readable(mail, timeout):
+    if has_buffered_data(mail):
+        return True
+    sock = mail.sock
+    # SSL sockets can hold decrypted data that select() does not see
+    if hasattr(sock, 'pending') and sock.pending():
+        return True
+    readable, _, _ = select.select([sock], [], [], timeout)
+    return bool(readable)
+
+
+# Function to wait in IDLE until new mail arrives or the timeout expires
+def idle_wait(mail, timeout):
+    # The asyncio client (aio_imap.SyncImapClient) runs IDLE on its event loop
+    if hasattr(mail, 'idle_wait'):
+        return mail.idle_wait(timeout)
+
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    response = mail.readline()
+    if not response.startswith(b'+'):
+        raise imaplib.IMAP4.error(f"IDLE rejected: {response.strip()!r}")
+
+    new_mail = False
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not wait_readable(mail, remaining):
+            break
+        line = mail.readline()
+        if not line or line.startswith(b'* BYE'):
+            raise imaplib.IMAP4.abort("Connection closed during IDLE")
+        if NEW_MAIL_RESPONSE.match(line):
+            new_mail = True
+            break
+
+    # Leave IDLE and read everything up to the tagged completion
+    mail.send(b'DONE\r\n')
+    while True:
+        line = mail.readline()
+        if not line:
+            raise imaplib.IMAP4.abort("Connection closed while leaving IDLE")
+        if line.startswith(tag):
+            break
+
+    return new_mail
+
+
+# Function to watch the inbox with IDLE, falling back to polling if the server lacks it
+# connection is an ImapConnection, a lost connection is reconnected and the inbox checked again
+def watch_inbox(connection, re_dir, json_file, account, poll_interval=POLL_INTERVAL,
+                rearm_interval=IDLE_REARM_INTERVAL, executor=None):
+    use_idle = None
+    new_mail = True
+    while True:
+        try:
+            mail = connection.ensure()
+            if use_idle is None:
+                use_idle = supports_idle(mail)
+                if use_idle:
+                    logging.info(f"Server supports IDLE, waiting for new mail of {account}.")
+                else:
+                    logging.info(f"Server does not support IDLE, polling every {poll_interval} seconds.")
+
+            if new_mail:
+                check_inbox(mail, re_dir, json_file, account, executor)
+
+            if use_idle:
+                try:
+                    # Nothing arrived means the IDLE is re-armed before the server times it out
+                    new_mail = idle_wait(mail, rearm_interval)
+                except imaplib.IMAP4.abort:
+                    raise
+                except imaplib.IMAP4.error as e:
+                    logging.warning(f"IDLE failed, falling back to polling: {e}")
+                    use_idle = False
+                    new_mail = False
+            else:
+                print(f"Waiting {poll_interval} seconds for the next check...")
+                time.sleep(poll_interval)
+                new_mail = True
+        except CONNECTION_ERRORS as e:
+            logging.warning(f"Connection of {account} lost ({e}), reconnecting.")
+            connection.close()
+            # Mail that arrived while the connection was down is picked up right away
+            new_mail = True
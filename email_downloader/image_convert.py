@@ -0,0 +1,68 @@
+import logging
+import os
+from pathlib import Path
+from config import IMAGE_MAX_SIDE, IMAGE_JPEG_QUALITY, IMAGE_MAX_PAGES
+from file_handler import unique_file_path
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.jpe', '.tif', '.tiff', '.gif', '.bmp', '.webp')
+
+# Long side of an A4 page in inches, every page is scaled to it
+A4_LONG_SIDE_INCHES = 11.69
+
+
+# Function to check if a file is an image that can become a PDF
+def is_image(file_path):
+    return str(file_path).lower().endswith(IMAGE_EXTENSIONS)
+
+
+# Function to turn one frame into a compact page: upright, scaled down, in a mode JPEG can store
+def prepare_frame(frame, max_side):
+    from PIL import ImageOps
+    frame = ImageOps.exif_transpose(frame)
+    if frame.mode == '1':
+        # Black and white scans stay 1 bit, that is smaller than any JPEG
+        pass
+    elif frame.mode in ('L', 'LA', 'I', 'I;16'):
+        frame = frame.convert('L')
+    else:
+        frame = frame.convert('RGB')
+    if max(frame.size) > max_side:
+        frame.thumbnail((max_side, max_side))
+    return frame
+
+
+# Function to convert an image (the pages of a TIFF) into a PDF next to it, the image is deleted afterwards
+# Frames are read and written one at a time, so a long TIFF never is in memory at once; an image
+# with more than max_pages frames is kept, its PDF only has the first max_pages pages
+# Runs in the worker pool, returns the path of the PDF or None
+def convert_image_to_pdf(image_path, max_side=IMAGE_MAX_SIDE, quality=IMAGE_JPEG_QUALITY,
+                         max_pages=IMAGE_MAX_PAGES):
+    from PIL import Image
+    image_path = Path(image_path)
+    pdf_path = unique_file_path(image_path.parent, image_path.stem + '.pdf')
+    tmp_path = pdf_path.with_name(pdf_path.name + '.tmp')
+    try:
+        with Image.open(image_path) as image:
+            frame_count = getattr(image, 'n_frames', 1)
+            pages = min(frame_count, max_pages)
+            for index in range(pages):
+                image.seek(index)
+                page = prepare_frame(image, max_side)
+                # Pages get the size of A4 on their long side, whatever the resolution of the scan was
+                page.save(tmp_path, 'PDF', append=index > 0, resolution=max(page.size) / A4_LONG_SIDE_INCHES,
+                          quality=quality, optimize=True)
+                del page
+        os.replace(tmp_path, pdf_path)
+    except Exception as e:
+        logging.error(f"Error converting {image_path} to PDF: {e}")
+        if tmp_path.exists():
+            tmp_path.unlink()
+        return None
+
+    if frame_count > pages:
+        logging.warning(f"{image_path.name} has {frame_count} pages, only the first {pages} are in "
+                        f"{pdf_path.name}. The image is kept.")
+    else:
+        image_path.unlink()
+    logging.info(f"Converted {image_path.name} ({pages} pages) to {pdf_path.name}")
+    return str(pdf_path)
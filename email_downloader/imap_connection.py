@@ -0,0 +1,135 @@
+import imaplib
+import logging
+import queue
+import random
+import ssl
+import time
+from contextlib import contextmanager
+from aio_imap import SyncImapClient
+from config import IMAP_TIMEOUT, IMAP_HEALTH_CHECK_INTERVAL, IMAP_RECONNECT_DELAY, IMAP_RECONNECT_MAX_DELAY
+
+# Errors that mean the connection is gone (dropped socket, BYE, timeout), not that a command failed
+CONNECTION_ERRORS = (imaplib.IMAP4.abort, ConnectionError, TimeoutError, ssl.SSLError, EOFError)
+
+
+# One logged-in IMAP connection that checks its health and reconnects with backoff when it is lost
+class ImapConnection:
+    def __init__(self, server, email_user, email_pass, port=993, use_ssl=True, timeout=IMAP_TIMEOUT,
+                 mail=None, use_asyncio=False):
+        self.server = server
+        self.email_user = email_user
+        self.email_pass = email_pass
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        # The asyncio client runs all connections of the process on one event loop thread
+        self.use_asyncio = use_asyncio
+        # An already logged-in connection (e.g. the one the GUI tested the password with) is reused
+        self.mail = mail
+        self.last_used = time.monotonic()
+        if mail is not None and mail.sock is not None:
+            mail.sock.settimeout(timeout)
+
+    # Function to open a new connection and log in, raises on failure
+    def connect(self):
+        if self.use_asyncio:
+            mail = SyncImapClient.connect(self.server, self.port, self.use_ssl, self.timeout)
+        elif self.use_ssl:
+            mail = imaplib.IMAP4_SSL(self.server, port=self.port, timeout=self.timeout)
+        else:
+            mail = imaplib.IMAP4(self.server, port=self.port, timeout=self.timeout)
+        try:
+            mail.login(self.email_user, self.email_pass)
+        except Exception:
+            mail.shutdown()
+            raise
+        self.mail = mail
+        self.last_used = time.monotonic()
+        logging.info(f"Connected to {self.server} as {self.email_user}.")
+        return mail
+
+    # Function to close the connection, errors of a dead connection are ignored
+    def close(self):
+        mail, self.mail = self.mail, None
+        if mail is None:
+            return
+        try:
+            mail.logout()
+        except Exception:
+            try:
+                mail.shutdown()
+            except Exception:
+                pass
+
+    # Function to check a connection that was idle for a while with NOOP
+    def is_healthy(self):
+        if self.mail is None:
+            return False
+        if time.monotonic() - self.last_used < IMAP_HEALTH_CHECK_INTERVAL:
+            return True
+        try:
+            typ, _ = self.mail.noop()
+        except (imaplib.IMAP4.error, OSError, EOFError):
+            return False
+        self.last_used = time.monotonic()
+        return typ == 'OK'
+
+    # Function to reconnect until it works, waiting twice as long after every failed attempt
+    def reconnect(self, max_attempts=None):
+        self.close()
+        delay = IMAP_RECONNECT_DELAY
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return self.connect()
+            except (imaplib.IMAP4.error, OSError, EOFError) as e:
+                if max_attempts is not None and attempt >= max_attempts:
+                    raise
+                # Jitter keeps the connections of many accounts from retrying in lockstep
+                wait = delay * random.uniform(0.8, 1.2)
+                logging.warning(f"Connecting {self.email_user} failed ({e}), retrying in {wait:.1f} seconds.")
+                time.sleep(wait)
+                delay = min(delay * 2, IMAP_RECONNECT_MAX_DELAY)
+
+    # Function to get a working connection, checked with NOOP and reconnected if needed
+    def ensure(self):
+        if not self.is_healthy():
+            if self.mail is not None:
+                logging.warning(f"Connection of {self.email_user} lost, reconnecting.")
+            self.reconnect()
+        self.last_used = time.monotonic()
+        return self.mail
+
+    def __enter__(self):
+        return self.ensure()
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None and issubclass(exc_type, CONNECTION_ERRORS):
+            # The next ensure() reconnects
+            self.close()
+        else:
+            self.last_used = time.monotonic()
+        return False
+
+
+# Fixed number of connections to one account, for work that fetches in parallel (backfill)
+class ImapConnectionPool:
+    def __init__(self, server, email_user, email_pass, size=4, **options):
+        self.connections = queue.Queue()
+        for _ in range(size):
+            self.connections.put(ImapConnection(server, email_user, email_pass, **options))
+
+    # Function to borrow a working connection, the mailbox has to be selected by the caller
+    @contextmanager
+    def connection(self):
+        connection = self.connections.get()
+        try:
+            with connection as mail:
+                yield mail
+        finally:
+            self.connections.put(connection)
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
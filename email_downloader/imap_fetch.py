@@ -0,0 +1,388 @@
+import hashlib
+import imaplib
+import logging
+import os
+import re
+from email.header import decode_header, make_header
+from email.utils import decode_rfc2231
+from urllib.parse import unquote
+from stream_decode import make_stream_decoder
+from metrics import timed
+from config import IMAGE_MIN_BYTES
+
+# Number of messages asked for in one FETCH command
+FETCH_BATCH_SIZE = 200
+
+# Parts larger than this are downloaded in chunks of this size instead of in one piece
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Upper bound for the attachment bytes requested in one batched FETCH
+MAX_BATCH_BYTES = 8 * 1024 * 1024
+
+# Attachment types that are downloaded, everything else stays on the server
+ATTACHMENT_TYPES = ('application/pdf',)
+ATTACHMENT_EXTENSIONS = ('.pdf', '.png', '.jpg', '.jpeg', '.tif', '.tiff')
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+LITERAL = re.compile(rb'\{(\d+)\}\r\n')
+
+
+# Function to split a list into chunks of the given size
+def chunked(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+# Function to build a compact IMAP sequence set (e.g. "1:4,7,9:10") from UIDs
+def build_uid_set(uids):
+    uids = sorted(set(int(uid) for uid in uids))
+    ranges = []
+    for uid in uids:
+        if ranges and uid == ranges[-1][1] + 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else f"{a}:{b}" for a, b in ranges)
+
+
+# Function to join the pieces imaplib returns for a FETCH into one byte string
+def join_fetch_data(data):
+    joined = b''
+    for item in data:
+        if isinstance(item, tuple):
+            # imaplib splits literals off: the header ends with "{n}" and the literal follows
+            joined += item[0] + b'\r\n' + item[1]
+        elif item:
+            joined += item
+    return joined
+
+
+# Function to parse IMAP data (lists, atoms, strings, literals) into Python lists
+def parse_imap_data(data):
+    pos = 0
+    stack = [[]]
+    length = len(data)
+    while pos < length:
+        char = data[pos:pos + 1]
+        if char in (b' ', b'\r', b'\n'):
+            pos += 1
+        elif char == b'(':
+            stack.append([])
+            pos += 1
+        elif char == b')':
+            item = stack.pop()
+            stack[-1].append(item)
+            pos += 1
+        elif char == b'"':
+            # Quoted string with backslash escapes
+            end = pos + 1
+            value = bytearray()
+            while data[end:end + 1] != b'"':
+                if data[end:end + 1] == b'\\':
+                    end += 1
+                value += data[end:end + 1]
+                end += 1
+            stack[-1].append(bytes(value).decode('utf-8', 'replace'))
+            pos = end + 1
+        elif char == b'{':
+            match = LITERAL.match(data, pos)
+            size = int(match.group(1))
+            start = match.end()
+            stack[-1].append(data[start:start + size])
+            pos = start + size
+        else:
+            # Atom, which may contain a section like BODY[1.2]<0>
+            end = pos
+            while end < length and data[end:end + 1] not in (b' ', b'(', b')', b'\r', b'\n'):
+                if data[end:end + 1] == b'[':
+                    end = data.index(b']', end)
+                end += 1
+            atom = data[pos:end].decode('ascii', 'replace')
+            stack[-1].append(None if atom.upper() == 'NIL' else atom)
+            pos = end
+    return stack[0]
+
+
+# Function to turn a FETCH response into one dictionary per message
+def parse_fetch_response(data):
+    messages = []
+    items = parse_imap_data(join_fetch_data(data))
+    # The response is a sequence of "<number> (<name> <value> ...)"
+    for item in items:
+        if not isinstance(item, list):
+            continue
+        fields = {}
+        for i in range(0, len(item) - 1, 2):
+            fields[item[i].upper()] = item[i + 1]
+        messages.append(fields)
+    return messages
+
+
+# Function to decode a header value that may contain RFC 2047 encoded words
+def decode_header_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, bytes):
+        value = value.decode('utf-8', 'replace')
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+# Function to read the relevant fields from an ENVELOPE structure
+def parse_envelope(envelope):
+    date, subject, from_list = envelope[0], envelope[1], envelope[2]
+    sender = ''
+    if from_list:
+        name, adl, mailbox, host = from_list[0]
+        sender = f"{mailbox}@{host}" if host else (mailbox or '')
+    return {
+        "date": decode_header_value(date),
+        "subject": decode_header_value(subject),
+        "sender": sender,
+        "message_id": decode_header_value(envelope[9])
+    }
+
+
+# Function to convert a body parameter list into a dictionary
+def parse_body_params(params):
+    result = {}
+    if not isinstance(params, list):
+        return result
+    for i in range(0, len(params) - 1, 2):
+        key = str(params[i]).lower()
+        value = params[i + 1]
+        if isinstance(value, bytes):
+            value = value.decode('utf-8', 'replace')
+        if key.endswith('*'):
+            # RFC 2231 extended value, e.g. filename*=utf-8''Rechnung%20123.pdf
+            key = key.rstrip('*')
+            charset, language, text = decode_rfc2231(value)
+            value = unquote(text, encoding=charset or 'utf-8', errors='replace')
+        result[key] = value
+    return result
+
+
+# Function to list every leaf part of a BODYSTRUCTURE with its section number
+# related is True inside a multipart/related, whose parts with a Content-ID are shown in the HTML body
+def walk_bodystructure(structure, prefix='', related=False):
+    if isinstance(structure[0], list):
+        # Multipart: the sub-parts come first, followed by the subtype
+        count = 0
+        while count < len(structure) and isinstance(structure[count], list):
+            count += 1
+        sub_parts = structure[:count]
+        subtype = structure[count] if count < len(structure) else None
+        if isinstance(subtype, bytes):
+            subtype = subtype.decode('ascii', 'replace')
+        is_related = related or (subtype or '').lower() == 'related'
+        for number, sub_part in enumerate(sub_parts, 1):
+            yield from walk_bodystructure(sub_part, f"{prefix}{number}.", is_related)
+        return
+
+    section = prefix.rstrip('.') or '1'
+    maintype = (structure[0] or '').lower()
+    subtype = (structure[1] or '').lower()
+    # Extension data sits after the type specific fields
+    if maintype == 'text':
+        disposition_index = 9
+    elif maintype == 'message' and subtype == 'rfc822':
+        disposition_index = 11
+    else:
+        disposition_index = 8
+
+    disposition = structure[disposition_index] if len(structure) > disposition_index else None
+    disposition_type = None
+    disposition_params = {}
+    if isinstance(disposition, list) and disposition:
+        disposition_type = decode_header_value(disposition[0]).lower() or None
+        if len(disposition) > 1:
+            disposition_params = parse_body_params(disposition[1])
+    content_params = parse_body_params(structure[2])
+
+    yield {
+        "section": section,
+        "type": f"{maintype}/{subtype}",
+        "encoding": (structure[5] or '7bit').lower(),
+        "size": int(structure[6] or 0),
+        "filename": decode_header_value(disposition_params.get('filename') or content_params.get('name')) or None,
+        "disposition": disposition_type,
+        "content_id": decode_header_value(structure[3]) or None,
+        "related": related
+    }
+
+
+# Function to check if an image is part of the message body (signature logo, embedded picture)
+def is_inline_image(part):
+    if not (part["type"].startswith('image/') or part["filename"].lower().endswith(IMAGE_EXTENSIONS)):
+        return False
+    if part.get("disposition") == 'attachment':
+        return False
+    return part.get("disposition") == 'inline' or bool(part.get("content_id") and part.get("related"))
+
+
+# Function to check if a downloaded image is a scan or photo sent as attachment, not a picture of
+# the email (signature logo or icon sent as a file, referenced by its Content-ID or just small)
+def is_attached_scan(part):
+    if part.get("content_id") and part.get("disposition") != 'attachment':
+        return False
+    return part.get("bytes", part["size"]) >= IMAGE_MIN_BYTES
+
+
+# Function to decide if a body part is an attachment we want to download
+# Images shown in the body stay on the server, PDFs are taken whatever their disposition
+# (some mail programs send attached PDFs as inline)
+def is_wanted_attachment(part):
+    if not part["filename"]:
+        return False
+    if is_inline_image(part):
+        return False
+    if part["type"] in ATTACHMENT_TYPES or part["type"].startswith('image/'):
+        return True
+    return part["filename"].lower().endswith(ATTACHMENT_EXTENSIONS)
+
+
+# Function to fetch UID, BODYSTRUCTURE and ENVELOPE for a batch of messages in one command
+@timed
+def fetch_message_structures(mail, uids):
+    status, data = mail.uid('fetch', build_uid_set(uids), '(UID BODYSTRUCTURE ENVELOPE)')
+    if status != 'OK':
+        logging.error(f"Error fetching message structures: {data}")
+        return []
+
+    messages = []
+    for fields in parse_fetch_response(data):
+        if 'UID' not in fields or 'BODYSTRUCTURE' not in fields:
+            continue
+        message = parse_envelope(fields.get('ENVELOPE') or [None] * 10)
+        message["uid"] = int(fields['UID'])
+        message["parts"] = [part for part in walk_bodystructure(fields['BODYSTRUCTURE']) if is_wanted_attachment(part)]
+        messages.append(message)
+
+    messages.sort(key=lambda message: message["uid"])
+    return messages
+
+
+# Function to get the FETCH response of one UID, unsolicited responses (flag changes) are skipped
+def response_for_uid(responses, uid):
+    for fields in responses:
+        if 'UID' in fields and int(fields['UID']) == uid:
+            return fields
+    return None
+
+
+# Function to check if a parsed FETCH response holds a BODY[section] item
+def has_section(fields, section):
+    return any(name.startswith(f"BODY[{section}]") for name in fields)
+
+
+# Function to get the content of a BODY[section] item from a parsed FETCH response
+def get_section_data(fields, section):
+    for name, value in fields.items():
+        if name.startswith(f"BODY[{section}]"):
+            if isinstance(value, str):
+                value = value.encode('latin-1', 'replace')
+            return value or b''
+    return b''
+
+
+# Function to write the decoded content of a part to its target path
+def write_part(part, encoded_chunks):
+    decoder = make_stream_decoder(part["encoding"])
+    digest = hashlib.sha256()
+    size = 0
+    tmp_path = f"{part['path']}.part"
+    completed = False
+    try:
+        # Write to a temporary file so a half downloaded attachment is never picked up
+        with open(tmp_path, "wb") as f:
+            for chunk in encoded_chunks:
+                data = decoder.feed(chunk)
+                # Hash the decoded bytes on the way to disk, the file is never read again for it
+                digest.update(data)
+                size += len(data)
+                f.write(data)
+            data = decoder.finish()
+            digest.update(data)
+            size += len(data)
+            f.write(data)
+        os.replace(tmp_path, part["path"])
+        part["sha256"] = digest.hexdigest()
+        part["bytes"] = size
+        completed = True
+    finally:
+        if not completed and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+# Function to fetch one large part piece by piece with partial FETCH (BODY.PEEK[n]<offset.length>)
+def iter_part_chunks(mail, uid, section, chunk_size=STREAM_CHUNK_SIZE):
+    offset = 0
+    while True:
+        status, data = mail.uid('fetch', str(uid), f"(BODY.PEEK[{section}]<{offset}.{chunk_size}>)")
+        if status != 'OK':
+            raise imaplib.IMAP4.error(f"Error fetching part {section} of UID {uid}: {data}")
+        fields = response_for_uid(parse_fetch_response(data), uid)
+        chunk = get_section_data(fields, section) if fields else b''
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        offset += len(chunk)
+
+
+# Function to split the messages into FETCH batches that stay below MAX_BATCH_BYTES
+def plan_section_batches(messages):
+    # Messages with the same attachment layout can share one FETCH command
+    groups = {}
+    for message in messages:
+        parts = [part for part in message["parts"] if part["size"] <= STREAM_CHUNK_SIZE]
+        if parts:
+            sections = tuple(part["section"] for part in parts)
+            groups.setdefault(sections, []).append((message["uid"], sum(part["size"] for part in parts)))
+
+    for sections, entries in groups.items():
+        batch, batch_bytes = [], 0
+        for uid, size in entries:
+            if batch and batch_bytes + size > MAX_BATCH_BYTES:
+                yield sections, batch
+                batch, batch_bytes = [], 0
+            batch.append(uid)
+            batch_bytes += size
+        if batch:
+            yield sections, batch
+
+
+# Function to download the attachment parts of a batch of messages to part["path"] (sets part["sha256"])
+@timed
+def download_attachments(mail, messages):
+    parts_by_key = {(message["uid"], part["section"]): part for message in messages for part in message["parts"]}
+
+    # Small parts: several messages per FETCH, bounded by MAX_BATCH_BYTES
+    for sections, uids in plan_section_batches(messages):
+        items = ' '.join(f"BODY.PEEK[{section}]" for section in sections)
+        status, data = mail.uid('fetch', build_uid_set(uids), f"({items})")
+        if status != 'OK':
+            logging.error(f"Error fetching attachments: {data}")
+            continue
+        for fields in parse_fetch_response(data):
+            # Unsolicited FETCH responses (flags changed by another client) have no UID or no body
+            if 'UID' not in fields:
+                continue
+            uid = int(fields['UID'])
+            for section in sections:
+                part = parts_by_key.get((uid, section))
+                if part is not None and has_section(fields, section):
+                    write_part(part, [get_section_data(fields, section)])
+
+    # Large parts: streamed chunk by chunk, memory stays bounded by STREAM_CHUNK_SIZE
+    for (uid, section), part in parts_by_key.items():
+        if part["size"] > STREAM_CHUNK_SIZE:
+            write_part(part, iter_part_chunks(mail, uid, section))
+
+
+# Function to set the \Seen flag on processed messages, like fetching RFC822 did before
+def mark_seen(mail, uids):
+    if uids:
+        mail.uid('store', build_uid_set(uids), '+FLAGS.SILENT', '(\\Seen)')
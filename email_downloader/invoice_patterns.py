@@ -0,0 +1,93 @@
+import logging
+import re
+from config import SUPPLIER_INVOICE_PATTERNS
+
+# Every built-in rule is anchored on one of these keywords, the text is scanned for them once
+KEYWORD = re.compile(r'Rechnung')
+
+# Characters around a keyword hit that the rules may look at
+WINDOW_BEFORE = 200
+WINDOW_AFTER = 120
+
+# Built-in rules in priority order: (name, word the hit must start, pattern)
+# A rule only runs in the windows of hits that start with its word, patterns that end
+# with the word get a window that ends right after it
+DEFAULT_RULES = [
+    ("rechnungsnr", "Rechnungsnr", r'Rechnungsnr\.?\s*:\s*([\w\d-]+)'),
+    ("rechnung_jahr", "Rechnung", r'Rechnung\s+(\d{4}/\d{4})'),
+    ("rechnungsnummer", "Rechnung", r'(?:Rechnung\s*Nr\.?|Rechnungs-Nr\.?|Rechnungsnummer)[\s:]*[-\s]*([\w\d-]+)'),
+    ("nummer_davor", "Rechnungsnummer", r'(\d{8,})\D*Rechnungsnummer'),
+    ("nummer_im_umfeld", "Rechnungsnummer", r'(\d{8,})[\s\S]*?Rechnungsnummer'),
+]
+
+
+# Function to get the domain of an email address
+def email_domain(address):
+    return address.rsplit('@', 1)[-1].lower() if address and '@' in address else None
+
+
+# Precompiled invoice number rules with a keyword index and optional rules per supplier
+class InvoicePatternEngine:
+    def __init__(self, rules=DEFAULT_RULES, supplier_rules=None):
+        self.rules = [(name, word, re.compile(pattern), pattern.endswith(word)) for name, word, pattern in rules]
+        # Supplier rules are keyed by full address or by domain, addresses win
+        self.supplier_rules = {
+            key.lower(): [re.compile(pattern, re.MULTILINE) for pattern in patterns]
+            for key, patterns in (supplier_rules or {}).items()
+        }
+
+    # Function to get the key of the supplier rules that apply to a sender ('' when there are none)
+    def rule_set_for(self, sender):
+        if not sender:
+            return ''
+        sender = sender.lower()
+        if sender in self.supplier_rules:
+            return sender
+        domain = email_domain(sender)
+        if domain in self.supplier_rules:
+            return domain
+        return ''
+
+    # Function to get the window of a keyword hit that a rule may look at
+    def _window(self, text, hit, word, ends_with_word):
+        start = max(0, hit - WINDOW_BEFORE)
+        # Never cut a number in half at the start of a window
+        while start > 0 and text[start - 1].isdigit() and hit - start < WINDOW_BEFORE + 32:
+            start -= 1
+        end = hit + len(word) if ends_with_word else min(len(text), hit + WINDOW_AFTER)
+        return start, end
+
+    # Function to find the invoice number, the first rule in priority order that matches wins
+    def find(self, text, sender=None):
+        if not text:
+            return None
+
+        rule_set = self.rule_set_for(sender)
+        for pattern in self.supplier_rules.get(rule_set, []):
+            match = pattern.search(text)
+            if match:
+                return (match.group(1) if match.groups() else match.group(0)).strip()
+
+        # Every regex only runs inside the short windows around a keyword, so time stays linear in the text
+        hits = [hit.start() for hit in KEYWORD.finditer(text)]
+        for name, word, pattern, ends_with_word in self.rules:
+            for hit in hits:
+                if not text.startswith(word, hit):
+                    continue
+                start, end = self._window(text, hit, word, ends_with_word)
+                match = pattern.search(text, start, end)
+                if match:
+                    logging.debug(f"Invoice number matched rule {name}")
+                    return match.group(1).strip()
+        return None
+
+
+_default_engine = None
+
+
+# Function to get the engine with the built-in rules and the supplier rules of config.py
+def get_default_engine():
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = InvoicePatternEngine(DEFAULT_RULES, SUPPLIER_INVOICE_PATTERNS)
+    return _default_engine
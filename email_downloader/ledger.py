@@ -0,0 +1,149 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+# Compact when the file holds this many times more lines than there are records
+COMPACT_RATIO = 2
+# Never compact small files, rewriting them would cost more than it saves
+COMPACT_MIN_LINES = 1000
+
+
+# Function to get the identity of an email record (Message-ID, or Date + sender for old records)
+def record_key(email_data):
+    message_id = email_data.get("Message_ID")
+    if message_id:
+        return message_id
+    return f"{email_data.get('Date')}|{email_data.get('Email')}"
+
+
+# Append-only JSON Lines store of email records with an in-memory index
+class EmailLedger:
+    def __init__(self, path):
+        self.path = Path(path)
+        self.index = {}
+        self.line_count = 0
+        self._lock = threading.Lock()
+        self._load()
+
+    # Function to replay the ledger into the index, the last line of a record wins
+    def _load(self):
+        if not self.path.exists():
+            return
+        good_size = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    # Half written line from a crash, it is cut off below
+                    logging.warning(f"Dropping incomplete last line of {self.path}")
+                    break
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    logging.warning(f"Skipping unreadable line in {self.path}")
+                    good_size += len(line)
+                    continue
+                self.index[record_key(record)] = record
+                self.line_count += 1
+                good_size += len(line)
+        if good_size < self.path.stat().st_size:
+            os.truncate(self.path, good_size)
+
+    # Function to append one record as a single write, so a crash can only lose that line
+    def _append(self, record):
+        line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.line_count += 1
+
+    # Function to add a record or update the attachments and invoice number of an existing one
+    def upsert(self, email_data):
+        with self._lock:
+            key = record_key(email_data)
+            record = self.index.get(key)
+            if record is None:
+                record = dict(email_data)
+            else:
+                record = dict(record)
+                record["Attachments"] = email_data.get("Attachments", record.get("Attachments"))
+                record["Invoice_number"] = email_data.get("Invoice_number", record.get("Invoice_number"))
+            self.index[key] = record
+            self._append(record)
+
+            if self.line_count > max(COMPACT_MIN_LINES, COMPACT_RATIO * len(self.index)):
+                self._compact()
+            return record
+
+    def get(self, email_data):
+        return self.index.get(record_key(email_data))
+
+    def records(self):
+        with self._lock:
+            return list(self.index.values())
+
+    # Function to rewrite the ledger with one line per record
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in self.index.values():
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.line_count = len(self.index)
+        logging.info(f"Compacted {self.path} to {self.line_count} records.")
+
+    # Function to import the records of the old email_info.json (a JSON array)
+    def migrate_from_json(self, json_file):
+        try:
+            with open(json_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logging.error(f"Could not migrate {json_file}: {e}")
+            return None
+        with self._lock:
+            for entry in data:
+                self.index[record_key(entry)] = entry
+            self._compact()
+        return len(data)
+
+    # Function to write all records as a JSON array, the format of the old email_info.json
+    def export_json(self, json_file):
+        records = self.records()
+        tmp_file = f"{json_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(records, f, indent=4, ensure_ascii=False)
+        os.replace(tmp_file, json_file)
+
+
+_ledgers = {}
+_ledgers_lock = threading.Lock()
+
+
+# Function to get the ledger that replaces a JSON file, migrating the JSON file on first use
+def get_ledger(json_file):
+    json_file = Path(json_file)
+    ledger_file = json_file.with_suffix(".jsonl")
+    with _ledgers_lock:
+        ledger = _ledgers.get(ledger_file)
+        if ledger is None:
+            ledger_file.parent.mkdir(parents=True, exist_ok=True)
+            migrate = json_file.exists() and not ledger_file.exists()
+            ledger = EmailLedger(ledger_file)
+            if migrate:
+                count = ledger.migrate_from_json(json_file)
+                if count is not None:
+                    # Keep the old file next to the ledger, it is no longer updated
+                    os.replace(json_file, json_file.with_name(json_file.name + ".migrated"))
+                    logging.info(f"Migrated {count} records from {json_file} to {ledger_file}")
+            _ledgers[ledger_file] = ledger
+        return ledger
@@ -1,6 +1,13 @@
 # main.py
 
-from gui import start_app
+import sys
 
 if __name__ == "__main__":
+    if "--headless" in sys.argv:
+        # The service never imports tkinter, it runs on servers without a display
+        from daemon import main, parse_args
+        args = parse_args([arg for arg in sys.argv[1:] if arg != "--headless"])
+        sys.exit(main(args.config, args.asyncio, args.check_threads, args.metrics_port))
+
+    from gui import start_app
     start_app()
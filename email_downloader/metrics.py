@@ -0,0 +1,290 @@
+import bisect
+import functools
+import logging
+import multiprocessing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from config import METRICS_PORT, METRICS_SUMMARY_INTERVAL
+
+PREFIX = "email_downloader_"
+
+# Upper bounds of the histogram buckets, every histogram also has +Inf
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+BYTES_BUCKETS = tuple(1024 * 4 ** i for i in range(11))  # 1 KB to 1 GB
+PAGES_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100, 500)
+
+# Known metrics: name -> (type, help text, buckets of a histogram)
+METRICS = {
+    "function_seconds": ("histogram", "Time spent in an instrumented function.", LATENCY_BUCKETS),
+    "function_errors_total": ("counter", "Calls of an instrumented function that raised an exception.", None),
+    "attachment_bytes": ("histogram", "Size of the downloaded attachments.", BYTES_BUCKETS),
+    "pdf_pages": ("histogram", "Pages of the PDFs that were read or written.", PAGES_BUCKETS),
+    "messages_total": ("counter", "Emails recorded.", None),
+    "attachments_total": ("counter", "Attachments downloaded.", None),
+    "invoices_found_total": ("counter", "PDFs in which an invoice number was found.", None),
+    "invoices_missed_total": ("counter", "PDFs without an invoice number.", None),
+    "files_moved_total": ("counter", "Files renamed and moved to the Re_Erledigt folder.", None),
+}
+
+
+# Counters and histograms of this process, keyed by (name, labels)
+# Worker processes keep their own and send them to the parent after every task
+class MetricsRegistry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}  # key -> [count per bucket (the last one is +Inf), sum]
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        self.observe_key((name, tuple(sorted(labels.items()))), value, METRICS[name][2])
+
+    def observe_key(self, key, value, buckets):
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(buckets) + 1), 0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+
+    # Function to take everything recorded so far and start again from zero
+    def take(self):
+        with self.lock:
+            counters, self.counters = self.counters, {}
+            histograms, self.histograms = self.histograms, {}
+        return counters, histograms
+
+    # Function to add what another process recorded (see take)
+    def merge(self, delta):
+        counters, histograms = delta
+        with self.lock:
+            for key, value in counters.items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, (counts, total) in histograms.items():
+                histogram = self.histograms.setdefault(key, [[0] * len(counts), 0])
+                histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+                histogram[1] += total
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters), {key: [list(counts), total] for key, (counts, total) in self.histograms.items()}
+
+    # Function to write the metrics in the Prometheus text format
+    def render(self):
+        counters, histograms = self.snapshot()
+        lines = []
+        for name, (kind, help_text, buckets) in METRICS.items():
+            lines.append(f"# HELP {PREFIX}{name} {help_text}")
+            lines.append(f"# TYPE {PREFIX}{name} {kind}")
+            if kind == "counter":
+                for (key_name, labels), value in sorted(counters.items()):
+                    if key_name == name:
+                        lines.append(f"{PREFIX}{name}{format_labels(labels)} {value}")
+                continue
+            for (key_name, labels), (counts, total) in sorted(histograms.items()):
+                if key_name != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + ("+Inf",), counts):
+                    cumulative += count
+                    lines.append(f"{PREFIX}{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{PREFIX}{name}_sum{format_labels(labels)} {total}")
+                lines.append(f"{PREFIX}{name}_count{format_labels(labels)} {cumulative}")
+        return "\n".join(lines) + "\n"
+
+
+# Function to escape a label value for the text format
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+# Function to format labels like {function="email_handler.check_inbox"}
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{escape_label(value)}"' for key, value in labels) + "}"
+
+
+# Function to estimate a quantile from the bucket counts, linear inside the bucket like Prometheus does
+def histogram_quantile(quantile, buckets, counts):
+    total = sum(counts)
+    if not total:
+        return None
+    rank = quantile * total
+    seen = 0
+    for i, count in enumerate(counts):
+        if seen + count >= rank and count:
+            if i == len(buckets):
+                # Above the last bound, the last bound is all that is known
+                return buckets[-1]
+            lower = buckets[i - 1] if i else 0
+            return lower + (buckets[i] - lower) * (rank - seen) / count
+        seen += count
+    return buckets[-1]
+
+
+_registry = MetricsRegistry()
+_calls = threading.local()
+_parent_queue = None  # Set in worker processes, the metrics of every task go there
+
+
+def get_registry():
+    return _registry
+
+
+def inc(name, amount=1, **labels):
+    _registry.inc(name, amount, **labels)
+
+
+def observe(name, value, **labels):
+    _registry.observe(name, value, **labels)
+
+
+# Function to create the queue the workers of one pool send their metrics to, read by a thread of this process
+# Every pool gets its own: a worker killed in the middle of a put can only leave the queue of its pool
+# broken, and that queue is discarded with the pool (see discard_worker_queue)
+def new_worker_queue():
+    queue = multiprocessing.Queue()
+    threading.Thread(target=_receive_worker_metrics, args=(queue,), name="metrics", daemon=True).start()
+    return queue
+
+
+# Function to stop reading the queue of a pool that was shut down or killed
+def discard_worker_queue(queue):
+    try:
+        queue.put(None)
+    except (OSError, ValueError):
+        pass
+    # Never wait for the queue at exit, its reader may be stuck on the half message of a killed worker
+    queue.cancel_join_thread()
+
+
+def _receive_worker_metrics(queue):
+    while True:
+        try:
+            delta = queue.get()
+        except (EOFError, OSError, ValueError):
+            return
+        except Exception as e:
+            logging.error(f"Error receiving worker metrics: {e}")
+            continue
+        if delta is None:
+            break
+        _registry.merge(delta)
+    queue.close()
+
+
+# Initializer of the worker processes: send the metrics to the parent
+def init_metrics_worker(queue):
+    global _parent_queue
+    _parent_queue = queue
+    # A forked worker starts with a copy of the parent's metrics (and maybe of a held lock), they are not its own
+    _registry.lock = threading.Lock()
+    _registry.take()
+    _calls.depth = 0
+
+
+# Function to record one call of an instrumented function or block
+# The outermost call in a worker process sends the metrics of the task to the parent
+def _record_call(key, seconds):
+    _registry.observe_key(key, seconds, LATENCY_BUCKETS)
+    _calls.depth -= 1
+    if not _calls.depth and _parent_queue is not None:
+        _parent_queue.put(_registry.take())
+
+
+# Decorator that records the time of every call of a function in function_seconds, errors in function_errors_total
+# Labelled module.qualname, several modules have functions of the same name
+def timed(fn):
+    name = f"{fn.__module__}.{fn.__qualname__}"
+    key = ("function_seconds", (("function", name),))
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        _calls.depth = getattr(_calls, "depth", 0) + 1
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        except Exception:
+            inc("function_errors_total", function=name)
+            raise
+        finally:
+            _record_call(key, time.perf_counter() - start)
+    return wrapper
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+        body = _registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # A scrape every few seconds would fill the log
+        pass
+
+
+# Function to serve the metrics on http://host:port/metrics in a background thread
+def start_metrics_server(port=METRICS_PORT, host="127.0.0.1"):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+# Function to get the lines of a summary of what changed between two snapshots
+def summary_lines(before, after):
+    counters_before, histograms_before = before
+    counters, histograms = after
+    lines = []
+    for (name, labels), (counts, total) in sorted(histograms.items()):
+        if name != "function_seconds":
+            continue
+        previous_counts, previous_total = histograms_before.get((name, labels), [[0] * len(counts), 0])
+        counts = [a - b for a, b in zip(counts, previous_counts)]
+        calls = sum(counts)
+        if not calls:
+            continue
+        total -= previous_total
+        p95 = histogram_quantile(0.95, LATENCY_BUCKETS, counts)
+        lines.append(f"{dict(labels)['function']}: {calls} calls, {total:.2f} s total, "
+                     f"{total / calls * 1000:.1f} ms mean, {p95 * 1000:.1f} ms p95")
+    changed = []
+    for key, value in sorted(counters.items()):
+        delta = value - counters_before.get(key, 0)
+        if delta and key[0] != "function_errors_total":
+            changed.append(f"{key[0].replace('_total', '')}{format_labels(key[1])} +{delta}")
+        elif delta:
+            changed.append(f"errors in {dict(key[1])['function']} +{delta}")
+    if changed:
+        lines.append(", ".join(changed))
+    return lines
+
+
+# Function to log a summary of the last interval every interval seconds, nothing when nothing happened
+def start_summary_logger(interval=METRICS_SUMMARY_INTERVAL):
+    def run():
+        before = _registry.snapshot()
+        while True:
+            time.sleep(interval)
+            after = _registry.snapshot()
+            lines = summary_lines(before, after)
+            if lines:
+                logging.info(f"Metrics of the last {interval} s:\n  " + "\n  ".join(lines))
+            before = after
+
+    thread = threading.Thread(target=run, name="metrics-summary", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,160 @@
+import argparse
+import asyncio
+import imaplib
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from config import (EMAIL_PROVIDERS, POLL_INTERVAL, IDLE_REARM_INTERVAL, IMAP_RECONNECT_DELAY,
+                    IMAP_RECONNECT_MAX_DELAY)
+from aio_imap import AsyncImapClient, SyncImapClient
+from email_handler import check_inbox
+from idle_watcher import watch_inbox
+from imap_connection import ImapConnection
+from worker_pool import get_worker_pool
+
+# JSON file shared by all accounts, records are told apart by the sender and date
+JSON_FILE = Path("data/email_info.json")
+
+
+# Function to load the list of accounts to monitor from the accounts file
+def load_accounts(config_file):
+    with open(config_file, "r", encoding="utf-8") as f:
+        config = json.load(f)
+
+    accounts = []
+    for entry in config.get("accounts", []):
+        # A server of its own (with port and ssl) can be given instead of a known provider
+        server = entry.get("server") or EMAIL_PROVIDERS.get(entry.get("provider"))
+        if not server:
+            logging.error(f"Unknown provider {entry.get('provider')} for {entry.get('email')}, skipping.")
+            continue
+
+        # Passwords can be kept out of the file by naming an environment variable
+        password = entry.get("password") or os.environ.get(entry.get("password_env", ""), "")
+        if not password:
+            logging.error(f"No password for {entry.get('email')}, skipping.")
+            continue
+
+        accounts.append({
+            "email": entry["email"],
+            "provider": entry.get("provider") or server,
+            "server": server,
+            "port": entry.get("port", 993),
+            "ssl": entry.get("ssl", True),
+            "password": password,
+            "folder": Path(entry["folder"])
+        })
+    return accounts, config.get("workers")
+
+
+# Function to run the sync loop of one account, watch_inbox reconnects when the connection drops
+def run_account(account, executor):
+    connection = ImapConnection(account["server"], account["email"], account["password"], account["port"],
+                                account["ssl"])
+    while True:
+        try:
+            watch_inbox(connection, account["folder"], JSON_FILE, account["email"], executor=executor)
+        except Exception as e:
+            logging.error(f"Sync loop of {account['email']} failed: {e}")
+        finally:
+            connection.close()
+        logging.info(f"Restarting {account['email']} in {POLL_INTERVAL} seconds...")
+        time.sleep(POLL_INTERVAL)
+
+
+# Function to watch one account on the event loop, reconnecting with backoff when the connection drops
+# Waiting in IDLE is a coroutine, only an inbox check takes a thread of check_pool
+async def watch_account_async(account, executor, check_pool):
+    loop = asyncio.get_running_loop()
+    delay = IMAP_RECONNECT_DELAY
+    while True:
+        client = AsyncImapClient(account["server"], account["port"], account["ssl"])
+        try:
+            await client.connect()
+            await client.login(account["email"], account["password"])
+            delay = IMAP_RECONNECT_DELAY
+            typ, data = await client.capability()
+            use_idle = 'IDLE' in (data[0] or b'').decode().upper().split()
+            # check_inbox is blocking code, its IMAP commands come back to this loop through the wrapper
+            mail = SyncImapClient(client)
+            while True:
+                await loop.run_in_executor(check_pool, check_inbox, mail, account["folder"], JSON_FILE,
+                                           account["email"], executor)
+                if not use_idle:
+                    await asyncio.sleep(POLL_INTERVAL)
+                    continue
+                try:
+                    # Nothing arrived means the IDLE is re-armed before the server times it out
+                    while not await client.idle(IDLE_REARM_INTERVAL):
+                        pass
+                except imaplib.IMAP4.abort:
+                    raise
+                except imaplib.IMAP4.error as e:
+                    logging.warning(f"IDLE failed for {account['email']}, falling back to polling: {e}")
+                    use_idle = False
+        except (imaplib.IMAP4.error, OSError, EOFError) as e:
+            logging.warning(f"Connection of {account['email']} lost ({e}), reconnecting in {delay} seconds.")
+        finally:
+            await client.close()
+        await asyncio.sleep(delay * random.uniform(0.8, 1.2))
+        delay = min(delay * 2, IMAP_RECONNECT_MAX_DELAY)
+
+
+# Function to watch all accounts from one event loop
+async def watch_accounts_async(accounts, executor, check_threads):
+    with ThreadPoolExecutor(max_workers=check_threads, thread_name_prefix="check") as check_pool:
+        await asyncio.gather(*(watch_account_async(account, executor, check_pool) for account in accounts))
+
+
+# Function to start the sync loop of every account in its own thread
+def start_account_threads(accounts, executor):
+    threads = []
+    for account in accounts:
+        account["folder"].mkdir(parents=True, exist_ok=True)
+        thread = threading.Thread(target=run_account, args=(account, executor), name=account["email"], daemon=True)
+        thread.start()
+        threads.append(thread)
+        logging.info(f"Monitoring {account['email']} ({account['provider']}) into {account['folder']}")
+    return threads
+
+
+# Function to monitor all accounts, each in its own thread (or all on one event loop), sharing one worker pool
+def main(config_file, use_asyncio=False, check_threads=4):
+    accounts, workers = load_accounts(config_file)
+    if not accounts:
+        logging.error("No accounts to monitor.")
+        return
+
+    executor = get_worker_pool(workers)
+    if use_asyncio:
+        for account in accounts:
+            account["folder"].mkdir(parents=True, exist_ok=True)
+            logging.info(f"Monitoring {account['email']} ({account['provider']}) into {account['folder']}")
+        try:
+            asyncio.run(watch_accounts_async(accounts, executor, check_threads))
+        except KeyboardInterrupt:
+            print("Exiting script.")
+        return
+
+    threads = start_account_threads(accounts, executor)
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        print("Exiting script.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Monitor several mailboxes at once.")
+    parser.add_argument("config_file", nargs="?", default="accounts.json")
+    parser.add_argument("--asyncio", action="store_true",
+                        help="watch all accounts from one event loop instead of one thread per account")
+    parser.add_argument("--check-threads", type=int, default=4,
+                        help="inbox checks running at the same time with --asyncio")
+    args = parser.parse_args()
+    main(args.config_file, args.asyncio, args.check_threads)
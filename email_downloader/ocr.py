@@ -0,0 +1,75 @@
+import logging
+import os
+from config import OCR_PAGES, OCR_DPI, OCR_LANGUAGE
+from extraction_cache import file_sha256, get_extraction_cache
+
+# Rule set under which the OCR text of a file is kept in the extraction cache
+OCR_RULE_SET = '#ocr'
+
+_run_ocr = True  # False in the extraction pool, OCR runs in its own pool there
+_tesseract = None
+
+
+# Raised by an extraction worker for a scan that needs OCR, the task is then run again in the OCR pool
+class OcrNeeded(Exception):
+    pass
+
+
+# Initializer of the worker processes: run OCR here or hand it on, keep Tesseract to one thread per process
+def init_ocr_worker(run_ocr):
+    global _run_ocr
+    _run_ocr = run_ocr
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+
+
+# Function to get pytesseract if it and the Tesseract program are installed, else None
+def get_tesseract():
+    global _tesseract
+    if _tesseract is None:
+        try:
+            import pytesseract
+            pytesseract.get_tesseract_version()
+            _tesseract = pytesseract
+        except Exception as e:
+            logging.warning(f"OCR not available, scans without text stay unread: {e}")
+            _tesseract = False
+    return _tesseract or None
+
+
+# Function to render the first pages of a PDF and read them with Tesseract
+# Rendering and OCR need a lot of CPU and memory, the OCR pool reads only OCR_MAX_CONCURRENT files at once
+def ocr_pages(pdf_file_path, pytesseract, max_pages=OCR_PAGES, dpi=OCR_DPI, language=OCR_LANGUAGE):
+    import pdfplumber
+    texts = []
+    with pdfplumber.open(pdf_file_path) as pdf:
+        for page in pdf.pages[:max_pages]:
+            try:
+                image = page.to_image(resolution=dpi).original.convert('L')
+            finally:
+                page.close()
+            texts.append(pytesseract.image_to_string(image, lang=language))
+    return '\n'.join(texts)
+
+
+# Function to get the OCR text of a scanned PDF, a file content is read with OCR only once
+def ocr_pdf_text(pdf_file_path):
+    pytesseract = get_tesseract()
+    if pytesseract is None:
+        return ''
+    try:
+        sha256 = file_sha256(pdf_file_path)
+        cache = get_extraction_cache()
+        cached = cache.get(sha256, OCR_RULE_SET)
+        if cached is not None:
+            return cached[0]
+        if not _run_ocr:
+            raise OcrNeeded(str(pdf_file_path))
+        logging.info(f"No text layer in {pdf_file_path}, running OCR.")
+        text = ocr_pages(pdf_file_path, pytesseract)
+    except OcrNeeded:
+        raise
+    except Exception as e:
+        logging.error(f"Error running OCR on {pdf_file_path}: {e}")
+        return ''
+    cache.put(sha256, text, None, OCR_RULE_SET)
+    return text
@@ -1,54 +1,168 @@
-import PyPDF2
 import logging
 import os
-import time
+from collections import deque
 from pathlib import Path
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+from file_handler import unique_file_path
+from metrics import timed, observe
 
-# Set to store processed files and avoid reprocessing
-processed_files = set()
 
-# Function to merge PDF attachments and delete original PDFs
+# Writer that copies the pages of other PDFs object by object straight into the output file
+# Only the object being copied is in memory, PdfMerger kept every page of every input until write()
+class StreamingPdfWriter:
+    def __init__(self, f):
+        self.f = f
+        self.offsets = []  # Offset of every object, the object number is the index + 1
+        self.page_refs = []
+        f.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        self.pages_ref = self._reserve()
+
+    def _reserve(self):
+        self.offsets.append(None)
+        return IndirectObject(len(self.offsets), 0, self)
+
+    def _write_object(self, ref, obj):
+        self.offsets[ref.idnum - 1] = self.f.tell()
+        self.f.write(b"%d 0 obj\n" % ref.idnum)
+        obj.write_to_stream(self.f, None)
+        self.f.write(b"\nendobj\n")
+
+    # Function to append all pages of a reader, returns the number of pages added
+    def add_reader(self, reader):
+        mapping = {}  # (idnum, generation) in the input -> reference in the output
+        queue = deque()
+
+        # Pages get their numbers first, so links between pages point to the copied pages
+        pages = list(reader.pages)
+        page_keys = set()
+        for page in pages:
+            ref = self._reserve()
+            if page.indirect_reference is not None:
+                key = (page.indirect_reference.idnum, page.indirect_reference.generation)
+                mapping[key] = ref
+                page_keys.add(key)
+            self.page_refs.append(ref)
+
+        def translate(obj):
+            if isinstance(obj, IndirectObject):
+                key = (obj.idnum, obj.generation)
+                if key not in mapping:
+                    target = obj.get_object()
+                    if isinstance(target, DictionaryObject) and target.get("/Type") == "/Pages":
+                        # The page tree of the input is replaced by the one of the output
+                        return self.pages_ref
+                    mapping[key] = self._reserve()
+                    queue.append((key, obj))
+                return mapping[key]
+            if isinstance(obj, StreamObject):
+                copy = obj.__class__()
+                copy._data = obj._data
+                for name, value in obj.items():
+                    copy[NameObject(name)] = translate(value)
+                return copy
+            if isinstance(obj, DictionaryObject):
+                copy = DictionaryObject()
+                for name, value in obj.items():
+                    copy[NameObject(name)] = translate(value)
+                return copy
+            if isinstance(obj, ArrayObject):
+                return ArrayObject(translate(value) for value in obj)
+            return obj
+
+        for page, ref in zip(pages, self.page_refs[-len(pages):]):
+            # Inherited attributes (Resources, MediaBox, ...) were already copied onto the page by the reader
+            copy = DictionaryObject()
+            for name, value in page.items():
+                if name != "/Parent":
+                    copy[NameObject(name)] = translate(value)
+            copy[NameObject("/Parent")] = self.pages_ref
+            self._write_object(ref, copy)
+
+            # Copy what the page uses, then let the reader forget it again
+            while queue:
+                key, indirect = queue.popleft()
+                if key in page_keys:
+                    continue
+                self._write_object(mapping[key], translate(indirect.get_object()))
+                reader.resolved_objects.pop((key[1], key[0]), None)
+        return len(pages)
+
+    # Function to write the page tree, the catalog, the cross-reference table and the trailer
+    def finish(self):
+        pages = DictionaryObject({
+            NameObject("/Type"): NameObject("/Pages"),
+            NameObject("/Kids"): ArrayObject(self.page_refs),
+            NameObject("/Count"): NumberObject(len(self.page_refs)),
+        })
+        self._write_object(self.pages_ref, pages)
+        catalog_ref = self._reserve()
+        self._write_object(catalog_ref, DictionaryObject({
+            NameObject("/Type"): NameObject("/Catalog"),
+            NameObject("/Pages"): self.pages_ref,
+        }))
+
+        xref = self.f.tell()
+        self.f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (len(self.offsets) + 1))
+        for offset in self.offsets:
+            self.f.write(b"%010d 00000 n \n" % offset)
+        self.f.write(b"trailer\n<< /Size %d /Root %d 0 R >>\nstartxref\n%d\n%%%%EOF\n"
+                     % (len(self.offsets) + 1, catalog_ref.idnum, xref))
+
+
+# Function to merge PDF attachments and delete the originals once the merged file is verified
+@timed
 def merge_email_attachments(pdf_files, output_filename):
     """Merges multiple PDF files into a single PDF and deletes the original files."""
-    merger = PyPDF2.PdfMerger()
-    merged_file_path = None
-    
+    # The same path twice would add its pages twice
+    pdf_files = [Path(pdf_file) for pdf_file in dict.fromkeys(map(str, pdf_files)) if pdf_file.lower().endswith('.pdf')]
+    if not pdf_files:
+        logging.warning("No PDF files to merge.")
+        return None
+
+    merged_file_path = unique_file_path(pdf_files[0].parent, output_filename)
+    tmp_path = merged_file_path.with_name(merged_file_path.name + ".tmp")
+    handles = []
     try:
-        for pdf_file in pdf_files:
-            pdf_file_path = Path(pdf_file)  # Ensure we're using Path
-            
-            if pdf_file_path.suffix == '.pdf':
-                # Check if the file has already been processed
-                if str(pdf_file_path) not in processed_files:
-                    merger.append(str(pdf_file_path))
-                    logging.info(f"Added {pdf_file_path} to the merger.")
-                    processed_files.add(str(pdf_file_path))  # Add to processed files
-                else:
-                    logging.info(f"File {pdf_file_path} already processed, skipping.")
-        
-        if pdf_files:
-            merged_file_path = pdf_file_path.parent / output_filename
-            with open(merged_file_path, 'wb') as f_out:
-                merger.write(f_out)
-            logging.info(f"Merged PDF saved as: {merged_file_path}")
-        else:
-            logging.warning("No PDF files to merge.")
-    
+        expected_pages = 0
+        with open(tmp_path, 'wb') as f_out:
+            writer = StreamingPdfWriter(f_out)
+            for pdf_file_path in pdf_files:
+                # The reader works on the open file and reads objects only when they are copied
+                handle = open(pdf_file_path, 'rb')
+                handles.append(handle)
+                reader = PdfReader(handle)
+                if reader.is_encrypted:
+                    reader.decrypt('')
+                expected_pages += writer.add_reader(reader)
+                logging.info(f"Added {pdf_file_path} to the merged PDF.")
+            writer.finish()
+            f_out.flush()
+            os.fsync(f_out.fileno())
+
+        # Check the result before anything is deleted (a path would make PdfReader load the whole file)
+        with open(tmp_path, 'rb') as f_check:
+            page_count = len(PdfReader(f_check).pages)
+        if page_count != expected_pages:
+            raise ValueError(f"merged PDF has {page_count} pages, expected {expected_pages}")
+        os.replace(tmp_path, merged_file_path)
+        observe("pdf_pages", page_count, function="merge_email_attachments")
+        logging.info(f"Merged PDF saved as: {merged_file_path}")
     except Exception as e:
-        logging.error(f"Error merging PDFs: {e}")
-    
+        logging.error(f"Error merging PDFs, keeping the originals: {e}")
+        if tmp_path.exists():
+            tmp_path.unlink()
+        return None
     finally:
-        # Close the merger to release file handles
-        merger.close()
-        
-        # Delete the original PDF files
-        for pdf_file in pdf_files:
-            pdf_file_path = Path(pdf_file)
-            if pdf_file_path.exists() and pdf_file_path.suffix == '.pdf':
-                try:
-                    pdf_file_path.unlink()  # This will delete the file
-                    logging.info(f"Deleted original PDF: {pdf_file_path}")
-                except Exception as e:
-                    logging.error(f"Error deleting PDF {pdf_file_path}: {e}")
+        for handle in handles:
+            handle.close()
+
+    # Delete the original PDF files
+    for pdf_file_path in pdf_files:
+        try:
+            pdf_file_path.unlink()
+            logging.info(f"Deleted original PDF: {pdf_file_path}")
+        except Exception as e:
+            logging.error(f"Error deleting PDF {pdf_file_path}: {e}")
 
     return merged_file_path
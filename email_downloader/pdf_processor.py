@@ -1,16 +1,25 @@
-import pdfplumber
 import re
 import os
 import json
 import shutil
 from pathlib import Path
-import pandas as pd
+from database import get_database
+from extraction_cache import extract_with_cache
+from pdf_text import extract_invoice_from_pdf
+from invoice_patterns import get_default_engine
+from worker_pool import parallel_map
+from config import EXTRACTION_TIMEOUT
+from file_handler import mark_files_processed
+from image_convert import is_image, convert_image_to_pdf
+from metrics import timed, inc, observe
 
 def sanitize_filename_for_windows(filename):
     sanitized = re.sub(r'[<>:"/\\|?*]', '_', filename)
     return sanitized
 
+@timed
 def extract_text_from_pdf(pdf_file_path):
+    import pdfplumber
     text = ''
     if not os.path.isfile(pdf_file_path):
         print(f"File does not exist: {pdf_file_path}")
@@ -22,6 +31,7 @@ def extract_text_from_pdf(pdf_file_path):
                 page_text = page.extract_text()
                 if page_text:
                     text += page_text + "\n"  # Ensure we separate pages with a newline
+            observe("pdf_pages", len(pdf.pages), function="extract_text_from_pdf")
         print("Full extracted text from PDF:")
         print(text)
     except Exception as e:
@@ -29,25 +39,20 @@ def extract_text_from_pdf(pdf_file_path):
     
     return text
 
-def extract_invoice_number(text):
-    patterns = [
-        r'Rechnungsnr\.?\s*:\s*([\w\d-]+)', 
-        r'Rechnung\s+(\d{4}/\d{4})', 
-        r'(?:Rechnung\s*Nr\.?|Rechnungs-Nr\.?|Rechnungsnummer)[\s:]*[-\s]*([\w\d-]+)',  
-        r'[\D]*(\d{8,})[\D]*Rechnungsnummer',  
-        r'(\d{8,})\s*[\s\S]*?Rechnungsnummer\s*[:\s]*',  
-        r'(\d{8,})\s*Rechnungsnummer\s*[:\s]*'
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.MULTILINE | re.DOTALL)
-        if match:
-            print(f"Found invoice number: {match.group(1).strip()}")  # Debugging output for found invoice number
-            return match.group(1).strip()  # Return the first matched invoice number
-    
+@timed
+def extract_invoice_number(text, sender=None):
+    invoice_number = get_default_engine().find(text, sender)
+    if invoice_number:
+        print(f"Found invoice number: {invoice_number}")  # Debugging output for found invoice number
+        return invoice_number
+
     print("No invoice number found.")  # Debugging output when no invoice number is found
     return None
 
+# Function to read the pages of a PDF until the invoice number is found
+def extract_invoice_text(pdf_file_path):
+    return extract_invoice_from_pdf(pdf_file_path, extract_invoice_number)
+
 def get_files_in_folder(folder_path):
     files = []
     for root, dirs, filenames in os.walk(folder_path):
@@ -56,13 +61,20 @@ def get_files_in_folder(folder_path):
                 files.append(os.path.join(root, filename))
     return files
 
-def extract_invoices_from_folder(folder_path):
+# Function to get the invoice number of one file, files parsed in an earlier run come from the cache
+@timed
+def extract_invoice_from_file(pdf_file_path):
+    text, invoice_number = extract_with_cache(pdf_file_path, extract_invoice_text)
+    inc("invoices_found_total" if invoice_number else "invoices_missed_total")
+    return invoice_number
+
+def extract_invoices_from_folder(folder_path, workers=None, timeout=EXTRACTION_TIMEOUT):
     invoices = []
     files = get_files_in_folder(folder_path)
 
-    for file in files:
-        text = extract_text_from_pdf(file)
-        invoice_number = extract_invoice_number(text)
+    # Files are parsed in parallel processes, a file that hangs is skipped after the timeout
+    invoice_numbers = parallel_map(extract_invoice_from_file, files, workers, timeout)
+    for file, invoice_number in zip(files, invoice_numbers):
         if invoice_number:
             invoices.append((file, invoice_number))
         else:
@@ -79,6 +91,7 @@ def display_invoices(invoices, filename_width=20):
             filename_base = filename_base[:filename_width - 3] + "..."
         print(f"{filename_base:<{filename_width}} {invoice_number:<25}")
 
+@timed
 def rename_and_move_files(invoices, folder_selected):
     re_erledigt_path = folder_selected.replace('re_', 'Re_Erledigt')
 
@@ -104,12 +117,38 @@ def rename_and_move_files(invoices, folder_selected):
                 
                 # Append information about the moved file
                 moved_files_info.append({'filename': new_name, 'location': re_erledigt_path, 'status': 'moved'})
+                get_database().record_move(new_name, str(file_path), destination_path, 'moved')
+                inc("files_moved_total")
             except Exception as e:
                 print(f"Error processing {file_path}: {e}")  # Handle any errors
 
     return moved_files_info
 
+# Function to extract, rename and move a batch of new files (called by the folder watcher)
+# Runs in the worker pool shared with the inbox checks, a file that hangs is skipped after the timeout
+def process_new_files(folder_selected, files, workers=None, timeout=EXTRACTION_TIMEOUT, executor=None):
+    # Scanned or photographed images are turned into PDFs first
+    images = [file for file in files if is_image(file)]
+    if images:
+        pdf_paths = dict(zip(images, parallel_map(convert_image_to_pdf, images, workers, timeout,
+                                                  executor=executor)))
+        # An image that could not be converted is kept, the extraction skips it and it is marked as processed
+        files = [pdf_paths.get(file) or file for file in files]
+        # So is an image with more pages than were converted
+        mark_files_processed(folder_selected, [os.path.basename(file) for file in images
+                                               if pdf_paths.get(file) and os.path.exists(file)])
+
+    invoice_numbers = parallel_map(extract_invoice_from_file, files, workers, timeout, executor=executor)
+    invoices = [(file, invoice_number) for file, invoice_number in zip(files, invoice_numbers) if invoice_number]
+    moved_files_info = rename_and_move_files(invoices, str(folder_selected)) if invoices else []
+
+    # Files without an invoice number stay in the folder, the manifest keeps them from being processed again
+    mark_files_processed(folder_selected, [os.path.basename(file) for file, invoice_number
+                                           in zip(files, invoice_numbers) if not invoice_number])
+    return moved_files_info
+
 def update_excel_file(folder_selected, moved_files_info):
+    import pandas as pd
     excel_path = os.path.join(folder_selected, 'email_info.xlsx')
 
     if os.path.exists(excel_path):
@@ -0,0 +1,64 @@
+import logging
+from config import INVOICE_SEARCH_PAGES, INVOICE_HEADER_FRACTION, OCR_MIN_TEXT_CHARS
+from ocr import ocr_pdf_text
+from metrics import observe
+
+
+# Function to yield the text of the pages of a PDF one by one, parsing a page only when it is reached
+def iter_page_texts(pdf, start=0, stop=None, header_fraction=None):
+    for page in pdf.pages[start:stop]:
+        try:
+            if header_fraction:
+                header = page.crop((0, 0, page.width, page.height * header_fraction))
+                yield page.page_number, header.extract_text() or '', True
+            yield page.page_number, page.extract_text() or '', False
+        finally:
+            # Drop the parsed layout of the page, long bundles would otherwise keep every page in memory
+            page.close()
+
+
+# Function to find the invoice number in the text layer of a PDF, stopping at the first page that gives a match
+def extract_invoice_from_text_layer(pdf_file_path, find_invoice_number, max_pages=INVOICE_SEARCH_PAGES,
+                                    header_fraction=INVOICE_HEADER_FRACTION):
+    # Imported here, pdfplumber is only loaded by the processes that parse PDFs
+    import pdfplumber
+    pages = []
+    try:
+        with pdfplumber.open(pdf_file_path) as pdf:
+            # First the header region and text of the first pages, matched again after every page
+            for page_number, text, is_header in iter_page_texts(pdf, 0, max_pages, header_fraction):
+                if is_header:
+                    candidate = '\n'.join(pages + [text])
+                else:
+                    pages.append(text)
+                    candidate = '\n'.join(pages)
+                invoice_number = find_invoice_number(candidate)
+                if invoice_number:
+                    logging.info(f"Found invoice number on page {page_number} of {pdf_file_path}")
+                    observe("pdf_pages", len(pages), function="extract_invoice_from_text_layer")
+                    return candidate, invoice_number
+
+            # Nothing on the first pages, fall back to the whole document
+            if max_pages is not None and len(pdf.pages) > max_pages:
+                for page_number, text, is_header in iter_page_texts(pdf, max_pages):
+                    pages.append(text)
+                text = '\n'.join(pages)
+                observe("pdf_pages", len(pages), function="extract_invoice_from_text_layer")
+                return text, find_invoice_number(text)
+    except Exception as e:
+        logging.error(f"Error reading {pdf_file_path}: {e}")
+    if pages:
+        observe("pdf_pages", len(pages), function="extract_invoice_from_text_layer")
+    return '\n'.join(pages), None
+
+
+# Function to find the invoice number of a PDF, scans without a usable text layer are read with OCR
+def extract_invoice_from_pdf(pdf_file_path, find_invoice_number, max_pages=INVOICE_SEARCH_PAGES,
+                             header_fraction=INVOICE_HEADER_FRACTION):
+    text, invoice_number = extract_invoice_from_text_layer(pdf_file_path, find_invoice_number, max_pages,
+                                                           header_fraction)
+    if invoice_number is None and len(text.strip()) < OCR_MIN_TEXT_CHARS:
+        ocr_text = ocr_pdf_text(pdf_file_path)
+        if ocr_text.strip():
+            return ocr_text, find_invoice_number(ocr_text)
+    return text, invoice_number
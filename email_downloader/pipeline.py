@@ -0,0 +1,51 @@
+import logging
+import threading
+import time
+from queue import Queue
+from config import PIPELINE_QUEUE_SIZE
+
+# Marker put into a queue after the last item
+STOP = object()
+
+
+# Function to create a bounded queue between two stages, put() blocks while the next stage is behind
+def stage_queue(maxsize=PIPELINE_QUEUE_SIZE):
+    return Queue(maxsize=maxsize)
+
+
+# Thread that takes items from its inbox, handles them and passes the results on to its outbox
+class Stage(threading.Thread):
+    def __init__(self, name, handle, inbox, outbox=None):
+        super().__init__(name=f"stage-{name}", daemon=True)
+        self.stage_name = name
+        # handle(item) returns an iterable of results for the next stage (or None)
+        self.handle = handle
+        self.inbox = inbox
+        self.outbox = outbox
+        self.count = 0
+        self.busy = 0.0
+
+    def run(self):
+        try:
+            while True:
+                item = self.inbox.get()
+                if item is STOP:
+                    break
+                start = time.perf_counter()
+                try:
+                    # A failing item is logged, the stage keeps running so the stages before it never block
+                    for result in self.handle(item) or ():
+                        if self.outbox is not None:
+                            self.outbox.put(result)
+                except Exception as e:
+                    logging.error(f"Error in {self.stage_name} stage: {e}")
+                self.busy += time.perf_counter() - start
+                self.count += 1
+        finally:
+            if self.outbox is not None:
+                self.outbox.put(STOP)
+
+    # Function to log how busy the stage was, the busiest stage limits the throughput
+    def log_stats(self):
+        if self.count:
+            logging.info(f"Stage {self.stage_name}: {self.count} items, {self.busy:.2f} s busy")
@@ -0,0 +1,69 @@
+import base64
+import binascii
+import quopri
+
+# Whitespace that may appear between base64 characters (line breaks every 76 chars)
+BASE64_WHITESPACE = b' \t\r\n'
+
+
+# Incremental base64 decoder, only keeps the last incomplete 4-character group
+class Base64StreamDecoder:
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, data):
+        data = self.pending + data.translate(None, BASE64_WHITESPACE)
+        usable = len(data) - len(data) % 4
+        self.pending = data[usable:]
+        return base64.b64decode(data[:usable])
+
+    def finish(self):
+        pending, self.pending = self.pending, b''
+        if not pending:
+            return b''
+        try:
+            # Some mailers drop the trailing "=" padding
+            return base64.b64decode(pending + b'=' * (-len(pending) % 4))
+        except binascii.Error:
+            return b''
+
+
+# Incremental quoted-printable decoder, works line by line
+class QuotedPrintableStreamDecoder:
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, data):
+        data = self.pending + data
+        cut = data.rfind(b'\n') + 1
+        if cut == 0:
+            # No complete line yet, only keep back an "=XX" escape that is cut in half
+            cut = len(data)
+            escape = data.rfind(b'=', max(cut - 2, 0))
+            if escape != -1:
+                cut = escape
+        self.pending = data[cut:]
+        return quopri.decodestring(data[:cut])
+
+    def finish(self):
+        pending, self.pending = self.pending, b''
+        return quopri.decodestring(pending)
+
+
+# Decoder for 7bit, 8bit and binary parts, which are stored as they are
+class IdentityStreamDecoder:
+    def feed(self, data):
+        return data
+
+    def finish(self):
+        return b''
+
+
+# Function to get a streaming decoder for a Content-Transfer-Encoding
+def make_stream_decoder(encoding):
+    encoding = (encoding or '').lower()
+    if encoding == 'base64':
+        return Base64StreamDecoder()
+    if encoding == 'quoted-printable':
+        return QuotedPrintableStreamDecoder()
+    return IdentityStreamDecoder()
@@ -0,0 +1,72 @@
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+
+# Default file that stores the IMAP sync state of every account
+SYNC_STATE_FILE = Path("data") / "sync_state.json"
+
+# Lock to avoid two threads rewriting the state file at the same time
+_state_lock = threading.Lock()
+
+
+# Function to read the whole sync state file
+def _read_state_file(state_file):
+    if not os.path.exists(state_file):
+        return {}
+    try:
+        with open(state_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError) as e:
+        logging.error(f"Error reading sync state {state_file}: {e}")
+        return {}
+
+
+# Function to load the sync state (UIDVALIDITY and last processed UID) of one account
+def load_sync_state(account, state_file=SYNC_STATE_FILE):
+    with _state_lock:
+        state = _read_state_file(state_file).get(account, {})
+    return {
+        "uidvalidity": state.get("uidvalidity"),
+        "last_uid": int(state.get("last_uid", 0))
+    }
+
+
+# Function to store the sync state of one account
+def save_sync_state(account, uidvalidity, last_uid, state_file=SYNC_STATE_FILE):
+    with _state_lock:
+        data = _read_state_file(state_file)
+        data[account] = {"uidvalidity": uidvalidity, "last_uid": int(last_uid)}
+
+        # Write to a temporary file first so a crash never leaves a half written state
+        Path(state_file).parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = f"{state_file}.tmp"
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(data, f, indent=4)
+        os.replace(tmp_file, state_file)
+
+
+# Watermark of one inbox check: the highest UID below which every message is completely processed
+# Messages finish out of order in the pipeline, a message that failed or is still running holds it back
+class UidWatermark:
+    def __init__(self, uids, last_uid):
+        self.uids = sorted(uids)
+        self.pending = set(uids)
+        # Value once every message is done: the old watermark, UIDNEXT - 1 or the highest UID of the check
+        self.last_uid = max([last_uid] + self.uids)
+        self._next = 0  # Index of the lowest UID that may still be pending
+
+    @property
+    def value(self):
+        while self._next < len(self.uids) and self.uids[self._next] not in self.pending:
+            self._next += 1
+        return self.uids[self._next] - 1 if self._next < len(self.uids) else self.last_uid
+
+    # Function to mark a message as done, returns True if the watermark moved
+    def done(self, uid):
+        if uid not in self.pending:
+            return False
+        before = self.value
+        self.pending.discard(uid)
+        return self.value > before
@@ -0,0 +1,235 @@
+import atexit
+import logging
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, CancelledError, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from config import WORKER_COUNT, EXTRACTION_TIMEOUT, OCR_MAX_CONCURRENT
+from ocr import OcrNeeded, init_ocr_worker
+from metrics import new_worker_queue, discard_worker_queue, init_metrics_worker
+
+
+# Executor wrapper that blocks submit() while too many tasks are queued or running
+# With a factory the executor can be restarted, which is how a hung task is stopped
+class BoundedExecutor:
+    def __init__(self, executor, max_pending, factory=None):
+        self.executor = executor
+        self.factory = factory
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._lock = threading.Lock()
+
+    def submit(self, fn, *args, **kwargs):
+        self._slots.acquire()
+        try:
+            with self._lock:
+                future = self.executor.submit(fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    # Function to kill the processes and start a fresh pool, unless that already happened for these futures
+    # The other tasks of the old pool fail with BrokenProcessPool (or are cancelled)
+    def restart(self, futures=()):
+        with self._lock:
+            if all(future.done() for future in futures) and not getattr(self.executor, '_broken', False):
+                return False
+            terminate_pool(self.executor)
+            self.executor = self.factory()
+            logging.warning("Restarted the worker pool.")
+            return True
+
+    # Results are returned in the order of the input, like Executor.map
+    def map(self, fn, *iterables):
+        futures = [self.submit(fn, *args) for args in zip(*iterables)]
+        return [future.result() for future in futures]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+
+_shared_pool = None
+_ocr_pool = None
+_pool_lock = threading.Lock()
+
+
+# Initializer of the worker processes: whether they run OCR, and the queue of the metrics
+def init_worker(run_ocr, metrics_queue):
+    init_ocr_worker(run_ocr)
+    init_metrics_worker(metrics_queue)
+
+
+# Process pool with a metrics queue of its own, discarded when the pool shuts down or is killed
+class WorkerProcessPool(ProcessPoolExecutor):
+    def __init__(self, workers, run_ocr=False):
+        self.metrics_queue = new_worker_queue()
+        super().__init__(max_workers=workers, initializer=init_worker, initargs=(run_ocr, self.metrics_queue))
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        super().shutdown(wait=wait, cancel_futures=cancel_futures)
+        discard_worker_queue(self.metrics_queue)
+
+
+# Function to start a process pool, the workers of the extraction pool leave OCR to the OCR pool
+def new_process_pool(workers, run_ocr=False):
+    return WorkerProcessPool(workers, run_ocr)
+
+
+# Function to get the worker pool shared by all accounts (created on first use)
+def get_worker_pool(workers=None):
+    global _shared_pool
+    with _pool_lock:
+        if _shared_pool is None:
+            workers = workers or WORKER_COUNT
+            # Processes, because pdfplumber and PyPDF2 are CPU bound and hold the GIL
+            _shared_pool = BoundedExecutor(new_process_pool(workers), max_pending=workers * 2,
+                                           factory=lambda: new_process_pool(workers))
+            atexit.register(_shared_pool.shutdown)
+            logging.info(f"Started shared worker pool with {workers} processes.")
+        return _shared_pool
+
+
+# Function to get the small pool that reads scans with OCR (created on first use)
+# Its size caps the OCR runs, an extraction worker never waits for OCR and is free for the next file
+def get_ocr_pool():
+    global _ocr_pool
+    with _pool_lock:
+        if _ocr_pool is None:
+            _ocr_pool = BoundedExecutor(new_process_pool(OCR_MAX_CONCURRENT, run_ocr=True),
+                                        max_pending=OCR_MAX_CONCURRENT * 2,
+                                        factory=lambda: new_process_pool(OCR_MAX_CONCURRENT, run_ocr=True))
+            atexit.register(_ocr_pool.shutdown)
+            logging.info(f"Started OCR pool with {OCR_MAX_CONCURRENT} processes.")
+        return _ocr_pool
+
+
+# Function to submit fn(*args), a pool that a crashed process broke is replaced by a fresh one first
+def submit_task(executor, fn, *args):
+    try:
+        return executor.submit(fn, *args)
+    except BrokenProcessPool:
+        executor.restart()
+        return executor.submit(fn, *args)
+
+
+# Function to wait for the result of fn(*args) submitted as future, a scan that needs OCR runs again in the OCR pool
+def task_result(executor, future, fn, *args, timeout=EXTRACTION_TIMEOUT):
+    try:
+        return _result_or_retry(executor, future, fn, args, timeout)
+    except OcrNeeded:
+        ocr_pool = get_ocr_pool()
+        return _result_or_retry(ocr_pool, submit_task(ocr_pool, fn, *args), fn, args, timeout)
+
+
+# Function to wait for a task like parallel_map does: its clock starts once the pool hands it to a process,
+# a task that runs longer than timeout is hung and the pool is restarted (TimeoutError),
+# a task that a crashed process or a restart took down is submitted once more
+def _result_or_retry(executor, future, fn, args, timeout):
+    retried = False
+    while True:
+        try:
+            while not future.running() and not future.done():
+                wait([future], timeout=1)
+            return future.result(timeout=timeout)
+        except TimeoutError:
+            if future.done():
+                raise
+            logging.error(f"Timeout after {timeout} s processing {args[0]}.")
+            if hasattr(executor, 'restart'):
+                executor.restart([future])
+            raise
+        except (BrokenProcessPool, CancelledError):
+            if retried:
+                raise
+            retried = True
+            if hasattr(executor, 'restart'):
+                executor.restart()
+            future = submit_task(executor, fn, *args)
+
+
+# Function to kill the processes of a pool, a hung task cannot be cancelled any other way
+def terminate_pool(pool):
+    processes = list((getattr(pool, '_processes', None) or {}).values())
+    pool.shutdown(wait=False, cancel_futures=True)
+    for process in processes:
+        if process.is_alive():
+            process.terminate()
+
+
+# Function to run fn over items in the shared worker pool (or executor), results in the order of the items
+# At most one task per worker is in flight and its clock starts once the pool hands it to a process,
+# so a task that runs longer than timeout is hung: the pool is restarted and its result is default.
+# Tasks that the restart (or a crashed process) took down are submitted once more,
+# scans that need OCR go on to the OCR pool once the others are done.
+def parallel_map(fn, items, workers=None, timeout=EXTRACTION_TIMEOUT, default=None, executor=None):
+    items = list(items)
+    results = [default] * len(items)
+    if not items:
+        return results
+    executor = executor or get_worker_pool(workers)
+    workers = max(1, min(workers or WORKER_COUNT, len(items)))
+
+    queue = list(range(len(items)))
+    queue.reverse()
+    needs_ocr = []
+    retried = set()
+    running = {}  # future -> [index, start time or None while it waits in the pool]
+    done_count = 0
+    next_report = 50
+    try:
+        while queue or running:
+            while queue and len(running) < workers:
+                index = queue.pop()
+                running[executor.submit(fn, items[index])] = [index, None]
+
+            done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+            for future in done:
+                index, _ = running.pop(future)
+                try:
+                    results[index] = future.result()
+                except OcrNeeded:
+                    needs_ocr.append(index)
+                    continue
+                except BrokenProcessPool as e:
+                    # A broken pool takes no more tasks, the first caller to notice starts a fresh one
+                    executor.restart()
+                    if index not in retried:
+                        retried.add(index)
+                        queue.append(index)
+                        continue
+                    logging.error(f"Error processing {items[index]}: {e}")
+                except Exception as e:
+                    logging.error(f"Error processing {items[index]}: {e}")
+                done_count += 1
+            if done and done_count >= next_report:
+                logging.info(f"Processed {done_count}/{len(items)} files.")
+                next_report = done_count + 50
+
+            now = time.monotonic()
+            for future, task in running.items():
+                if task[1] is None and future.running():
+                    task[1] = now
+            expired = [future for future, (index, started) in running.items()
+                       if started is not None and now - started > timeout]
+            if expired:
+                for future in expired:
+                    index, _ = running.pop(future)
+                    done_count += 1
+                    logging.error(f"Timeout after {timeout} s processing {items[index]}, skipping it.")
+                if executor.restart(expired):
+                    # The other tasks of the killed pool start again in the fresh one
+                    queue.extend(sorted((index for index, _ in running.values()), reverse=True))
+                    running.clear()
+    finally:
+        for future in running:
+            future.cancel()
+
+    if needs_ocr:
+        logging.info(f"Reading {len(needs_ocr)} scans with OCR.")
+        needs_ocr.sort()
+        ocr_results = parallel_map(fn, [items[index] for index in needs_ocr], OCR_MAX_CONCURRENT, timeout,
+                                   default, get_ocr_pool())
+        for index, result in zip(needs_ocr, ocr_results):
+            results[index] = result
+    return results
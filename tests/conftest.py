@@ -0,0 +1,52 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+# The modules import each other by their flat names, like when they are run from email_downloader/
+sys.path.insert(0, str(ROOT / "email_downloader"))
+sys.path.insert(0, str(ROOT / "benchmarks"))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty folder: data/ (index, cache, state) is created there and the shared
+    databases, ledgers and caches of earlier tests are forgotten."""
+    import database
+    import extraction_cache
+    import file_handler
+    import ledger
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(database, "_databases", {})
+    monkeypatch.setattr(extraction_cache, "_caches", {})
+    monkeypatch.setattr(ledger, "_ledgers", {})
+    monkeypatch.setattr(file_handler, "_indexed_excel_files", set())
+    monkeypatch.setattr(file_handler, "_indexed_ledgers", set())
+    monkeypatch.setattr(file_handler, "_dirty_excel_files", set())
+    (tmp_path / "data").mkdir()
+    return tmp_path
+
+
+@pytest.fixture
+def imap_server():
+    """Fake IMAP server on a free local port, add messages with server.mailbox.add(raw)."""
+    from fake_imap_server import FakeImapServer
+    server = FakeImapServer().start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def imap(imap_server):
+    """imaplib client logged in to the fake server."""
+    import imaplib
+    mail = imaplib.IMAP4("127.0.0.1", imap_server.port)
+    mail.login("test", "test")
+    yield mail
+    try:
+        mail.logout()
+    except Exception:
+        pass
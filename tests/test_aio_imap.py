@@ -0,0 +1,56 @@
+import asyncio
+import imaplib
+
+import pytest
+
+from aio_imap import AsyncImapClient, SyncImapClient, get_shared_loop
+
+
+# Scripted server: answers LOGIN and EXAMINE, a FETCH gets only half of its literal and then silence
+async def serve(reader, writer, commands):
+    writer.write(b"* OK ready\r\n")
+    while line := await reader.readline():
+        tag, command = line.split()[:2]
+        commands.append(command.decode())
+        if command == b"FETCH":
+            writer.write(b"* 1 FETCH (UID 1 BODY[1] {10}\r\n01234")
+        elif command == b"EXAMINE":
+            writer.write(b"* 1 EXISTS\r\n" + tag + b" OK [READ-ONLY] EXAMINE completed\r\n")
+        else:
+            writer.write(tag + b" OK done\r\n")
+        await writer.drain()
+
+
+async def start_server(commands):
+    server = await asyncio.start_server(lambda r, w: serve(r, w, commands), "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+def test_a_read_timeout_in_a_response_closes_the_connection():
+    async def run():
+        commands = []
+        server, port = await start_server(commands)
+        client = await AsyncImapClient("127.0.0.1", port, use_ssl=False, timeout=0.5).connect()
+        await client.login("user", "secret")
+        with pytest.raises(imaplib.IMAP4.abort):
+            await client.command("FETCH", "1", "BODY[1]", result="FETCH")
+        # The rest of the literal would be read as the next response, the client reconnects instead
+        with pytest.raises(imaplib.IMAP4.abort):
+            await client.noop()
+        assert commands == ["LOGIN", "FETCH"]
+        server.close()
+    asyncio.run(run())
+
+
+def test_sync_select_readonly_sends_examine():
+    commands = []
+    loop = get_shared_loop()
+    server, port = asyncio.run_coroutine_threadsafe(start_server(commands), loop).result()
+    try:
+        mail = SyncImapClient.connect("127.0.0.1", port, use_ssl=False, timeout=5)
+        typ, data = mail.select("inbox", readonly=True)
+        assert (typ, data) == ("OK", [b"1"])
+        assert commands == ["EXAMINE"]
+        mail.shutdown()
+    finally:
+        loop.call_soon_threadsafe(server.close)
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timezone
+
+import backfill
+import email_handler
+from backfill import Backfill, build_search_criteria
+from sync_state import load_sync_state
+
+
+def test_build_search_criteria():
+    assert build_search_criteria() == "ALL"
+    assert build_search_criteria(date(2024, 1, 5), date(2024, 3, 1), "1:5000") == \
+        "UID 1:5000 SINCE 05-Jan-2024 BEFORE 01-Mar-2024"
+
+
+def test_backfill_resumes_after_an_interrupted_batch(workdir, imap_server, monkeypatch):
+    from synthetic import build_message, text_pdf
+
+    date_sent = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(6):
+        pdf = text_pdf([[f"Rechnungsnr.: RE-{i:04d}"]])
+        imap_server.mailbox.add(build_message(f"Rechnung {i}", "a@lieferant.de", [(f"r{i}.pdf", pdf)], date_sent))
+    account = {"server": "127.0.0.1", "email": "test", "password": "test", "port": imap_server.port, "ssl": False}
+    re_dir = workdir / "re_test"
+    re_dir.mkdir()
+    json_file = workdir / "data" / "email_info.jsonl"
+    state_file = workdir / "data" / "backfill_state.json"
+
+    fetched = []
+    fetch = backfill.fetch_message_structures
+
+    def recording_fetch(mail, uids):
+        fetched.extend(uids)
+        return fetch(mail, uids)
+    monkeypatch.setattr(backfill, "fetch_message_structures", recording_fetch)
+
+    # The move of UID 3 fails after its batch (UIDs 3 and 4) was recorded
+    extract = email_handler.extract_invoice_from_file
+
+    def failing_extract(path, sender=None):
+        if path.name == "r2.pdf":
+            raise RuntimeError("worker died")
+        return extract(path, sender)
+    monkeypatch.setattr(email_handler, "extract_invoice_from_file", failing_extract)
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        Backfill(account, re_dir, json_file, executor, connections=1, batch_size=2,
+                 state_file=state_file).run("ALL")
+    assert load_sync_state("test backfill ALL", state_file)["last_uid"] == 2
+    assert (re_dir / "r2.pdf").exists()
+
+    # The next run starts at the failed message and finishes the rest
+    fetched.clear()
+    monkeypatch.setattr(email_handler, "extract_invoice_from_file", extract)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        Backfill(account, re_dir, json_file, executor, connections=1, batch_size=2,
+                 state_file=state_file).run("ALL")
+    assert fetched == [3, 4, 5, 6]
+    assert load_sync_state("test backfill ALL", state_file)["last_uid"] == 6
+    assert sorted(path.name for path in (workdir / "Re_Erledigttest").iterdir()) == [
+        f"RE-{i:04d}_r{i}.pdf" for i in range(6)]
+    assert not [path for path in re_dir.iterdir() if path.suffix == ".pdf"]
+    # The watermark of the normal sync is not touched
+    assert not (workdir / "data" / "sync_state.json").exists()
@@ -0,0 +1,36 @@
+from database import InvoiceDatabase
+
+EMAIL = {"Date": "Mon, 1 Jan 2024 08:00:00 +0000", "Email": "a@lieferant.de", "Subject": "Rechnung",
+         "Message_ID": "<1@lieferant.de>", "Attachments": ["r.pdf"], "Invoice_number": ''}
+
+
+def test_record_invoice_keeps_the_file_path(tmp_path):
+    database = InvoiceDatabase(tmp_path / "index.sqlite")
+    database.record_invoice(dict(EMAIL, Invoice_number="RE-1"), "RE-1", "/Re_Erledigt/RE-1_r.pdf")
+    # Saving the record again (Excel/JSON index) must not forget the path
+    database.upsert_message(dict(EMAIL, Invoice_number="RE-1"))
+    database.record_invoice(dict(EMAIL, Invoice_number="RE-1"), "RE-1")
+    [invoice] = database.find_invoice("RE-1", "a@lieferant.de")
+    assert invoice["file_path"] == "/Re_Erledigt/RE-1_r.pdf"
+
+
+def test_duplicate_of_is_kept_and_never_points_to_itself(tmp_path):
+    database = InvoiceDatabase(tmp_path / "index.sqlite")
+    reminder = dict(EMAIL, Message_ID="<2@lieferant.de>")
+    database.record_attachment(EMAIL, "r.pdf", "/re/r.pdf", "abc", 10)
+    original = database.find_attachment_by_hash("abc")
+    database.record_attachment(reminder, "r.pdf", None, "abc", 10, duplicate_of=original["id"])
+
+    # A message fetched again finds the other message's copy, never a row of its own
+    assert database.find_attachment_by_hash("abc", EMAIL) is None
+    assert database.find_attachment_by_hash("abc", reminder)["id"] == original["id"]
+    assert database.find_own_attachment(EMAIL, "abc")["path"] == "/re/r.pdf"
+    assert database.find_own_attachment(reminder, "abc") is None
+
+    # Recording the original again, even with its own id, does not make it a duplicate
+    database.record_attachment(EMAIL, "r.pdf", "/re/r.pdf", "abc", 10, duplicate_of=original["id"])
+    assert database.find_attachment_by_hash("abc")["id"] == original["id"]
+    # The duplicate keeps the original it was first matched with
+    database.record_attachment(reminder, "r.pdf", None, "abc", 10)
+    rows = database.connection.execute("SELECT id, duplicate_of FROM attachments ORDER BY id").fetchall()
+    assert [tuple(row) for row in rows] == [(original["id"], None), (original["id"] + 1, original["id"])]
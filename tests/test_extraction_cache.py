@@ -0,0 +1,38 @@
+import sqlite3
+
+import extraction_cache
+from extraction_cache import ExtractionCache, extract_with_cache
+
+
+def test_cache_evicts_the_least_recently_used_entries(tmp_path):
+    cache = ExtractionCache(tmp_path / "cache.sqlite", max_entries=3, max_bytes=10 ** 6)
+    for i in range(3):
+        cache.put(f"hash{i}", f"text {i}", f"RE-{i}")
+    cache.get("hash0")
+    cache.put("hash3", "text 3", "RE-3")
+    assert cache.get("hash1") is None
+    assert cache.get("hash0") == ("text 0", "RE-0")
+    assert cache._totals() == (3, 18)
+
+
+def test_cache_counts_only_when_the_estimate_is_over_a_limit(tmp_path):
+    cache = ExtractionCache(tmp_path / "cache.sqlite", max_entries=100, max_bytes=20)
+    queries = []
+    cache.connection.set_trace_callback(queries.append)
+    cache.put("hash0", "0123456789", None)
+    assert not [query for query in queries if "count(*)" in query]
+    # Replacing an entry overestimates the size, the exact count then finds nothing to evict
+    cache.put("hash0", "0123456789", None)
+    cache.put("hash0", "0123456789", None)
+    assert [query for query in queries if "count(*)" in query]
+    assert cache.get("hash0") == ("0123456789", None)
+    assert (cache._count, cache._total) == (1, 10)
+
+
+def test_a_locked_cache_falls_back_to_reading_the_file(tmp_path, monkeypatch):
+    def locked(cache_file):
+        raise sqlite3.OperationalError("database is locked")
+    monkeypatch.setattr(extraction_cache, "get_extraction_cache", locked)
+    pdf = tmp_path / "r.pdf"
+    pdf.write_bytes(b"%PDF-1.4")
+    assert extract_with_cache(pdf, lambda path: ("Rechnungsnr.: RE-1", "RE-1")) == ("Rechnungsnr.: RE-1", "RE-1")
@@ -0,0 +1,43 @@
+from file_handler import check_new_files, mark_files_processed
+
+
+def test_check_new_files_leaves_out_the_exports(workdir):
+    folder = workdir / "re_test"
+    folder.mkdir()
+    for name in ["r1.pdf", "email_info.xlsx", "email_info.jsonl", "~$email_info.xlsx", "r2.pdf.part"]:
+        (folder / name).write_bytes(b"x")
+    assert check_new_files(folder) == {"r1.pdf"}
+
+    mark_files_processed(folder, ["r1.pdf"])
+    # The export is written again after every cycle
+    (folder / "email_info.xlsx").write_bytes(b"xy")
+    assert check_new_files(folder) == set()
+
+
+def test_excel_export_is_written_from_the_database(workdir):
+    import time
+    from openpyxl import load_workbook
+    from file_handler import save_email_info, save_email_info_to_excel, start_excel_export_timer
+
+    folder = workdir / "re_test"
+    folder.mkdir()
+    excel_file = folder / "email_info.xlsx"
+    for i in range(3):
+        record = {"Date": f"Mon, {i + 1} Jan 2024 08:00:00 +0000", "Email": "a@lieferant.de",
+                  "Subject": f"Rechnung {i}", "Message_ID": f"<{i}@lieferant.de>",
+                  "Attachments": [f"r{i}.pdf"], "Invoice_number": f"RE-{i}" if i else ''}
+        save_email_info(record, workdir / "data" / "email_info.json")
+        save_email_info_to_excel(record, excel_file)
+    assert not excel_file.exists()
+
+    start_excel_export_timer(interval=0.1)
+    deadline = time.monotonic() + 10
+    while not excel_file.exists() and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+    workbook = load_workbook(excel_file, read_only=True)
+    rows = list(workbook.active.iter_rows(values_only=True))
+    workbook.close()
+    assert rows[0] == ("Date", "Email", "Subject", "Attachments", "Invoice_number")
+    assert [row[2:] for row in rows[1:]] == [
+        ("Rechnung 0", "['r0.pdf']", None), ("Rechnung 1", "['r1.pdf']", "RE-1"), ("Rechnung 2", "['r2.pdf']", "RE-2")]
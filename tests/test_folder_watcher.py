@@ -0,0 +1,53 @@
+import shutil
+import threading
+import time
+
+import pytest
+
+from folder_watcher import FolderWatcher, Inotify, is_pdf
+
+
+def test_is_pdf_skips_unfinished_downloads():
+    assert is_pdf("Rechnung.PDF") and is_pdf("scan.jpg")
+    assert not is_pdf("Rechnung.pdf.part") and not is_pdf("notes.txt")
+
+
+def test_inotify_hands_each_new_file_to_the_callback_once(workdir):
+    try:
+        Inotify().close()
+    except (OSError, AttributeError):
+        pytest.skip("inotify is not available")
+
+    folder = workdir / "watched"
+    outside = workdir / "outside"
+    folder.mkdir()
+    outside.mkdir()
+    calls = []
+    watcher = FolderWatcher(folder, calls.append, debounce=0.2)
+
+    def run():
+        # Removing the folder ends the watch with OSError
+        try:
+            watcher.run()
+        except OSError:
+            pass
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    time.sleep(0.2)
+
+    (folder / "written.pdf").write_bytes(b"%PDF-1.4 written in place")
+    (outside / "moved.pdf").write_bytes(b"%PDF-1.4 moved in")
+    (outside / "moved.pdf").rename(folder / "moved.pdf")
+    (folder / "ignored.txt").write_text("not an invoice")
+
+    deadline = time.monotonic() + 10
+    while sum(len(batch) for batch in calls) < 2 and time.monotonic() < deadline:
+        time.sleep(0.05)
+    # Nothing else arrives once the files are handed over
+    time.sleep(0.5)
+    assert sorted(path for batch in calls for path in batch) == [
+        str(folder / "moved.pdf"), str(folder / "written.pdf")]
+
+    shutil.rmtree(folder)
+    thread.join(timeout=5)
+    assert not thread.is_alive()
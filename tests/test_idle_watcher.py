@@ -0,0 +1,52 @@
+import imaplib
+import socket
+import threading
+import time
+
+from idle_watcher import idle_wait
+
+
+# Server that answers IDLE with the continuation and an EXISTS in the same packet
+def serve_one_client(listener, idle_answer):
+    conn, _ = listener.accept()
+    with conn:
+        conn.sendall(b"* OK [CAPABILITY IMAP4rev1 IDLE] ready\r\n")
+        reader = conn.makefile("rb")
+        while True:
+            line = reader.readline()
+            if not line:
+                return
+            tag, command = line.split()[:2]
+            if command.upper() == b"IDLE":
+                conn.sendall(idle_answer)
+                if reader.readline().strip() == b"DONE":
+                    conn.sendall(tag + b" OK IDLE terminated\r\n")
+            elif command.upper() == b"LOGOUT":
+                conn.sendall(b"* BYE\r\n" + tag + b" OK LOGOUT completed\r\n")
+                return
+            else:
+                conn.sendall(tag + b" OK done\r\n")
+
+
+def connect(idle_answer):
+    listener = socket.create_server(("127.0.0.1", 0))
+    threading.Thread(target=serve_one_client, args=(listener, idle_answer), daemon=True).start()
+    mail = imaplib.IMAP4("127.0.0.1", listener.getsockname()[1])
+    listener.close()
+    return mail
+
+
+def test_idle_sees_exists_sent_with_the_continuation():
+    mail = connect(b"+ idling\r\n* 4 EXISTS\r\n")
+    start = time.monotonic()
+    assert idle_wait(mail, 5) is True
+    assert time.monotonic() - start < 1
+    mail.logout()
+
+
+def test_idle_times_out_without_new_mail():
+    mail = connect(b"+ idling\r\n")
+    assert idle_wait(mail, 0.3) is False
+    # The connection is still usable after leaving IDLE
+    assert mail.noop()[0] == "OK"
+    mail.logout()
@@ -0,0 +1,34 @@
+import pdfplumber
+from PIL import Image
+
+from image_convert import convert_image_to_pdf
+from imap_fetch import is_attached_scan
+
+
+def write_tiff(path, pages):
+    frames = [Image.new("L", (800, 1100), 255 - i) for i in range(pages)]
+    frames[0].save(path, save_all=True, append_images=frames[1:])
+
+
+def test_tiff_pages_become_pdf_pages(tmp_path):
+    write_tiff(tmp_path / "scan.tif", 3)
+    pdf_path = convert_image_to_pdf(tmp_path / "scan.tif")
+    with pdfplumber.open(pdf_path) as pdf:
+        assert len(pdf.pages) == 3
+    assert not (tmp_path / "scan.tif").exists()
+
+
+def test_image_with_too_many_pages_is_kept(tmp_path):
+    write_tiff(tmp_path / "scan.tif", 4)
+    pdf_path = convert_image_to_pdf(tmp_path / "scan.tif", max_pages=2)
+    with pdfplumber.open(pdf_path) as pdf:
+        assert len(pdf.pages) == 2
+    assert (tmp_path / "scan.tif").exists()
+
+
+def test_only_attached_scans_are_converted():
+    scan = {"size": 400000, "bytes": 300000, "disposition": "attachment", "content_id": None}
+    assert is_attached_scan(scan)
+    # Logo sent as a file and referenced by the HTML, or a small icon
+    assert not is_attached_scan(dict(scan, disposition=None, content_id="<logo>"))
+    assert not is_attached_scan(dict(scan, bytes=3000))
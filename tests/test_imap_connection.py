@@ -0,0 +1,122 @@
+import imaplib
+import threading
+import time
+
+import pytest
+
+import imap_connection
+from config import IMAP_HEALTH_CHECK_INTERVAL, IMAP_RECONNECT_DELAY, IMAP_RECONNECT_MAX_DELAY
+from imap_connection import ImapConnection
+
+
+# Stand-in for imaplib.IMAP4_SSL, every instance is one connection to the server
+class FakeClient:
+    instances = []
+    failures = 0  # Connection attempts that fail before one works
+
+    def __init__(self, server, port=993, timeout=None):
+        if FakeClient.failures:
+            FakeClient.failures -= 1
+            raise ConnectionRefusedError("server down")
+        self.sock = None
+        self.noop_error = None  # Raised by noop() once set
+        self.logged_in = False
+        self.closed = False
+        FakeClient.instances.append(self)
+
+    def login(self, user, password):
+        self.logged_in = True
+
+    def noop(self):
+        if self.noop_error is not None:
+            raise self.noop_error
+        return 'OK', [b'NOOP completed']
+
+    def logout(self):
+        if self.closed:
+            raise imaplib.IMAP4.abort("socket error: EOF")
+        self.closed = True
+
+    def shutdown(self):
+        self.closed = True
+
+
+@pytest.fixture
+def fake_imap(monkeypatch):
+    FakeClient.instances = []
+    FakeClient.failures = 0
+    monkeypatch.setattr(imaplib, "IMAP4_SSL", FakeClient)
+    sleeps = []
+    test_thread = threading.current_thread()
+    real_sleep = time.sleep
+
+    # Only the waits of the test are recorded, threads left by other tests keep sleeping
+    def sleep(seconds):
+        if threading.current_thread() is test_thread:
+            sleeps.append(seconds)
+        else:
+            real_sleep(seconds)
+    monkeypatch.setattr(imap_connection.time, "sleep", sleep)
+    monkeypatch.setattr(imap_connection.random, "uniform", lambda low, high: 1.0)
+    return sleeps
+
+
+# Function to make a connection look idle for longer than the health check interval
+def idle(connection):
+    connection.last_used -= IMAP_HEALTH_CHECK_INTERVAL + 1
+
+
+@pytest.mark.parametrize("noop_error", [imaplib.IMAP4.abort("connection reset"), OSError("broken pipe"), EOFError()])
+def test_ensure_reconnects_when_noop_fails(fake_imap, noop_error):
+    connection = ImapConnection("imap.example.com", "a@example.com", "secret")
+    first = connection.ensure()
+    assert first.logged_in
+
+    # A recently used connection is trusted without a NOOP
+    first.noop_error = noop_error
+    assert connection.ensure() is first
+
+    idle(connection)
+    second = connection.ensure()
+    assert second is not first and second.logged_in
+    assert first.closed
+    assert fake_imap == []
+
+
+def test_abort_inside_the_block_reconnects_on_the_next_use(fake_imap):
+    connection = ImapConnection("imap.example.com", "a@example.com", "secret")
+    with pytest.raises(imaplib.IMAP4.abort):
+        with connection as mail:
+            first = mail
+            raise imaplib.IMAP4.abort("command: FETCH => socket error: EOF")
+    assert connection.mail is None and first.closed
+
+    with connection as mail:
+        assert mail is not first and mail.logged_in
+    assert len(FakeClient.instances) == 2
+
+
+def test_a_failed_command_keeps_the_connection(fake_imap):
+    connection = ImapConnection("imap.example.com", "a@example.com", "secret")
+    with pytest.raises(imaplib.IMAP4.error):
+        with connection as mail:
+            raise imaplib.IMAP4.error("SEARCH command error: BAD")
+    assert connection.mail is mail and not mail.closed
+
+
+def test_reconnect_backoff_doubles_up_to_the_cap(fake_imap):
+    FakeClient.failures = 12
+    connection = ImapConnection("imap.example.com", "a@example.com", "secret")
+    assert connection.reconnect().logged_in
+    expected = [min(IMAP_RECONNECT_DELAY * 2 ** attempt, IMAP_RECONNECT_MAX_DELAY) for attempt in range(12)]
+    assert fake_imap == expected
+    assert fake_imap[-2:] == [IMAP_RECONNECT_MAX_DELAY, IMAP_RECONNECT_MAX_DELAY]
+
+
+def test_reconnect_gives_up_after_max_attempts(fake_imap):
+    FakeClient.failures = 5
+    connection = ImapConnection("imap.example.com", "a@example.com", "secret")
+    with pytest.raises(ConnectionRefusedError):
+        connection.reconnect(max_attempts=3)
+    assert fake_imap == [IMAP_RECONNECT_DELAY, IMAP_RECONNECT_DELAY * 2]
+    assert FakeClient.instances == []
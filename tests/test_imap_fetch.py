@@ -0,0 +1,129 @@
+import email.utils
+from email.message import EmailMessage
+
+from imap_fetch import (build_uid_set, download_attachments, fetch_message_structures, iter_part_chunks,
+                        parse_envelope, parse_fetch_response, walk_bodystructure)
+
+
+# Function to build a message with an HTML body, a signature logo shown in it and the given attachments
+def message_with_logo(attachments):
+    msg = EmailMessage()
+    msg["Subject"] = "Rechnung"
+    msg["From"] = "Buchhaltung <rechnung@lieferant.de>"
+    msg["To"] = "re@example.com"
+    msg["Date"] = email.utils.formatdate()
+    msg["Message-ID"] = email.utils.make_msgid()
+    msg.set_content("Anbei die Rechnung.")
+    msg.add_alternative('<p>Anbei die Rechnung.</p><img src="cid:logo">', subtype="html")
+    html = msg.get_payload()[1]
+    html.add_related(b"\x89PNG logo", maintype="image", subtype="png", cid="<logo>", filename="image001.png",
+                     disposition="inline")
+    for filename, data, maintype, subtype in attachments:
+        msg.add_attachment(data, maintype=maintype, subtype=subtype, filename=filename)
+    return msg.as_bytes()
+
+
+def test_signature_logo_stays_on_the_server(imap_server, imap):
+    imap_server.mailbox.add(message_with_logo([
+        ("rechnung.pdf", b"%PDF-1.4 invoice", "application", "pdf"),
+        ("foto.jpg", b"\xff\xd8 photo", "image", "jpeg"),
+    ]))
+    imap.select("inbox")
+    [message] = fetch_message_structures(imap, [1])
+    assert [part["filename"] for part in message["parts"]] == ["rechnung.pdf", "foto.jpg"]
+
+
+def test_inline_pdf_is_still_downloaded():
+    # Some mail programs attach PDFs with an inline disposition
+    structure = [["text", "plain", ["charset", "utf-8"], None, None, "7bit", "5", "1", None, None, None, None],
+                 ["application", "pdf", ["name", "r.pdf"], None, None, "base64", "100", None,
+                  ["inline", ["filename", "r.pdf"]], None, None],
+                 ["image", "png", ["name", "logo.png"], None, None, "base64", "100", None,
+                  ["inline", ["filename", "logo.png"]], None, None],
+                 "mixed", None, None, None]
+    parts = {part["filename"]: part for part in walk_bodystructure(structure)}
+    from imap_fetch import is_wanted_attachment
+    assert is_wanted_attachment(parts["r.pdf"])
+    assert not is_wanted_attachment(parts["logo.png"])
+
+
+def test_image_under_related_with_attachment_disposition_is_kept():
+    structure = [["text", "html", ["charset", "utf-8"], None, None, "7bit", "5", "1", None, None, None, None],
+                 ["image", "jpeg", ["name", "scan.jpg"], "<scan>", None, "base64", "100", None,
+                  ["attachment", ["filename", "scan.jpg"]], None, None],
+                 ["image", "gif", ["name", "banner.gif"], "<banner>", None, "base64", "100", None, None, None, None],
+                 "related", None, None, None]
+    from imap_fetch import is_wanted_attachment
+    [html, scan, banner] = walk_bodystructure(structure)
+    assert scan["related"] and scan["content_id"] == "<scan>"
+    assert is_wanted_attachment(scan)
+    # Referenced from the HTML by its Content-ID, without a disposition
+    assert not is_wanted_attachment(banner)
+
+
+# IMAP connection that answers every FETCH with a flag update of another message first
+class UnsolicitedFetchMail:
+    def __init__(self, body):
+        self.body = body
+
+    def uid(self, command, uid_set, items):
+        data = [b"7 (FLAGS (\\Seen))"]
+        if "<" in items:
+            # Partial fetch of a large part
+            offset, size = map(int, items[items.index("<") + 1:items.index(">")].split("."))
+            chunk = self.body[offset:offset + size]
+        else:
+            chunk = self.body
+        data.append((b"1 (UID 5 BODY[2]" + (b"<%d>" % offset if "<" in items else b"") + b" {%d}" % len(chunk), chunk))
+        data.append(b")")
+        return "OK", data
+
+
+def test_download_ignores_unsolicited_fetch_responses(tmp_path):
+    part = {"section": "2", "encoding": "7bit", "size": 12, "filename": "r.pdf", "path": tmp_path / "r.pdf"}
+    download_attachments(UnsolicitedFetchMail(b"%PDF invoice"), [{"uid": 5, "parts": [part]}])
+    assert (tmp_path / "r.pdf").read_bytes() == b"%PDF invoice"
+    assert part["bytes"] == 12
+
+
+def test_streamed_part_ignores_unsolicited_fetch_responses():
+    body = bytes(range(256)) * 10
+    chunks = list(iter_part_chunks(UnsolicitedFetchMail(body), 5, "2", chunk_size=1000))
+    assert b"".join(chunks) == body
+
+
+def test_build_uid_set_joins_ranges():
+    assert build_uid_set([5, 1, 2, 3, 9, 10, 3]) == "1:3,5,9:10"
+
+
+def test_fetch_response_with_literals_and_nested_lists():
+    data = [(b'1 (UID 12 BODY[2] {5}', b'ab)"c'), b' FLAGS (\\Seen "x y"))']
+    [fields] = parse_fetch_response(data)
+    assert fields == {"UID": "12", "BODY[2]": b'ab)"c', "FLAGS": ["\\Seen", "x y"]}
+
+
+def test_envelope_with_encoded_subject():
+    [fields] = parse_fetch_response([
+        b'1 (UID 3 ENVELOPE ("Mon, 1 Jan 2024 08:00:00 +0100" "=?utf-8?q?Rechnung_f=C3=BCr_Januar?=" '
+        b'(("Buchhaltung" NIL "rechnung" "lieferant.de")) NIL NIL NIL NIL NIL NIL "<1@lieferant.de>"))'
+    ])
+    assert parse_envelope(fields["ENVELOPE"]) == {
+        "date": "Mon, 1 Jan 2024 08:00:00 +0100", "subject": "Rechnung für Januar",
+        "sender": "rechnung@lieferant.de", "message_id": "<1@lieferant.de>"}
+
+
+def test_bodystructure_sections_and_encoded_filenames():
+    [fields] = parse_fetch_response([
+        b'1 (UID 3 BODYSTRUCTURE ((("text" "plain" ("charset" "utf-8") NIL NIL "7bit" 10 1 NIL NIL NIL NIL)'
+        b'("text" "html" ("charset" "utf-8") NIL NIL "quoted-printable" 20 1 NIL NIL NIL NIL)'
+        b' "alternative" ("boundary" "b2") NIL NIL NIL)'
+        b'("application" "pdf" ("name" "r.pdf") NIL NIL "base64" 300 NIL'
+        b' ("attachment" ("filename*" "utf-8\'\'Rechnung%20M%C3%A4rz.pdf")) NIL NIL)'
+        b' "mixed" ("boundary" "b1") NIL NIL NIL))'
+    ])
+    parts = list(walk_bodystructure(fields["BODYSTRUCTURE"]))
+    assert [(part["section"], part["type"]) for part in parts] == [
+        ("1.1", "text/plain"), ("1.2", "text/html"), ("2", "application/pdf")]
+    pdf = parts[2]
+    assert (pdf["filename"], pdf["encoding"], pdf["size"], pdf["disposition"]) == (
+        "Rechnung März.pdf", "base64", 300, "attachment")
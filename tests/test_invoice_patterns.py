@@ -0,0 +1,105 @@
+import re
+
+import pytest
+
+from invoice_patterns import WINDOW_AFTER, WINDOW_BEFORE, InvoicePatternEngine
+
+# The patterns of extract_invoice_number before the rule engine, tried on the whole text in this order
+OLD_PATTERNS = [
+    r'Rechnungsnr\.?\s*:\s*([\w\d-]+)',
+    r'Rechnung\s+(\d{4}/\d{4})',
+    r'(?:Rechnung\s*Nr\.?|Rechnungs-Nr\.?|Rechnungsnummer)[\s:]*[-\s]*([\w\d-]+)',
+    r'[\D]*(\d{8,})[\D]*Rechnungsnummer',
+    r'(\d{8,})\s*[\s\S]*?Rechnungsnummer\s*[:\s]*',
+    r'(\d{8,})\s*Rechnungsnummer\s*[:\s]*',
+]
+
+
+def old_extract(text):
+    for pattern in OLD_PATTERNS:
+        match = re.search(pattern, text, re.MULTILINE | re.DOTALL)
+        if match:
+            return match.group(1).strip()
+    return None
+
+
+engine = InvoicePatternEngine()
+
+
+@pytest.mark.parametrize("rule, text, expected", [
+    ("rechnungsnr", "Kunde 4711\nRechnungsnr.: RE-000123\nDatum", "RE-000123"),
+    ("rechnungsnr", "Rechnungsnr : 2024-17", "2024-17"),
+    ("rechnung_jahr", "Ihre Rechnung 2024/0815 vom 3.1.", "2024/0815"),
+    ("rechnungsnummer", "Rechnung Nr. R0012345", "R0012345"),
+    ("rechnungsnummer", "Rechnungs-Nr. 2023-00042", "2023-00042"),
+    ("rechnungsnummer", "Rechnungsnummer: 00001234", "00001234"),
+    ("rechnungsnummer", "RechnungNr 77", "77"),
+    ("nummer_davor", "0123456789 Rechnungsnummer", "0123456789"),
+    ("nummer_im_umfeld", "Beleg 12345678 vom 1.1.2024\nRechnungsnummer", "12345678"),
+    ("priority", "Rechnung 2024/0001\nRechnungsnr.: RE-9", "RE-9"),
+    ("no keyword", "Lieferschein 12345678 vom 1.1.2024", None),
+    ("empty", "", None),
+])
+def test_built_in_rules(rule, text, expected):
+    assert engine.find(text) == expected
+
+
+# Texts where the engine must give what the old patterns gave
+@pytest.mark.parametrize("text", [
+    "Lieferant GmbH\nRechnungsnr.: RE-004711\nIBAN DE12345678901234567890",
+    "Rechnung 2021/0042\nZahlbar innerhalb von 14 Tagen",
+    "Kundennummer: 55555\nRechnung Nr. R0000042\nLieferdatum: 01.02.2024",
+    "Seite 1 von 2\n2023-00017 ist Ihre Rechnungs-Nr. 2023-00017",
+    "0000012345 Rechnungsnummer\nVielen Dank",
+    "Pos. Artikel 12345678901 Menge 2\nRechnungsnummer",
+])
+def test_same_result_as_the_old_patterns(text):
+    assert engine.find(text) == old_extract(text)
+
+
+def test_number_before_the_keyword_is_found_only_within_the_look_back():
+    # Old behaviour: any 8+ digit number before the keyword; now only WINDOW_BEFORE characters back
+    far = "12345678 " + "x" * (WINDOW_BEFORE + 50) + " Rechnungsnummer"
+    assert old_extract(far) == "12345678"
+    assert engine.find(far) is None
+
+
+@pytest.mark.parametrize("gap, expected", [
+    # The number ends right before the window: the window starts at a separator and misses it
+    (WINDOW_BEFORE, None),
+    # One character closer, the window would start inside the number and is widened to all of it
+    (WINDOW_BEFORE - 1, "0123456789"),
+])
+def test_look_back_window_edge(gap, expected):
+    text = "0123456789 " + "x" * gap + "Rechnungsnummer"
+    assert engine.find(text) == expected
+
+
+@pytest.mark.parametrize("spaces, expected", [
+    (WINDOW_AFTER - len("Rechnungsnummer:") - 5, "12345"),  # ends exactly at the window end
+    (WINDOW_AFTER - len("Rechnungsnummer:") - 4, "1234"),   # one character cut off by the window
+    (WINDOW_AFTER, None),                                    # starts after the window
+])
+def test_look_ahead_window_edge(spaces, expected):
+    assert engine.find("Rechnungsnummer:" + " " * spaces + "12345") == expected
+
+
+def test_supplier_rules_come_first_and_addresses_win_over_domains():
+    supplier_engine = InvoicePatternEngine(supplier_rules={
+        "lieferant.de": [r'^Beleg\s+(\S+)'],
+        "chef@lieferant.de": [r'^Vorgang\s+(\S+)'],
+        "Other.example": [r'KD-\d+'],
+    })
+    text = "Vorgang V-1\nBeleg B-2\nRechnungsnr.: RE-3"
+    assert supplier_engine.find(text, "buchhaltung@lieferant.de") == "B-2"
+    assert supplier_engine.find(text, "Chef@Lieferant.de") == "V-1"
+    assert supplier_engine.find(text, "a@fremd.de") == "RE-3"
+    assert supplier_engine.find(text) == "RE-3"
+    # A pattern without a group gives the whole match, no match falls back to the built-in rules
+    assert supplier_engine.find("Kunde KD-77", "x@other.example") == "KD-77"
+    assert supplier_engine.find("Rechnungsnr.: RE-4", "x@other.example") == "RE-4"
+
+    assert supplier_engine.rule_set_for("buchhaltung@lieferant.de") == "lieferant.de"
+    assert supplier_engine.rule_set_for("chef@lieferant.de") == "chef@lieferant.de"
+    assert supplier_engine.rule_set_for("a@fremd.de") == ''
+    assert supplier_engine.rule_set_for(None) == ''
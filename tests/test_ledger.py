@@ -0,0 +1,55 @@
+import json
+
+import ledger
+from ledger import EmailLedger, get_ledger
+
+RECORD = {"Date": "Mon, 1 Jan 2024 08:00:00 +0000", "Email": "a@lieferant.de", "Subject": "Rechnung",
+          "Message_ID": "<1@lieferant.de>", "Attachments": ["r.pdf"], "Invoice_number": ''}
+
+
+def test_upsert_updates_a_record_and_survives_a_reload(tmp_path):
+    store = EmailLedger(tmp_path / "email_info.jsonl")
+    store.upsert(RECORD)
+    store.upsert(dict(RECORD, Subject="changed", Invoice_number="RE-1"))
+    store.upsert(dict(RECORD, Message_ID=None))
+    assert len(store.records()) == 2
+
+    reloaded = EmailLedger(tmp_path / "email_info.jsonl")
+    record = reloaded.get(RECORD)
+    # Only the attachments and the invoice number of an existing record change
+    assert (record["Subject"], record["Invoice_number"]) == ("Rechnung", "RE-1")
+    assert reloaded.line_count == 3
+
+
+def test_half_written_last_line_is_dropped(tmp_path):
+    path = tmp_path / "email_info.jsonl"
+    store = EmailLedger(path)
+    store.upsert(RECORD)
+    with open(path, "ab") as f:
+        f.write(b'{"Message_ID": "<2@lief')
+    reloaded = EmailLedger(path)
+    assert [record["Message_ID"] for record in reloaded.records()] == ["<1@lieferant.de>"]
+    reloaded.upsert(dict(RECORD, Message_ID="<3@lieferant.de>"))
+    assert len(EmailLedger(path).records()) == 2
+
+
+def test_ledger_is_compacted(tmp_path, monkeypatch):
+    monkeypatch.setattr(ledger, "COMPACT_MIN_LINES", 4)
+    path = tmp_path / "email_info.jsonl"
+    store = EmailLedger(path)
+    for i in range(5):
+        store.upsert(dict(RECORD, Invoice_number=f"RE-{i}"))
+    assert len(path.read_text().splitlines()) == 1
+    assert EmailLedger(path).get(RECORD)["Invoice_number"] == "RE-4"
+
+
+def test_old_json_file_is_migrated(workdir):
+    json_file = workdir / "data" / "email_info.json"
+    json_file.write_text(json.dumps([RECORD, dict(RECORD, Message_ID="<2@lieferant.de>")]))
+    store = get_ledger(json_file)
+    assert len(store.records()) == 2
+    assert not json_file.exists() and (workdir / "data" / "email_info.json.migrated").exists()
+
+    store.export_json(json_file)
+    assert [record["Message_ID"] for record in json.loads(json_file.read_text())] == [
+        "<1@lieferant.de>", "<2@lieferant.de>"]
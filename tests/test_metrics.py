@@ -0,0 +1,53 @@
+import time
+
+import metrics
+from metrics import timed
+from worker_pool import new_process_pool, terminate_pool
+
+
+@timed
+def add(a, b):
+    return a + b
+
+
+def hang():
+    time.sleep(60)
+
+
+def calls_of(name):
+    counters, histograms = metrics.get_registry().snapshot()
+    histogram = histograms.get(("function_seconds", (("function", name),)))
+    return sum(histogram[0]) if histogram else 0
+
+
+# Function to wait until the metrics of the workers reached this process
+def wait_for_calls(name, count):
+    deadline = time.monotonic() + 10
+    while calls_of(name) < count and time.monotonic() < deadline:
+        time.sleep(0.05)
+    return calls_of(name)
+
+
+def test_timed_is_labelled_with_module_and_qualname():
+    before = calls_of("test_metrics.add")
+    assert add(1, 2) == 3
+    assert calls_of("test_metrics.add") == before + 1
+    assert "function_seconds_bucket{function=\"test_metrics.add\"" in metrics.get_registry().render()
+
+
+def test_worker_metrics_arrive_after_a_pool_was_killed():
+    before = calls_of("test_metrics.add")
+    pool = new_process_pool(2)
+    assert pool.submit(add, 1, 1).result(timeout=30) == 2
+    assert wait_for_calls("test_metrics.add", before + 1) == before + 1
+
+    pool.submit(hang)
+    time.sleep(0.5)
+    terminate_pool(pool)
+    # The killed pool's queue is given up, the next pool reports through a fresh one
+    pool = new_process_pool(2)
+    try:
+        assert pool.submit(add, 2, 2).result(timeout=30) == 4
+        assert wait_for_calls("test_metrics.add", before + 2) == before + 2
+    finally:
+        pool.shutdown()
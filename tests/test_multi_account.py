@@ -0,0 +1,17 @@
+import json
+
+from multi_account import load_accounts
+
+
+def test_load_accounts_with_a_server_instead_of_a_provider(tmp_path):
+    config = tmp_path / "accounts.json"
+    config.write_text(json.dumps({"workers": 2, "accounts": [
+        {"email": "rechnungen@example.com", "server": "imap.example.com", "port": 143, "ssl": False,
+         "password": "secret", "folder": "re_example"},
+        {"email": "other@example.com", "provider": "nowhere", "password": "secret", "folder": "re_other"},
+    ]}))
+    accounts, workers = load_accounts(config)
+    assert workers == 2
+    [account] = accounts
+    assert account["provider"] == account["server"] == "imap.example.com"
+    assert (account["port"], account["ssl"]) == (143, False)
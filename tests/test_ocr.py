@@ -0,0 +1,44 @@
+import os
+
+import pytest
+
+import ocr
+import worker_pool
+from worker_pool import BoundedExecutor, new_process_pool, parallel_map
+
+
+# Stands in for pytesseract, remembers the processes it ran in
+class FakeTesseract:
+    def __init__(self, folder):
+        self.folder = folder
+
+    def image_to_string(self, image, lang=None):
+        (self.folder / f"ocr_{os.getpid()}").touch()
+        return "Rechnungsnr.: RE-000123"
+
+
+@pytest.fixture
+def pools(monkeypatch):
+    extraction = BoundedExecutor(new_process_pool(2), max_pending=4, factory=lambda: new_process_pool(2))
+    monkeypatch.setattr(worker_pool, "_ocr_pool", None)
+    yield extraction
+    extraction.shutdown()
+    if worker_pool._ocr_pool is not None:
+        worker_pool._ocr_pool.shutdown()
+
+
+def test_scans_are_read_in_the_ocr_pool(workdir, pools, monkeypatch):
+    from email_handler import extract_invoice_from_file
+    from synthetic import scanned_pdf, text_pdf
+
+    fake = FakeTesseract(workdir)
+    monkeypatch.setattr(ocr, "get_tesseract", lambda: fake)
+    (workdir / "scan.pdf").write_bytes(scanned_pdf([["Rechnungsnr.: RE-000123"]]))
+    (workdir / "text.pdf").write_bytes(text_pdf([["Rechnungsnr.: RE-000456"]]))
+
+    results = parallel_map(extract_invoice_from_file, [workdir / "scan.pdf", workdir / "text.pdf"], executor=pools)
+    assert results == ["RE-000123", "RE-000456"]
+
+    # Only the processes of the OCR pool ran Tesseract
+    ocr_pids = {int(path.name[4:]) for path in workdir.glob("ocr_*")}
+    assert ocr_pids and ocr_pids <= set(worker_pool._ocr_pool.executor._processes)
@@ -0,0 +1,130 @@
+import pdfplumber
+from PyPDF2 import PdfReader, PdfWriter
+
+from pdf_handler import merge_email_attachments
+from synthetic import pdf_string, text_pdf
+
+
+# Function to serialise numbered objects into a PDF file, object 1 is the catalog
+def raw_pdf(objects):
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for number in sorted(objects):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + objects[number] + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(offsets) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(offsets) + 1, xref)
+    return bytes(out)
+
+
+def content(text):
+    data = b"BT /F1 11 Tf 50 790 Td " + pdf_string(text) + b" Tj ET"
+    return b"<< /Length %d >>\nstream\n" % len(data) + data + b"\nendstream"
+
+
+FONT = b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica /Encoding /WinAnsiEncoding >>"
+
+
+# Two pages whose font and media box are only given by the page tree
+def inherited_resources_pdf():
+    return raw_pdf({
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        2: b"<< /Type /Pages /Kids [4 0 R 6 0 R] /Count 2 /MediaBox [0 0 595 842] "
+           b"/Resources << /Font << /F1 3 0 R >> >> >>",
+        3: FONT,
+        4: b"<< /Type /Page /Parent 2 0 R /Contents 5 0 R >>",
+        5: content("Inherited 1"),
+        6: b"<< /Type /Page /Parent 2 0 R /Contents 7 0 R >>",
+        7: content("Inherited 2"),
+    })
+
+
+# Two pages, the first with a note and a link to the second
+def annotated_pdf():
+    resources = b"/MediaBox [0 0 595 842] /Resources << /Font << /F1 3 0 R >> >>"
+    return raw_pdf({
+        1: b"<< /Type /Catalog /Pages 2 0 R >>",
+        2: b"<< /Type /Pages /Kids [4 0 R 6 0 R] /Count 2 >>",
+        3: FONT,
+        4: b"<< /Type /Page /Parent 2 0 R /Contents 5 0 R /Annots [8 0 R 9 0 R] " + resources + b" >>",
+        5: content("Annotated 1"),
+        6: b"<< /Type /Page /Parent 2 0 R /Contents 7 0 R " + resources + b" >>",
+        7: content("Annotated 2"),
+        8: b"<< /Type /Annot /Subtype /Text /Rect [10 10 30 30] /Contents (Bitte zahlen) >>",
+        9: b"<< /Type /Annot /Subtype /Link /Rect [40 40 90 60] /Dest [6 0 R /Fit] >>",
+    })
+
+
+# Function to encrypt a PDF with an owner password only, it opens without a password
+def owner_encrypted(data, path):
+    plain = path.with_name("plain.pdf")
+    plain.write_bytes(data)
+    writer = PdfWriter()
+    for page in PdfReader(plain).pages:
+        writer.add_page(page)
+    writer.encrypt(user_password="", owner_password="geheim")
+    plain.unlink()
+    with open(path, "wb") as f:
+        writer.write(f)
+    return path
+
+
+def page_texts(path):
+    with pdfplumber.open(path) as pdf:
+        return [page.extract_text() for page in pdf.pages]
+
+
+def test_merge_keeps_every_page_and_its_text(tmp_path):
+    first = tmp_path / "a.pdf"
+    second = tmp_path / "b.pdf"
+    first.write_bytes(text_pdf([["Rechnungsnr.: RE-1"], ["Seite 2"]]))
+    second.write_bytes(text_pdf([["Lieferschein"]]))
+
+    merged = merge_email_attachments([first, second], "merged.pdf")
+    assert merged == tmp_path / "merged.pdf"
+    assert page_texts(merged) == ["Rechnungsnr.: RE-1", "Seite 2", "Lieferschein"]
+    assert not first.exists() and not second.exists()
+
+
+def test_merge_copies_resources_inherited_from_the_page_tree(tmp_path):
+    first = tmp_path / "a.pdf"
+    second = tmp_path / "b.pdf"
+    first.write_bytes(inherited_resources_pdf())
+    second.write_bytes(text_pdf([["Anlage"]]))
+
+    merged = merge_email_attachments([first, second], "merged.pdf")
+    assert page_texts(merged) == ["Inherited 1", "Inherited 2", "Anlage"]
+    for page in PdfReader(merged).pages[:2]:
+        assert "/F1" in page["/Resources"]["/Font"]
+        assert [float(value) for value in page.mediabox] == [0, 0, 595, 842]
+
+
+def test_merge_opens_owner_password_files_and_keeps_annotations(tmp_path):
+    encrypted = owner_encrypted(text_pdf([["Verschlüsselt"]]), tmp_path / "encrypted.pdf")
+    assert PdfReader(encrypted).is_encrypted
+    annotated = tmp_path / "annotated.pdf"
+    annotated.write_bytes(annotated_pdf())
+
+    merged = merge_email_attachments([encrypted, annotated], "merged.pdf")
+    assert page_texts(merged) == ["Verschlüsselt", "Annotated 1", "Annotated 2"]
+    reader = PdfReader(merged)
+    assert not reader.is_encrypted
+    note, link = [annotation.get_object() for annotation in reader.pages[1]["/Annots"]]
+    assert note["/Contents"] == "Bitte zahlen"
+    # The link points to the copied page, not into the input file
+    assert link["/Dest"][0].get_object() == reader.pages[2].get_object()
+
+
+def test_failed_merge_keeps_the_originals(tmp_path):
+    good = tmp_path / "a.pdf"
+    broken = tmp_path / "b.pdf"
+    good.write_bytes(text_pdf([["Rechnungsnr.: RE-1"]]))
+    broken.write_bytes(b"%PDF-1.4\nthis is no PDF")
+
+    assert merge_email_attachments([good, broken], "merged.pdf") is None
+    assert good.read_bytes() == text_pdf([["Rechnungsnr.: RE-1"]])
+    assert broken.exists()
+    assert sorted(path.name for path in tmp_path.iterdir()) == ["a.pdf", "b.pdf"]
@@ -0,0 +1,65 @@
+import re
+
+from pdf_text import extract_invoice_from_text_layer
+from synthetic import text_pdf
+
+
+# Function to write a PDF whose pages hold the given lines, "Seite n" is the first line of every page
+def write_pdf(path, pages):
+    path.write_bytes(text_pdf([[f"Seite {number}"] + lines for number, lines in enumerate(pages, 1)]))
+    return path
+
+
+# Finder that remembers every text it was asked about
+class Finder:
+    def __init__(self):
+        self.candidates = []
+
+    def __call__(self, text):
+        self.candidates.append(text)
+        match = re.search(r"Rechnungsnr\.: (\S+)", text)
+        return match.group(1) if match else None
+
+
+def test_stops_at_the_first_page_with_a_number(tmp_path):
+    path = write_pdf(tmp_path / "r.pdf", [["Rechnungsnr.: RE-1"], ["Rechnungsnr.: RE-2"], ["Anlage"]])
+    find = Finder()
+    text, number = extract_invoice_from_text_layer(path, find, max_pages=2)
+    assert number == "RE-1"
+    assert len(find.candidates) == 1
+    assert "Seite 2" not in text
+
+
+def test_number_after_the_first_pages_is_found_in_the_whole_document(tmp_path):
+    path = write_pdf(tmp_path / "r.pdf", [["Anschreiben"], ["Lieferschein"], ["Anlage"], ["Rechnungsnr.: RE-4"]])
+    find = Finder()
+    text, number = extract_invoice_from_text_layer(path, find, max_pages=2)
+    assert number == "RE-4"
+    # Page by page for the first two pages, then once for everything
+    assert len(find.candidates) == 3
+    assert all(f"Seite {n}" in text for n in range(1, 5))
+
+
+def test_header_region_is_matched_first(tmp_path):
+    # Lines are 14 pt apart from the top, the top 10 % of the page holds the first three of them
+    lines = ["Rechnungsnr.: RE-HEAD", "Kunde 1"] + ["Position"] * 10 + ["Rechnungsnr.: RE-BODY"]
+    path = write_pdf(tmp_path / "r.pdf", [lines])
+    find = Finder()
+    text, number = extract_invoice_from_text_layer(path, find, max_pages=2, header_fraction=0.1)
+    assert number == "RE-HEAD"
+    [header] = find.candidates
+    assert "RE-BODY" not in header and "Position" not in header
+
+
+def test_header_without_a_number_falls_back_to_the_page(tmp_path):
+    lines = ["Briefkopf"] + ["Position"] * 10 + ["Rechnungsnr.: RE-BODY"]
+    path = write_pdf(tmp_path / "r.pdf", [lines])
+    find = Finder()
+    text, number = extract_invoice_from_text_layer(path, find, max_pages=2, header_fraction=0.1)
+    assert number == "RE-BODY"
+    assert len(find.candidates) == 2
+
+
+def test_unreadable_file_gives_no_number(tmp_path):
+    (tmp_path / "broken.pdf").write_bytes(b"not a pdf")
+    assert extract_invoice_from_text_layer(tmp_path / "broken.pdf", Finder()) == ('', None)
@@ -0,0 +1,38 @@
+import base64
+import quopri
+
+import pytest
+
+from stream_decode import make_stream_decoder
+
+PAYLOAD = bytes(range(256)) * 5
+
+
+# Function to decode data fed in pieces of the given size
+def decode_in_chunks(encoding, data, size):
+    decoder = make_stream_decoder(encoding)
+    out = b''.join(decoder.feed(data[i:i + size]) for i in range(0, len(data), size))
+    return out + decoder.finish()
+
+
+@pytest.mark.parametrize("size", [1, 3, 4, 7, 76, 77, 10000])
+def test_base64_split_anywhere(size):
+    encoded = base64.encodebytes(PAYLOAD).replace(b"\n", b"\r\n")
+    assert decode_in_chunks("base64", encoded, size) == PAYLOAD
+
+
+def test_base64_without_padding():
+    assert decode_in_chunks("BASE64", base64.b64encode(b"invoice!!").rstrip(b"="), 5) == b"invoice!!"
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 5, 76, 10000])
+def test_quoted_printable_split_anywhere(size):
+    text = ("Rechnungsnummer: RE-123 für März = 100 € " * 10).encode("utf-8")
+    encoded = quopri.encodestring(text)
+    assert b"=\n" in encoded and b"=C3" in encoded
+    assert decode_in_chunks("quoted-printable", encoded, size) == text
+
+
+def test_other_encodings_are_stored_as_they_are():
+    assert decode_in_chunks("8bit", PAYLOAD, 100) == PAYLOAD
+    assert decode_in_chunks(None, PAYLOAD, 100) == PAYLOAD
@@ -0,0 +1,101 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from sync_state import UidWatermark, load_sync_state, save_sync_state
+
+
+def test_sync_state_round_trip(tmp_path):
+    state_file = tmp_path / "sync_state.json"
+    assert load_sync_state("a@example.com", state_file) == {"uidvalidity": None, "last_uid": 0}
+    save_sync_state("a@example.com", 7, 42, state_file)
+    save_sync_state("b@example.com", 9, 3, state_file)
+    assert load_sync_state("a@example.com", state_file) == {"uidvalidity": 7, "last_uid": 42}
+    assert json.loads(state_file.read_text())["b@example.com"]["last_uid"] == 3
+
+
+def test_watermark_waits_for_messages_finished_out_of_order():
+    watermark = UidWatermark([11, 12, 13], last_uid=10)
+    assert watermark.value == 10
+    assert not watermark.done(13)
+    assert watermark.value == 10
+    assert watermark.done(11)
+    assert watermark.value == 11
+    assert watermark.done(12)
+    assert watermark.value == 13
+
+
+def test_watermark_stops_before_a_failed_message():
+    watermark = UidWatermark([5, 8, 9], last_uid=4)
+    watermark.done(5)
+    watermark.done(9)
+    # 8 never finishes
+    assert watermark.value == 7
+
+
+def test_watermark_of_a_resync_ends_at_uidnext():
+    watermark = UidWatermark([3], last_uid=20)
+    assert watermark.value == 2
+    watermark.done(3)
+    assert watermark.value == 20
+
+
+def test_check_inbox_keeps_a_failed_message_above_the_watermark(workdir, imap_server, imap, monkeypatch):
+    import email_handler
+    from synthetic import build_message, text_pdf
+    from datetime import datetime, timezone
+
+    date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(4):
+        pdf = text_pdf([[f"Rechnungsnr.: RE-{i:04d}"]])
+        imap_server.mailbox.add(build_message(f"Rechnung {i}", "a@lieferant.de", [(f"r{i}.pdf", pdf)], date))
+
+    # The extraction of the second message fails, the ones after it succeed
+    extract = email_handler.extract_invoice_from_file
+
+    def failing_extract(path, sender=None):
+        if path.name == "r1.pdf":
+            raise RuntimeError("worker died")
+        return extract(path, sender)
+    monkeypatch.setattr(email_handler, "extract_invoice_from_file", failing_extract)
+
+    state_file = workdir / "data" / "sync_state.json"
+    # A first check only sets the watermark (full resync of unseen mail), so start from a known state
+    imap.select("inbox")
+    typ, data = imap.response("UIDVALIDITY")
+    save_sync_state("test", int(data[0]), 0, state_file)
+
+    re_dir = workdir / "re_test"
+    re_dir.mkdir()
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        email_handler.check_inbox(imap, re_dir, workdir / "data" / "email_info.jsonl", "test", executor)
+
+    assert load_sync_state("test", state_file)["last_uid"] == 1
+    assert sorted(path.name for path in (workdir / "Re_Erledigttest").iterdir()) == [
+        "RE-0000_r0.pdf", "RE-0002_r2.pdf", "RE-0003_r3.pdf"]
+    # The index knows where the moved invoices are
+    from database import get_database
+    [invoice] = get_database().find_invoice("RE-0002")
+    assert invoice["file_path"] == str(workdir / "Re_Erledigttest" / "RE-0002_r2.pdf")
+
+    # The next check fetches the failed message again and then moves the watermark past all four
+    monkeypatch.setattr(email_handler, "extract_invoice_from_file", extract)
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        email_handler.check_inbox(imap, re_dir, workdir / "data" / "email_info.jsonl", "test", executor)
+    assert load_sync_state("test", state_file)["last_uid"] == 4
+    assert "RE-0001_r1.pdf" in {path.name for path in (workdir / "Re_Erledigttest").iterdir()}
+    assert not (re_dir / "r1_1.pdf").exists() and not (re_dir / "r1.pdf").exists()
+
+    # The refetched message reused its first download, it is no duplicate of itself
+    from ledger import get_ledger
+    [record] = [record for record in get_ledger(workdir / "data" / "email_info.jsonl").records()
+                if record["Subject"] == "Rechnung 1"]
+    assert (record["Attachments"], record["Invoice_number"]) == (["r1.pdf"], "RE-0001")
+    database = get_database()
+    [invoice] = database.find_invoice("RE-0001", "a@lieferant.de")
+    assert invoice["file_path"] == str(workdir / "Re_Erledigttest" / "RE-0001_r1.pdf")
+    rows = database.connection.execute(
+        """SELECT a.filename, a.duplicate_of FROM attachments a JOIN messages m ON m.id = a.message_id
+           WHERE m.subject = 'Rechnung 1'""").fetchall()
+    assert [tuple(row) for row in rows] == [("r1.pdf", None)]
+    assert invoice["message_id"] == database.connection.execute(
+        "SELECT id FROM messages WHERE subject = 'Rechnung 1'").fetchone()[0]
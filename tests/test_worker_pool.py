@@ -0,0 +1,101 @@
+import os
+import time
+
+import pytest
+
+import email_handler
+import worker_pool
+from worker_pool import BoundedExecutor, new_process_pool, parallel_map, task_result
+
+
+def slow_square(n):
+    if n == 3:
+        time.sleep(60)
+    return n * n
+
+
+def crash_once(path):
+    # The first run of 2 kills its process, like a segfault in a PDF library
+    if path.endswith("2") and not os.path.exists(path):
+        open(path, "w").close()
+        os._exit(1)
+    return path[-1]
+
+
+extract_invoice_from_file = email_handler.extract_invoice_from_file
+
+
+def crash_once_extract(path, sender=None):
+    # The first extraction of r1.pdf kills its process, the marker lives next to the invoice folder
+    marker = path.parent.parent / "crashed"
+    if path.name == "r1.pdf" and not marker.exists():
+        marker.touch()
+        os._exit(1)
+    return extract_invoice_from_file(path, sender)
+
+
+@pytest.fixture
+def pool():
+    executor = BoundedExecutor(new_process_pool(2), max_pending=4, factory=lambda: new_process_pool(2))
+    yield executor
+    executor.shutdown()
+
+
+def test_parallel_map_skips_a_hung_task_and_keeps_the_pool_usable(pool):
+    before = pool.executor
+    results = parallel_map(slow_square, range(6), workers=2, timeout=2, default=-1, executor=pool)
+    assert results == [0, 1, 4, -1, 16, 25]
+    # The hung process was killed with its pool, later calls get the fresh one
+    assert pool.executor is not before
+    assert pool.submit(slow_square, 5).result(timeout=30) == 25
+
+
+def test_parallel_map_submits_tasks_of_a_crashed_pool_again(pool, tmp_path):
+    items = [str(tmp_path / f"file{i}") for i in range(4)]
+    assert parallel_map(crash_once, items, workers=2, timeout=30, executor=pool) == ["0", "1", "2", "3"]
+
+
+def test_parallel_map_uses_the_shared_pool(pool, monkeypatch):
+    monkeypatch.setattr(worker_pool, "_shared_pool", pool)
+    assert parallel_map(slow_square, [1, 2]) == [1, 4]
+
+
+def test_task_result_restarts_the_pool_of_a_hung_task(pool):
+    before = pool.executor
+    future = pool.submit(slow_square, 3)
+    with pytest.raises(TimeoutError):
+        task_result(pool, future, slow_square, 3, timeout=2)
+    assert pool.executor is not before
+    assert task_result(pool, pool.submit(slow_square, 4), slow_square, 4) == 16
+
+
+def test_check_inbox_survives_crashed_workers(pool, workdir, imap_server, imap, monkeypatch):
+    from datetime import datetime, timezone
+    from concurrent.futures.process import BrokenProcessPool
+    from synthetic import build_message, text_pdf
+    from sync_state import load_sync_state, save_sync_state
+
+    date = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    for i in range(4):
+        pdf = text_pdf([[f"Rechnungsnr.: RE-{i:04d}"]])
+        imap_server.mailbox.add(build_message(f"Rechnung {i}", "a@lieferant.de", [(f"r{i}.pdf", pdf)], date))
+    state_file = workdir / "data" / "sync_state.json"
+    imap.select("inbox")
+    typ, data = imap.response("UIDVALIDITY")
+    save_sync_state("test", int(data[0]), 0, state_file)
+    # Forked workers of the pool (and of the restarted ones) run the patched extraction
+    monkeypatch.setattr(email_handler, "extract_invoice_from_file", crash_once_extract)
+
+    # A crash before the check leaves a broken pool behind
+    with pytest.raises(BrokenProcessPool):
+        pool.submit(os._exit, 1).result(timeout=30)
+
+    re_dir = workdir / "re_test"
+    re_dir.mkdir()
+    email_handler.check_inbox(imap, re_dir, workdir / "data" / "email_info.jsonl", "test", pool)
+
+    # The crash during the check took down r1.pdf (and whatever ran next to it), all were submitted again
+    assert (workdir / "crashed").exists()
+    assert sorted(path.name for path in (workdir / "Re_Erledigttest").iterdir()) == [
+        "RE-0000_r0.pdf", "RE-0001_r1.pdf", "RE-0002_r2.pdf", "RE-0003_r3.pdf"]
+    assert load_sync_state("test", state_file)["last_uid"] == 4